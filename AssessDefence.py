@@ -1,13 +1,15 @@
 from StateTypes import GraphState, DefenceAnalysis
-from context_utils import build_context
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain_core.prompts import PromptTemplate
+from output_parsing import RepairingOutputParser
+from prompts import node_prompt
+from pre_assessment import pre_assess_defence
+from interview import DEFENCE_QUESTIONNAIRE, consolidation_prompt
+from StageNode import StageNode
+import nodes
 import logging
 
-defence_analysis_parser = PydanticOutputParser(pydantic_object=DefenceAnalysis)
+defence_analysis_parser = RepairingOutputParser(pydantic_object=DefenceAnalysis)
 
-defence_analysis_prompt = PromptTemplate(
-    template="""
+defence_analysis_prompt = node_prompt("""
  Situation
 You are an expert Australian bushfire risk assessor evaluating my
 capability, as a property owner, to defend my home during a bushfire emergency. 
@@ -51,30 +53,26 @@ It is crucial that you provide an accurate, unbiased assessment that could
 save lives during a bushfire emergency. Do not downplay risks or overstate 
 capabilities. Be direct and honest in your evaluation, as people's safety 
 depends on your assessment.
+""", defence_analysis_parser)
 
-    Context: {full_context}
-    
-    {format_instructions}
-    """,
-    input_variables=["full_context"],
-    partial_variables={"format_instructions": defence_analysis_parser.get_format_instructions()},
-)
+# The one LLM call of the stage in batched interview mode
+defence_consolidation_prompt = consolidation_prompt("""
+Assess the household's capability to defend the property from the answers, record 'low' or 'high' in
+capability_level and your reasoning in message and assessment. Only use 'unclear' if the answers do not allow
+either rating.
+""", defence_analysis_parser)
 
-class AssessDefence:
-  def __init__(self, llm):
-    self.llm = llm
-    self.llm_chain = defence_analysis_prompt | llm | defence_analysis_parser
+class AssessDefence(StageNode):
+  def __init__(self, llm, llm_cache=None, fallback_llm=None):
+    super().__init__("defence_assessment", nodes.ASSESS_DEFENCE_NODE, DefenceAnalysis, defence_analysis_parser, defence_analysis_prompt,
+                     defence_consolidation_prompt, DEFENCE_QUESTIONNAIRE, DefenceAnalysis(message="", assessment="", capability_level="unclear"),
+                     llm, llm_cache, fallback_llm, pre_assess=pre_assess_defence)
 
-  def __call__(self, state: GraphState):
+  async def __call__(self, state: GraphState):
     """
     Assesses the ability for users to defend their property against bushfire risk using an LLM and structured parsing.
     """
 
     logging.debug(f"[{state.session_id}] Assessing stay and defend capability")
 
-    full_context = build_context(state)
-    parsed_response = self.llm_chain.invoke({"full_context": full_context})
-
-    return {
-      "defence_assessment": parsed_response,
-    }
\ No newline at end of file
+    return await self.run(state)
@@ -1,13 +1,15 @@
 from StateTypes import GraphState, RiskAnalysis
-from context_utils import build_context
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain_core.prompts import PromptTemplate
+from output_parsing import RepairingOutputParser
+from prompts import node_prompt
+from pre_assessment import pre_assess_risk
+from interview import RISK_QUESTIONNAIRE, consolidation_prompt
+from StageNode import StageNode
+import nodes
 import logging
 
-risk_analysis_parser = PydanticOutputParser(pydantic_object=RiskAnalysis)
+risk_analysis_parser = RepairingOutputParser(pydantic_object=RiskAnalysis)
 
-risk_analysis_prompt = PromptTemplate(
-    template="""
+risk_analysis_prompt = node_prompt("""
 You are a certified bushfire risk consultant operating in Australia 
 with extensive experience in bushfire behaviour, risk assessment 
 methodologies, and emergency management protocols. You are working 
@@ -75,30 +77,25 @@ Do not ask the same question more than once.
 
 If you have determined a High or Low risk, conclude your response by showing
 your risk assessment.
+""", risk_analysis_parser)
 
-Context: {full_context}
+# The one LLM call of the stage in batched interview mode
+risk_consolidation_prompt = consolidation_prompt("""
+Assess the bushfire risk of the property from the answers, record 'low' or 'high' in risk_level and your
+reasoning in message and assessment. Only use 'unclear' if the answers do not allow either rating.
+""", risk_analysis_parser)
 
-{format_instructions}
-    """,
-    input_variables=["full_context"],
-    partial_variables={"format_instructions": risk_analysis_parser.get_format_instructions()},
-)
+class AssessRisk(StageNode):
+  def __init__(self, llm, llm_cache=None, fallback_llm=None):
+    super().__init__("risk_assessment", nodes.ASSESS_RISK_NODE, RiskAnalysis, risk_analysis_parser, risk_analysis_prompt,
+                     risk_consolidation_prompt, RISK_QUESTIONNAIRE, RiskAnalysis(message="", assessment="", risk_level="unclear"),
+                     llm, llm_cache, fallback_llm, pre_assess=pre_assess_risk)
 
-class AssessRisk:
-  def __init__(self, llm):
-    self.llm = llm
-    self.llm_chain = risk_analysis_prompt | llm | risk_analysis_parser
-
-  def __call__(self, state: GraphState):
+  async def __call__(self, state: GraphState):
     """
     Assesses bushfire risk using an LLM and structured parsing.
     """
 
     logging.debug(f"[{state.session_id}] Assessing Bushfire Risk")
 
-    full_context = build_context(state)
-    parsed_response = self.llm_chain.invoke({"full_context": full_context})
-
-    return {
-      "risk_assessment": parsed_response,
-    }
\ No newline at end of file
+    return await self.run(state)
@@ -2,15 +2,14 @@ from StateTypes import GraphState
 import logging
 
 class WebSocketChoice:
-    def __init__(self, section, message_section, prompt, choices, pending_messages, lock):
+    def __init__(self, section, message_section, prompt, choices, send_message):
         self.section = section
         self.prompt = prompt
         self.choices = choices
         self.message_section = message_section
-        self.pending_messages = pending_messages
-        self.lock = lock
+        self.send_message = send_message
 
-    def __call__(self, state: GraphState):
+    async def __call__(self, state: GraphState):
         session_id = state.session_id
         logging.debug(f"[{session_id}]WebSocketChoice node ({self.section})")
         if not session_id:
@@ -30,21 +29,17 @@ class WebSocketChoice:
             level_label = None
         level = risk_level + capability_level
 
-        # Store message to send later
-        with self.lock:
-            if session_id not in self.pending_messages:
-                self.pending_messages[session_id] = []
-            
-            self.pending_messages[session_id].append({
-                "type": "choice",
-                "section": self.section,
-                "prompt": self.prompt,
-                "choices": self.choices,
-                "message": message,
-                "assessment": assessment,
-                "level_label": level_label,
-                "level": level
-            })
+        # Queue the message on the session's outbox
+        self.send_message(session_id, {
+            "type": "choice",
+            "section": self.section,
+            "prompt": self.prompt,
+            "choices": self.choices,
+            "message": message,
+            "assessment": assessment,
+            "level_label": level_label,
+            "level": level
+        })
 
         # Return update to ensure state persistence
         return {
@@ -58,7 +53,7 @@ class WebSocketSelection:
         self.section = section
         self.user_responses = user_responses
 
-    def __call__(self, state: GraphState):
+    async def __call__(self, state: GraphState):
         session_id = state.session_id
         logging.debug(f"[{session_id}]WebSocketSelection node ({self.section})")
         if not session_id:
@@ -68,14 +63,16 @@ class WebSocketSelection:
         if session_id not in self.user_responses:
             return {}
             
-        user_response = self.user_responses[session_id]
+        return self.select(state, self.user_responses[session_id])
 
-        # Update answers in place
+    def select(self, state: GraphState, user_response: str):
+        """
+        Records the user's selection, also used to prepare the state of speculative branches.
+        """
         choice_obj = getattr(state, self.section, None)
-        choice_prompt = choice_obj.choice_prompt
-        choice_obj.choices_made.update({
-            choice_prompt: user_response
-        })
-        choice_obj.last_choice = user_response
-
-        return {self.section: choice_obj}
\ No newline at end of file
+        return {
+            self.section: choice_obj.model_copy(update={
+                "choices_made": {**choice_obj.choices_made, choice_obj.choice_prompt: user_response},
+                "last_choice": user_response,
+            })
+        }
\ No newline at end of file
@@ -1,13 +1,14 @@
 from StateTypes import GraphState, LeavePlan
-from context_utils import build_context
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain_core.prompts import PromptTemplate
+from output_parsing import RepairingOutputParser
+from prompts import node_prompt
+from interview import LEAVE_PLAN_QUESTIONNAIRE, consolidation_prompt
+from StageNode import StageNode
+import nodes
 import logging
 
-risk_analysis_parser = PydanticOutputParser(pydantic_object=LeavePlan)
+leave_plan_parser = RepairingOutputParser(pydantic_object=LeavePlan)
 
-risk_analysis_prompt = PromptTemplate(
-    template="""
+leave_plan_prompt = node_prompt("""
 **Situation**
 You are operating as step 3 in a 4-step agentic bushfire planning application workflow. 
 I have already completed risk assessment (step 1) and defence capability assessment 
@@ -75,31 +76,28 @@ too difficult to predict.
 Your response format must be:
 - status: "more" (if additional information needed) or "done" (if all areas are complete)
 - questions: 1-3 specific, actionable questions targeting identified information gaps (you can ask more questions if required)
+""", leave_plan_parser)
 
-    Context: {full_context}
-    
-    {format_instructions}
-    """,
-    input_variables=["full_context"],
-    partial_variables={"format_instructions": risk_analysis_parser.get_format_instructions()},
-)
+# The one LLM call of the stage in batched interview mode
+leave_plan_consolidation_prompt = consolidation_prompt("""
+Record the complete leave plan from the answers in when_to_leave, where_to_go, how_to_get_there,
+what_to_take, who_to_tell and backup_plan, and set plan_status to "done".
+""", leave_plan_parser)
 
-class CreateLeavePlan:
-  def __init__(self, llm):
-    self.llm = llm
-    self.llm_chain = risk_analysis_prompt | llm | risk_analysis_parser
+class CreateLeavePlan(StageNode):
+  def __init__(self, llm, llm_cache=None, fallback_llm=None):
+    super().__init__("leave_plan", nodes.CREATE_LEAVE_PLAN_NODE, LeavePlan, leave_plan_parser, leave_plan_prompt,
+                     leave_plan_consolidation_prompt, LEAVE_PLAN_QUESTIONNAIRE, LeavePlan(plan_status="more", **dict.fromkeys(LEAVE_PLAN_QUESTIONNAIRE)),
+                     llm, llm_cache, fallback_llm)
 
-  def __call__(self, state: GraphState):
+  def output(self, parsed_response: LeavePlan) -> dict:
+    return {"leave_plan": parsed_response, "questions": parsed_response.questions}
+
+  async def __call__(self, state: GraphState):
     """
     Creates a leave plan using an LLM and structured parsing.
     """
 
     logging.debug(f"[{state.session_id}] Creating stay and defend plan")
 
-    full_context = build_context(state)
-    parsed_response = self.llm_chain.invoke({"full_context": full_context})
-
-    return {
-      "leave_plan": parsed_response,
-      "questions": parsed_response.questions
-    }
\ No newline at end of file
+    return await self.run(state)
@@ -1,13 +1,14 @@
 from StateTypes import GraphState, StayPlan
-from context_utils import build_context
-from langchain_core.output_parsers import PydanticOutputParser
-from langchain_core.prompts import PromptTemplate
+from output_parsing import RepairingOutputParser
+from prompts import node_prompt
+from interview import STAY_PLAN_QUESTIONNAIRE, consolidation_prompt
+from StageNode import StageNode
+import nodes
 import logging
 
-risk_analysis_parser = PydanticOutputParser(pydantic_object=StayPlan)
+stay_plan_parser = RepairingOutputParser(pydantic_object=StayPlan)
 
-risk_analysis_prompt = PromptTemplate(
-    template="""
+stay_plan_prompt = node_prompt("""
 **Situation**
 You are operating as part of an agentic bushfire planning application that follows 
 a structured workflow. You are currently at step 3 of the process, where I have 
@@ -85,31 +86,28 @@ Your response format must be:
 It is cruicial that you systematically collect complete information for each 
 area before marking the assessment as "done" - incomplete information could 
 result in a plan that fails to protect lives and property during a bushfire emergency.
+""", stay_plan_parser)
 
-      Context: {full_context}
-      
-      {format_instructions}
-    """,
-    input_variables=["full_context"],
-    partial_variables={"format_instructions": risk_analysis_parser.get_format_instructions()},
-)
+# The one LLM call of the stage in batched interview mode
+stay_plan_consolidation_prompt = consolidation_prompt("""
+Record the complete stay and defend plan from the answers in when_to_start, before_the_fire,
+during_the_fire, after_the_fire, who_can_help, peoples_roles and backup_plan, and set plan_status to "done".
+""", stay_plan_parser)
 
-class CreateStayPlan:
-   def __init__(self, llm):
-      self.llm = llm
-      self.llm_chain = risk_analysis_prompt | llm | risk_analysis_parser
+class CreateStayPlan(StageNode):
+   def __init__(self, llm, llm_cache=None, fallback_llm=None):
+      super().__init__("stay_plan", nodes.CREATE_STAY_PLAN_NODE, StayPlan, stay_plan_parser, stay_plan_prompt,
+                       stay_plan_consolidation_prompt, STAY_PLAN_QUESTIONNAIRE, StayPlan(plan_status="more", **dict.fromkeys(STAY_PLAN_QUESTIONNAIRE)),
+                       llm, llm_cache, fallback_llm)
 
-   def __call__(self, state: GraphState):
+   def output(self, parsed_response: StayPlan) -> dict:
+      return {"stay_plan": parsed_response, "questions": parsed_response.questions}
+
+   async def __call__(self, state: GraphState):
       """
       Creates a stay and defend plan using an LLM and structured parsing.
       """
 
       logging.debug(f"[{state.session_id}] Creating stay and defend plan")
 
-      full_context = build_context(state)
-      parsed_response = self.llm_chain.invoke({"full_context": full_context})
-
-      return {
-         "stay_plan": parsed_response,
-         "questions": parsed_response.questions
-      }
\ No newline at end of file
+      return await self.run(state)
@@ -0,0 +1,222 @@
+from collections import OrderedDict
+from typing import Optional
+from langchain_core.messages import AIMessage, AIMessageChunk
+from pydantic import BaseModel
+from context_utils import count_tokens
+from prompts import static_prefix
+import asyncio
+import hashlib
+import logging
+import re
+import settings
+import sqlite3
+import threading
+import time
+
+def normalise_context(context: str) -> str:
+    # Near-identical answers ("No.", "no", " NO ") should share a cache entry. Only punctuation ending a sentence
+    # is dropped, "1.5 km" and "15 km" or "10:30" and "1030" are different answers.
+    context = context.lower()
+    context = re.sub(r"[.!?]+(?=\s|$)", "", context)
+    return re.sub(r"\s+", " ", context).strip()
+
+class LLMCache:
+    """
+    Caches LLM responses keyed on the model name, the prompt template and the normalised context.
+
+    Responses are kept in an in-memory LRU tier and, when db_path is given, in a SQLite tier that survives
+    restarts and can be shared. Entries expire after ttl_seconds and each tier is limited in size. Hit and
+    miss counters, along with the tokens the hits saved, are kept for reporting.
+    """
+
+    def __init__(self, ttl_seconds: int, max_entries: int, db_path: Optional[str] = None, db_max_entries: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.db_max_entries = db_max_entries
+
+        self.memory: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self.lock = threading.Lock()
+        # Calls being made for a key, so concurrent identical calls share a single LLM call
+        self.inflight: dict[str, asyncio.Future] = {}
+
+        self.conn = None
+        if db_path:
+            self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)""")
+            self.db_writes = 0
+
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+        self.saved_prompt_tokens = 0
+        self.saved_completion_tokens = 0
+
+    @staticmethod
+    def make_key(model_name: str, template: str, context: str) -> str:
+        key = hashlib.sha256()
+        for part in (model_name, template, normalise_context(context)):
+            key.update(part.encode())
+            key.update(b"\0")
+        return key.hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self.lock:
+            if key in self.memory:
+                created_at, value = self.memory[key]
+                if now - created_at < self.ttl_seconds:
+                    self.memory.move_to_end(key)
+                    self.hits["memory"] += 1
+                    return value
+                del self.memory[key]
+
+            if self.conn:
+                row = self.conn.execute("SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+                if row and now - row[1] < self.ttl_seconds:
+                    self.conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                    self._remember(key, row[1], row[0])
+                    self.hits["disk"] += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self.lock:
+            self._remember(key, now, value)
+            if self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?)", (key, value, now, now))
+                self.db_writes += 1
+                if self.db_writes % 100 == 0:
+                    self._prune_db(now)
+
+    def _remember(self, key: str, created_at: float, value: str):
+        self.memory[key] = (created_at, value)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _prune_db(self, now: float):
+        self.conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        self.conn.execute("""DELETE FROM llm_cache WHERE key NOT IN (
+            SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT ?)""", (self.db_max_entries,))
+
+    async def aget(self, key: str) -> Optional[str]:
+        if self.conn:
+            return await asyncio.to_thread(self.get, key)
+        return self.get(key)
+
+    async def aset(self, key: str, value: str):
+        if self.conn:
+            return await asyncio.to_thread(self.set, key, value)
+        return self.set(key, value)
+
+    def record_saving(self, context: str, value: str):
+        self.saved_prompt_tokens += count_tokens(context)
+        self.saved_completion_tokens += count_tokens(value)
+
+    def stats(self) -> dict:
+        hits = sum(self.hits.values())
+        return {
+            "hits_memory": self.hits["memory"],
+            "hits_disk": self.hits["disk"],
+            "misses": self.misses,
+            "hit_ratio": hits / (hits + self.misses) if hits + self.misses else 0.0,
+            "saved_prompt_tokens": self.saved_prompt_tokens,
+            "saved_completion_tokens": self.saved_completion_tokens,
+            "saved_cost_usd": round(
+                self.saved_prompt_tokens * settings.LLM_INPUT_COST_PER_MTOK / 1_000_000
+                + self.saved_completion_tokens * settings.LLM_OUTPUT_COST_PER_MTOK / 1_000_000, 4),
+        }
+
+def model_name_of(llm) -> str:
+    return getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__
+
+class CachedChain:
+    """
+    Wraps a node's chain so its responses are served from an LLMCache when the same prompt has been seen before.
+
+    Structured responses are stored as JSON and validated back into output_type, text responses are stored
+    as their content. The chain is called with the node's usual {"full_context": ...} input.
+    """
+
+    def __init__(self, chain, cache: LLMCache, llm, prompt, output_type: Optional[type[BaseModel]] = None):
+        self.chain = chain
+        self.cache = cache
+        self.model_name = model_name_of(llm)
+        self.template = static_prefix(prompt)
+        self.output_type = output_type
+
+    def _encode(self, response) -> str:
+        # AIMessage is a pydantic model too, only structured responses are stored as JSON
+        if self.output_type:
+            return response.model_dump_json()
+        return response.content
+
+    def _decode(self, value: str):
+        if self.output_type:
+            return self.output_type.model_validate_json(value)
+        return AIMessage(content=value)
+
+    async def ainvoke(self, inputs: dict, config=None):
+        context = inputs["full_context"]
+        key = self.cache.make_key(self.model_name, self.template, context)
+
+        while key in self.cache.inflight:
+            logging.debug("Waiting for identical LLM call already in flight")
+            value = await asyncio.shield(self.cache.inflight[key])
+            # None when the call was cancelled, the caller is not cancelled with it and makes the call itself
+            if value is not None:
+                return self._decode(value)
+
+        future = asyncio.get_running_loop().create_future()
+        self.cache.inflight[key] = future
+        try:
+            value = await self.cache.aget(key)
+            if value is not None:
+                self.cache.record_saving(context, value)
+                future.set_result(value)
+                return self._decode(value)
+
+            response = await self.chain.ainvoke(inputs, config)
+            value = self._encode(response)
+            await self.cache.aset(key, value)
+            future.set_result(value)
+            return response
+        except asyncio.CancelledError:
+            # Only this caller was cancelled, the callers waiting on it retry and the first one takes the call over
+            future.set_result(None)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting on it
+            future.exception()
+            raise
+        finally:
+            del self.cache.inflight[key]
+
+    async def astream(self, inputs: dict, config=None):
+        context = inputs["full_context"]
+        key = self.cache.make_key(self.model_name, self.template, context)
+
+        value = await self.cache.aget(key)
+        if value is not None:
+            self.cache.record_saving(context, value)
+            yield AIMessageChunk(content=value)
+            return
+
+        content = ""
+        async for chunk in self.chain.astream(inputs, config):
+            content += chunk.content
+            yield chunk
+        await self.cache.aset(key, content)
+
+def cached_chain(chain, cache: Optional[LLMCache], llm, prompt, output_type: Optional[type[BaseModel]] = None):
+    """
+    Returns the chain wrapped in a CachedChain, or the chain itself when caching is disabled.
+    """
+    if cache is None:
+        return chain
+    return CachedChain(chain, cache, llm, prompt, output_type)
@@ -0,0 +1,258 @@
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from context_utils import count_tokens
+import asyncio
+import logging
+import metrics
+import random
+import time
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+def status_code_of(error: Exception) -> Optional[int]:
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+def retry_after_of(error: Exception) -> Optional[float]:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def split_limit(limit_per_minute: float, shares: int) -> float:
+    """
+    Splits a per minute limit evenly between shares. The shares are not rounded down, so a limit smaller than
+    the number of shares still limits each of them rather than becoming 0, which is unlimited.
+    """
+    return limit_per_minute / shares
+
+class TokenBucket:
+    """
+    Allows rate_per_minute units a minute. Providers enforce their limits over short periods, so bursts are
+    limited to burst_seconds worth of units. A rate of 0 is unlimited.
+    """
+
+    def __init__(self, rate_per_minute: float, burst_seconds: float = 1.0):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        if not self.rate:
+            return 0.0
+        self._refill()
+        # A request larger than the bucket only waits for a full bucket
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def consume(self, amount: float):
+        if self.rate:
+            self._refill()
+            self.tokens -= amount
+
+class LLMScheduler:
+    """
+    Coordinates every LLM call made by this worker so that sessions share the provider's rate limits.
+
+    Calls wait in a queue per session and are started round-robin across sessions, so one session making many
+    calls cannot starve the others. A call is started when fewer than max_in_flight calls are running and the
+    requests and tokens per minute buckets allow it. Calls that fail with a rate limit or server error are
+    retried with jittered exponential backoff. A 429 pauses all calls until its backoff has passed and halves
+    the number of calls allowed in flight, which then grows back by one with each successful call.
+
+    The scheduler is only used from the event loop, so no locks are needed.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, max_in_flight: int,
+                 max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 30.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        # Waiting calls by session, in the order sessions will next be served
+        self.queues: OrderedDict[str, deque] = OrderedDict()
+        self.in_flight = 0
+        self.in_flight_limit = float(max_in_flight)
+        self.paused_until = 0.0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _dispatch(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        while self.queues and self.in_flight < int(self.in_flight_limit):
+            session_id, queue = next(iter(self.queues.items()))
+            future, tokens = queue[0]
+            if future.done():
+                self._pop(session_id, queue)
+                continue
+
+            wait = max(self.paused_until - time.monotonic(), self.requests.wait_time(1), self.tokens.wait_time(tokens))
+            if wait > 0:
+                self.timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+
+            self._pop(session_id, queue)
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+            self.in_flight += 1
+            future.set_result(time.monotonic())
+
+    def _pop(self, session_id: str, queue: deque):
+        queue.popleft()
+        # The session goes to the back of the line for its next call
+        if queue:
+            self.queues.move_to_end(session_id)
+        else:
+            del self.queues[session_id]
+
+    async def acquire(self, session_id: str, tokens: int):
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(session_id, deque()).append((future, tokens))
+        queued_at = time.monotonic()
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        metrics.llm_queue_seconds.observe(time.monotonic() - queued_at)
+
+    def release(self, succeeded: bool = False):
+        self.in_flight -= 1
+        if succeeded:
+            self.in_flight_limit = min(float(self.max_in_flight), self.in_flight_limit + 1)
+        self._dispatch()
+
+    def record_usage(self, tokens: int):
+        """
+        Charges tokens only known once a call completes, such as its completion tokens, to the tokens bucket.
+        """
+        self.tokens.consume(tokens)
+
+    def _backoff(self, attempt: int, error: Exception) -> Optional[float]:
+        status = status_code_of(error)
+        if status not in RETRYABLE_STATUS_CODES or attempt >= self.max_retries:
+            return None
+        # Full jitter spreads retries out, but never retry before the provider's retry-after
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        delay = max(delay, retry_after_of(error) or 0.0)
+        if status == 429:
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            self.in_flight_limit = max(1.0, self.in_flight_limit / 2)
+        metrics.llm_backoffs.inc(status=str(status))
+        return delay
+
+    async def call(self, session_id: str, tokens: int, function: Callable[[], Awaitable[Any]]) -> Any:
+        attempt = 0
+        while True:
+            await self.acquire(session_id, tokens)
+            succeeded = False
+            try:
+                result = await function()
+                succeeded = True
+                return result
+            except Exception as e:
+                delay = self._backoff(attempt, e)
+                if delay is None:
+                    raise
+                logging.warning(f"[{session_id}] LLM call failed with {status_code_of(e)}, retrying in {delay:.2f}s")
+            finally:
+                self.release(succeeded)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def stream(self, session_id: str, tokens: int, function: Callable[[], AsyncIterator]) -> AsyncIterator:
+        """
+        Like call, for streamed responses. Only failures before the first chunk arrives are retried.
+        """
+        attempt = 0
+        while True:
+            await self.acquire(session_id, tokens)
+            started = False
+            try:
+                async for chunk in function():
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                delay = None if started else self._backoff(attempt, e)
+                if delay is None:
+                    raise
+                logging.warning(f"[{session_id}] LLM stream failed with {status_code_of(e)}, retrying in {delay:.2f}s")
+            finally:
+                self.release(started)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+class ScheduledChatModel(BaseChatModel):
+    """
+    Wraps a chat model so its async calls are run by an LLMScheduler.
+
+    Calls are queued under the session's thread_id, which LangGraph adds to the metadata of every run in the
+    graph. The wrapped model's name is reported as this model's name, so cache keys and metrics are unchanged.
+    """
+
+    model: BaseChatModel
+    scheduler: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return self.model._llm_type
+
+    @property
+    def model_name(self) -> str:
+        return getattr(self.model, "model_name", None) or getattr(self.model, "model", None) or self.model._llm_type
+
+    def _get_ls_params(self, stop: Optional[List[str]] = None, **kwargs: Any):
+        return self.model._get_ls_params(stop=stop, **kwargs)
+
+    def _session_id(self, run_manager) -> str:
+        return str((getattr(run_manager, "metadata", None) or {}).get("thread_id", "default"))
+
+    def _prompt_tokens(self, messages: List[BaseMessage]) -> int:
+        return sum(count_tokens(str(message.content)) for message in messages)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        # Synchronous calls are not scheduled, the graph only makes async calls
+        return self.model._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        result = await self.scheduler.call(
+            self._session_id(run_manager),
+            self._prompt_tokens(messages),
+            lambda: self.model._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs),
+        )
+        usage = getattr(result.generations[0].message, "usage_metadata", None) if result.generations else None
+        if usage:
+            self.scheduler.record_usage(usage.get("output_tokens", 0))
+        return result
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        async for chunk in self.scheduler.stream(
+            self._session_id(run_manager),
+            self._prompt_tokens(messages),
+            lambda: self.model._astream(messages, stop=stop, run_manager=run_manager, **kwargs),
+        ):
+            usage = getattr(chunk.message, "usage_metadata", None)
+            if usage:
+                self.scheduler.record_usage(usage.get("output_tokens", 0))
+            yield chunk
@@ -0,0 +1,45 @@
+from typing import Callable, Dict, Optional
+import logging
+
+class ModelRouter:
+    """
+    Chooses the chat model used by each graph node.
+
+    Nodes listed in node_models use the named model, every other node uses default_model. Models are created
+    on first use with model_factory (init_chat_model) and shared between nodes. When fallback is enabled, a
+    node on a smaller model falls back to default_model if its output still fails validation.
+    """
+
+    def __init__(self, model_factory: Callable, default_model: str, node_models: Optional[Dict[str, str]] = None, fallback: bool = True):
+        self.model_factory = model_factory
+        self.default_model = default_model
+        self.node_models = node_models or {}
+        self.fallback_enabled = fallback
+        self.models = {}
+
+    @classmethod
+    def single(cls, llm) -> "ModelRouter":
+        """
+        Returns a router that gives every node the same, already created, model.
+        """
+        return cls(lambda name: llm, "default", fallback=False)
+
+    def get(self, name: str):
+        if name not in self.models:
+            logging.info(f"Initialising chat model {name}")
+            self.models[name] = self.model_factory(name)
+        return self.models[name]
+
+    def model_name(self, node: str) -> str:
+        return self.node_models.get(node, self.default_model)
+
+    def model(self, node: str):
+        return self.get(self.model_name(node))
+
+    def fallback(self, node: str):
+        """
+        Returns the model to retry the node with when its output fails validation, or None.
+        """
+        if not self.fallback_enabled or self.model_name(node) == self.default_model:
+            return None
+        return self.get(self.default_model)
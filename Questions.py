@@ -1,13 +1,13 @@
 from StateTypes import GraphState
+from answers import AnswerStore
 import logging
 
 class WebSocketQuestions:
-    def __init__(self, section, pending_messages, lock):
+    def __init__(self, section, send_message):
         self.section = section
-        self.pending_messages = pending_messages
-        self.lock = lock
+        self.send_message = send_message
 
-    def __call__(self, state: GraphState):
+    async def __call__(self, state: GraphState):
         session_id = state.session_id
         logging.debug(f"[{session_id}]WebSocketQuestions node ({self.section})")
         if not session_id:
@@ -22,16 +22,17 @@ class WebSocketQuestions:
             logging.warning(f"[{session_id}] No questions to ask in section {self.section}")
             return {}
         
-        # Store message to send later
-        with self.lock:
-            if session_id not in self.pending_messages:
-                self.pending_messages[session_id] = []
+        message = {
+            "type": "questions",
+            "section": self.section,
+            "questions": questions
+        }
+        # A questionnaire also says which field of the section each question is for
+        if questions_section.fields:
+            message["fields"] = questions_section.fields
 
-            self.pending_messages[session_id].append({
-                "type": "questions",
-                "section": self.section,
-                "questions": questions
-            })
+        # Queue the message on the session's outbox
+        self.send_message(session_id, message)
         
         return {}
 
@@ -40,7 +41,7 @@ class WebSocketAnswers:
         self.section = section
         self.user_responses = user_responses
 
-    def __call__(self, state: GraphState):
+    async def __call__(self, state: GraphState):
         session_id = state.session_id
         logging.debug(f"[{session_id}]WebSocketAnswers node ({self.section})")
         if not session_id:
@@ -51,9 +52,9 @@ class WebSocketAnswers:
             return {}
         
         user_response = self.user_responses[session_id]
+        if not isinstance(user_response, dict):
+            logging.warning(f"[{session_id}] Expected answers to questions, got {user_response!r}")
+            return {}
 
-        # Update answers in place
-        section_obj = getattr(state, self.section, None)
-        if section_obj and hasattr(section_obj, 'questions'):
-            section_obj.questions.answers.update(user_response)
-        return {}
\ No newline at end of file
+        # Merged into the session's answer store by the graph
+        return {"answers": AnswerStore.of(self.section, user_response)}
\ No newline at end of file
@@ -0,0 +1,389 @@
+from collections import OrderedDict
+from typing import Any, Callable, Coroutine, Dict, Optional
+from fastapi import WebSocket
+import asyncio
+import logging
+import time
+from session_stores import MemorySessionStore
+import metrics
+import wire
+
+# Messages the user answers, the last one is sent again when a session resumes waiting for its answer
+PROMPT_TYPES = ("questions", "choice")
+
+# Messages only sent, never recorded or replayed. A client that misses plan chunks still gets the whole plan in
+# plan_complete.
+UNRECORDED_TYPES = ("plan_chunk",)
+
+class SessionManager:
+    """
+    Owns all per-session state: the session record, its WebSocket and outbox, and user responses.
+
+    Messages for a session are put on its own asyncio.Queue outbox and sent by a writer task dedicated to
+    that session's WebSocket, so sends for different sessions never wait on each other. All state is only
+    touched from the event loop, so no locks are needed.
+
+    Each session's graph is run by one long-lived driver task, which is cancelled when the session is
+    evicted. On shutdown, drivers are given a grace period to finish the step they are running and the
+    checkpointer is then closed, which writes out any buffered checkpoints.
+
+    Sessions idle for longer than ttl_seconds are evicted by a background sweeper and the least recently
+    used session is evicted when max_sessions is exceeded. Evicting a session also removes its
+    checkpointer thread so that memory stays bounded in a long-running pod.
+
+    Every session is also registered in a session store, which records the replica that owns it and keeps
+    each message until it has been sent. A disconnected session is only detached from this worker, and a
+    client reconnecting resumes it from its checkpoint and receives the messages it missed, and the last question
+    or choice is sent again as it may have been written to a connection that was already dead. When the store is
+    shared by several replicas the client can resume on any of them. Detached sessions are removed from the
+    store, with their checkpoints, once they have been idle for twice ttl_seconds.
+    """
+
+    def __init__(self, checkpointer, ttl_seconds: int, max_sessions: int, sweep_interval: int,
+                 store=None, owner: str = "local", resume_timeout: float = 30.0):
+        self.checkpointer = checkpointer
+        self.store = store or MemorySessionStore()
+        self.owner = owner
+        self.resume_timeout = resume_timeout
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+
+        # Sessions are kept in least recently used order
+        self.sessions: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+        self.websockets: Dict[str, WebSocket] = {}
+        self.outboxes: Dict[str, asyncio.Queue] = {}
+        self.writers: Dict[str, asyncio.Task] = {}
+        # User responses wait in each session's inbox until its driver task is ready for them
+        self.inboxes: Dict[str, asyncio.Queue] = {}
+        self.drivers: Dict[str, asyncio.Task] = {}
+        self.user_responses: Dict[str, Dict[str, str]] = {}
+
+        # Callbacks given the session_id of each evicted session, used to drop per-session caches
+        self.on_evict: list[Callable[[str], None]] = []
+
+        self.sweeper: Optional[asyncio.Task] = None
+
+    async def open(self, session_id: str, websocket: WebSocket, encoding: str = "json"):
+        await self.store.register(session_id, self.owner, attached=True)
+        await self._attach(session_id, websocket, encoding)
+
+    async def resume(self, session_id: str, websocket: WebSocket, encoding: str = "json") -> Optional[Dict[str, Any]]:
+        """
+        Attaches a WebSocket to a session registered by this or another replica and makes this worker its owner.
+        Returns the values shared for the session, or None if the store has no such session.
+
+        Messages are sent in the WebSocket's encoding (see wire.py), which may differ from the session's last one.
+        """
+        values = await self.store.get(session_id)
+
+        # Another replica still attached to the session is finishing its step, it detaches once the step is
+        # checkpointed. A replica that has not noticed its client has gone is taken over after resume_timeout.
+        deadline = time.monotonic() + self.resume_timeout
+        while values and values.get("attached") and values["owner"] != self.owner and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+            values = await self.store.get(session_id)
+
+        # The claim fails if another replica has claimed the session since it was read
+        if values is None or not await self.store.claim(session_id, self.owner, values["owner"]):
+            return None
+        await self.store.update(session_id, attached=True)
+        if session_id in self.sessions:
+            # The session is still held on an old WebSocket, detach it and wait for its driver to let go
+            old_websocket = self.websockets.get(session_id)
+            driver = self.drivers.get(session_id)
+            await self.detach(session_id, "resumed on a new websocket")
+            if driver and not driver.done():
+                await asyncio.wait([driver])
+            try:
+                await old_websocket.close(code=1001, reason="resumed on a new websocket")
+            except Exception as e:
+                logging.debug(f"[{session_id}] Unable to close websocket: {e}")
+
+        # Messages sent from now on are not pending, so the pending messages are read before the session is attached
+        pending = await self.store.pending(session_id)
+        prompt = (await self.store.get(session_id) or {}).get("last_prompt")
+        await self._attach(session_id, websocket, encoding)
+        self.sessions[session_id]["pending"] = pending
+        # A prompt that is replayed anyway is not sent twice
+        if prompt and prompt["seq"] not in {seq for seq, _ in pending}:
+            self.sessions[session_id]["prompt"] = prompt["message"]
+        return values
+
+    async def replay(self, session_id: str) -> int:
+        """
+        Queues the session's messages that were never delivered to be sent again, returns how many there were.
+        """
+        outbox = self.outboxes.get(session_id)
+        if outbox is None:
+            return 0
+        pending = self.sessions[session_id].pop("pending", [])
+        for seq, message in pending:
+            outbox.put_nowait((seq, message))
+        return len(pending)
+
+    def resend_prompt(self, session_id: str) -> bool:
+        """
+        Sends the last question or choice again to a resumed session waiting for its answer. A message written to
+        a half-open connection counts as delivered, so without this the client might never receive it. The copy is
+        marked repeated, a client still showing the question ignores it.
+        """
+        prompt = self.sessions.get(session_id, {}).pop("prompt", None)
+        if prompt is None:
+            return False
+        logging.info(f"[{session_id}] Sending the last {prompt.get('type')} message again")
+        return self.send(session_id, {**prompt, "repeated": True})
+
+    async def _attach(self, session_id: str, websocket: WebSocket, encoding: str):
+        self.sessions[session_id] = {"last_seen": time.monotonic(), "messages_sent": 0}
+        self.websockets[session_id] = websocket
+        self.outboxes[session_id] = asyncio.Queue()
+        self.inboxes[session_id] = asyncio.Queue()
+        self.writers[session_id] = asyncio.create_task(self.write_loop(session_id, websocket, self.outboxes[session_id], encoding))
+
+        overflow = len(self.sessions) - self.max_sessions
+        for lru_session_id in list(self.sessions.keys())[:max(overflow, 0)]:
+            await self.evict(lru_session_id, "session limit reached", close_websocket=True)
+
+    async def write_loop(self, session_id: str, websocket: WebSocket, outbox: asyncio.Queue, encoding: str = "json"):
+        # Each message is recorded in the store before it is sent and marked delivered once sent, so messages
+        # that could not be sent are replayed when the session resumes. Plan chunks are only sent. None stops
+        # the writer.
+        connected = True
+        while True:
+            item = await outbox.get()
+            if item is None:
+                return
+            seq, message = item
+            recorded = message.get("type") not in UNRECORDED_TYPES
+            try:
+                if seq is None and recorded:
+                    seq = await self.store.append(session_id, message)
+                    if message.get("type") in PROMPT_TYPES:
+                        await self.store.update(session_id, last_prompt={"seq": seq, "message": message})
+                if not connected:
+                    continue
+                frame = wire.encode(message, encoding)
+                if isinstance(frame, bytes):
+                    await websocket.send_bytes(frame)
+                    metrics.websocket_bytes_sent.inc(len(frame), encoding=encoding)
+                else:
+                    await websocket.send_text(frame)
+                    metrics.websocket_bytes_sent.inc(len(frame.encode()), encoding=encoding)
+                if recorded:
+                    await self.store.mark_delivered(session_id, seq)
+            except Exception as e:
+                logging.warning(f"[{session_id}] Unable to send {message.get('type')} message: {e}")
+                connected = False
+
+    def send(self, session_id: str, message: dict) -> bool:
+        """
+        Queues a message to be sent to the session's WebSocket, returns False if the session has no WebSocket.
+        """
+        outbox = self.outboxes.get(session_id)
+        if outbox is None:
+            logging.warning(f"[{session_id}] No outbox for {message.get('type')} message")
+            return False
+        outbox.put_nowait((None, message))
+        self.sessions[session_id]["messages_sent"] += 1
+        return True
+
+    def start_driver(self, session_id: str, driver: Coroutine):
+        """
+        Runs the coroutine as the session's driver task, replacing any driver already running.
+        """
+        if session_id not in self.sessions:
+            driver.close()
+            return
+        previous = self.drivers.get(session_id)
+        if previous and not previous.done():
+            previous.cancel()
+        task = asyncio.create_task(driver)
+        self.drivers[session_id] = task
+        task.add_done_callback(lambda task: self._driver_done(session_id, task))
+
+    def _driver_done(self, session_id: str, task: asyncio.Task):
+        if self.drivers.get(session_id) is task:
+            del self.drivers[session_id]
+        if not task.cancelled() and task.exception():
+            logging.error(f"[{session_id}] Session driver failed: {task.exception()}")
+
+    def respond(self, session_id: str, response) -> bool:
+        inbox = self.inboxes.get(session_id)
+        if inbox is None:
+            return False
+        inbox.put_nowait(response)
+        return True
+
+    async def wait_for_response(self, session_id: str):
+        response = await self.inboxes[session_id].get()
+        # The driver is busy with the response from now on, so a disconnect lets it run the step it starts
+        self.update(session_id, busy=True)
+        return response
+
+    def messages_sent(self, session_id: str) -> int:
+        return self.sessions.get(session_id, {}).get("messages_sent", 0)
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        return self.sessions.get(session_id)
+
+    def update(self, session_id: str, **values):
+        if session_id in self.sessions:
+            self.sessions[session_id].update(values)
+
+    async def share(self, session_id: str, **values):
+        """
+        Records values in the session store, they are returned by resume() on whichever replica resumes the session.
+        """
+        await self.store.update(session_id, **values)
+
+    def detaching(self, session_id: str) -> Optional[str]:
+        return self.sessions.get(session_id, {}).get("detaching")
+
+    async def owns(self, session_id: str) -> bool:
+        return await self.store.owner(session_id) == self.owner
+
+    def touch(self, session_id: str):
+        if session_id in self.sessions:
+            self.sessions[session_id]["last_seen"] = time.monotonic()
+            self.sessions.move_to_end(session_id)
+
+    async def evict(self, session_id: str, reason: str, close_websocket: bool = False, drain: bool = False):
+        logging.info(f"[{session_id}] Evicting session: {reason}")
+        await self._drop(session_id, reason, close_websocket, drain)
+
+        # A session resumed by another replica since is left to that replica
+        if not await self.owns(session_id):
+            return
+
+        try:
+            await self.store.delete(session_id)
+        except Exception as e:
+            logging.error(f"[{session_id}] Unable to delete session from store: {e}")
+
+        try:
+            await self.checkpointer.adelete_thread(session_id)
+        except Exception as e:
+            logging.error(f"[{session_id}] Unable to delete checkpoint thread: {e}")
+
+    async def detach(self, session_id: str, reason: str):
+        """
+        Drops this worker's state for the session but keeps its checkpoints and store entry, so it can resume.
+
+        A session in the middle of a graph step is only marked as detaching. Its driver finishes the step, so the
+        step is checkpointed and its messages recorded, and then calls detach() again.
+        """
+        session = self.sessions.get(session_id)
+        if session is None:
+            return
+        busy = session.get("busy") or not self.inboxes[session_id].empty()
+        if busy and session_id in self.drivers:
+            session["detaching"] = reason
+            return
+
+        logging.info(f"[{session_id}] Detaching session: {reason}")
+        await self._drop(session_id, reason, drain=True)
+        if await self.owns(session_id):
+            await self.store.update(session_id, attached=False)
+
+        # Buffered checkpoints are written out so that another replica resuming the session can read them
+        flush = getattr(self.checkpointer, "flush", None)
+        if flush:
+            try:
+                await asyncio.to_thread(flush)
+            except Exception as e:
+                logging.error(f"[{session_id}] Unable to flush checkpoints: {e}")
+
+    async def disconnect(self, session_id: str, websocket: WebSocket, reason: str):
+        # A session resumed on a new WebSocket is left alone when its old WebSocket closes
+        if self.websockets.get(session_id) is not websocket:
+            return
+        await self.detach(session_id, reason)
+
+    async def _drop(self, session_id: str, reason: str, close_websocket: bool = False, drain: bool = False):
+        self.sessions.pop(session_id, None)
+        websocket = self.websockets.pop(session_id, None)
+        outbox = self.outboxes.pop(session_id, None)
+        self.inboxes.pop(session_id, None)
+        self.user_responses.pop(session_id, None)
+        writer = self.writers.pop(session_id, None)
+        driver = self.drivers.pop(session_id, None)
+        if driver and driver is not asyncio.current_task():
+            driver.cancel()
+
+        if writer and drain and outbox is not None:
+            # Let the writer record the messages still queued so they are replayed on resume
+            outbox.put_nowait(None)
+            try:
+                await asyncio.wait_for(writer, timeout=5)
+            except Exception as e:
+                logging.warning(f"[{session_id}] Unable to record queued messages: {e}")
+        elif writer:
+            writer.cancel()
+
+        for callback in self.on_evict:
+            callback(session_id)
+
+        if close_websocket and websocket:
+            try:
+                await websocket.close(code=1001, reason=reason)
+            except Exception as e:
+                logging.debug(f"[{session_id}] Unable to close websocket: {e}")
+
+    async def sweep(self):
+        cutoff = time.monotonic() - self.ttl_seconds
+        expired = [session_id for session_id, session in self.sessions.items() if session["last_seen"] < cutoff]
+
+        for session_id in expired:
+            await self.evict(session_id, "idle timeout", close_websocket=True)
+
+        # Detached sessions are removed from the store, with their checkpoints, once they have been idle for long enough
+        expired_in_store = await self.store.expire(self.ttl_seconds * 2)
+        for session_id in expired_in_store:
+            try:
+                await self.checkpointer.adelete_thread(session_id)
+            except Exception as e:
+                logging.error(f"[{session_id}] Unable to delete checkpoint thread: {e}")
+        if expired_in_store:
+            logging.info(f"Removed {len(expired_in_store)} idle sessions from the session store")
+
+    async def run_sweeper(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                logging.error(f"Session sweep failed: {e}")
+
+    def start(self):
+        if self.sweeper is None:
+            self.sweeper = asyncio.create_task(self.run_sweeper())
+
+    async def stop(self, grace_seconds: float = 0):
+        if self.sweeper:
+            self.sweeper.cancel()
+            try:
+                await self.sweeper
+            except asyncio.CancelledError:
+                pass
+            self.sweeper = None
+
+        # Let drivers in the middle of a graph step finish it, then cancel everything still running
+        busy = [self.drivers[session_id] for session_id, session in self.sessions.items()
+                if session.get("busy") and session_id in self.drivers]
+        if busy and grace_seconds > 0:
+            logging.info(f"Waiting up to {grace_seconds}s for {len(busy)} sessions to finish their current step")
+            await asyncio.wait(busy, timeout=grace_seconds)
+
+        tasks = list(self.drivers.values()) + list(self.writers.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # Buffered checkpoints are written out so the sessions can resume after the restart
+        close = getattr(self.checkpointer, "close", None)
+        if close:
+            try:
+                await asyncio.to_thread(close)
+            except Exception as e:
+                logging.error(f"Unable to close checkpointer: {e}")
@@ -1,10 +1,10 @@
 from StateTypes import GraphState
 from context_utils import build_context
-from langchain_core.prompts import PromptTemplate
+from prompts import node_prompt
+from langgraph.config import get_stream_writer
 import logging
 
-plan_prompt = PromptTemplate(
-    template="""
+plan_prompt = node_prompt("""
 Situation
 You are an authoritive expert bushfire safety consultant tasked with creating the final deliverable 
 of a comprehensive bushfire survival plan. This is the fourth and final step in an 
@@ -47,18 +47,15 @@ Ensure the document flows logically from risk assessment to specific actions.
 Verify that all sections from the appropriate plan type (leave or stay) are
 included and fully developed.
 Double-check that no placeholder text remains in the final document.
-
-    Context: {full_context}
-    """,
-    input_variables=["full_context"]
-)
+""")
 
 class ShowPlan:
   def __init__(self, llm):
     self.llm = llm
+    # Not cached: the plan is dated, so a plan written for another session on another day would be out of date
     self.llm_chain = plan_prompt | llm
 
-  def __call__(self, state: GraphState):
+  async def __call__(self, state: GraphState):
     """
     Create a bushfire plan based on the information gathered
     """
@@ -66,10 +63,16 @@ class ShowPlan:
     logging.debug(f"[{state.session_id}] Show plan")
 
     full_context = build_context(state)
-    response = self.llm_chain.invoke({"full_context": full_context})
+
+    # Stream the plan so chunks can be forwarded to the UI as they arrive
+    writer = get_stream_writer()
+    content = ""
+    async for chunk in self.llm_chain.astream({"full_context": full_context}):
+      content += chunk.content
+      writer({"type": "plan_chunk", "content": chunk.content})
     
     # Split the HTML into lines for display
-    plan_lines = response.content.split('\n')
+    plan_lines = content.split('\n')
 
     return {
       "final_plan": {"content": plan_lines}
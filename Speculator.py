@@ -0,0 +1,98 @@
+from typing import Callable, Dict, Optional
+from StateTypes import GraphState
+from context_utils import ContextBuilder
+import asyncio
+import logging
+import metrics
+import settings
+
+class Speculator:
+    """
+    Starts the LLM call that follows a choice while the user is still making it.
+
+    Choice nodes are registered with the selection node that records the answer and the LLM node each answer
+    leads to. While the graph waits for a choice, the selection is applied to a copy of the state for each
+    branch (or only the likely one) and the branch's LLM call is started through the LLM cache. When the
+    user's answer arrives, the chosen branch is left to finish so the real node picks up its in-flight call
+    or cached response. The other branches are discarded but also left to finish into the cache rather than
+    cancelled, as another session's real node may be waiting on the same in-flight call.
+
+    Only used from the event loop. Requires the LLM cache, which is what lets the real node reuse the result.
+    """
+
+    def __init__(self, mode: str, callbacks: Optional[list] = None):
+        # 'likely' speculates the predicted branch, 'all' every branch
+        self.mode = mode
+        self.callbacks = callbacks or []
+        self.choices: Dict[str, tuple] = {}
+        self.tasks: Dict[str, Dict[str, asyncio.Task]] = {}
+        # Discarded calls still running, kept referenced until they finish
+        self.discarded: set[asyncio.Task] = set()
+
+    def add_choice(self, interrupt_node: str, selection, branches: Dict[str, tuple], likely: Optional[Callable[[GraphState], str]] = None):
+        """
+        Registers the choice the graph waits for before interrupt_node. branches maps each answer to the
+        (node name, node) of the LLM node it leads to and likely predicts the answer from the state.
+        """
+        self.choices[interrupt_node] = (selection, branches, likely)
+
+    def start(self, session_id: str, interrupt_node: str, state: GraphState):
+        # In batched interview mode the node after a choice sends its questionnaire rather than calling the LLM
+        if interrupt_node not in self.choices or state.interview_mode == "batched":
+            return
+        self.cancel(session_id)
+
+        selection, branches, likely = self.choices[interrupt_node]
+        answers = list(branches.keys())
+        if self.mode == "likely" and likely:
+            answers = [answer for answer in answers if answer == likely(state)]
+
+        tasks = {}
+        for answer in answers:
+            branch_state = state.model_copy(deep=True)
+            branch_state = branch_state.model_copy(update=selection.select(branch_state, answer))
+            node_name, node = branches[answer]
+            if getattr(node, "decided_without_llm", None) and node.decided_without_llm(branch_state):
+                continue
+            tasks[answer] = asyncio.create_task(self._prefetch(session_id, node_name, node, branch_state))
+            logging.info(f"[{session_id}] Speculatively starting {node_name} for answer '{answer}'")
+        self.tasks[session_id] = tasks
+
+    async def _prefetch(self, session_id: str, node_name: str, node, state: GraphState):
+        # A fresh builder renders the same context the node will build once the answer is recorded
+        full_context = ContextBuilder(token_budget=settings.CONTEXT_TOKEN_BUDGET, compact=settings.CONTEXT_COMPACTION).build(state)
+        config = {
+            "callbacks": self.callbacks,
+            "metadata": {"thread_id": session_id, "langgraph_node": node_name, "speculative": True},
+        }
+        try:
+            await node.llm_chain.ainvoke({"full_context": full_context}, config)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"[{session_id}] Speculative {node_name} call failed: {e}")
+
+    def resolve(self, session_id: str, answer):
+        """
+        Keeps the branch for the user's answer and discards the others.
+        """
+        tasks = self.tasks.pop(session_id, None)
+        if not tasks:
+            return
+        for branch, task in tasks.items():
+            if branch == answer:
+                metrics.speculative_prefetches.inc(outcome="used")
+            else:
+                self._discard(task)
+
+    def cancel(self, session_id: str):
+        for task in self.tasks.pop(session_id, {}).values():
+            self._discard(task)
+
+    def _discard(self, task: asyncio.Task):
+        # Cancelling the task could cancel an in-flight call that another session has joined, so it finishes into
+        # the cache instead
+        metrics.speculative_prefetches.inc(outcome="discarded")
+        if not task.done():
+            self.discarded.add(task)
+            task.add_done_callback(self.discarded.discard)
@@ -0,0 +1,79 @@
+from typing import Callable, Optional
+from pydantic import BaseModel
+from StateTypes import GraphState
+from context_utils import build_context, count_tokens
+from LLMCache import cached_chain
+from output_parsing import RepairingOutputParser, structured_chain
+from prompts import static_prefix
+from budgets import stage_usage
+from answers import drop_answered_questions
+from pre_assessment import record_pre_assessment
+from interview import ask_questionnaire, consolidation_context, consolidated
+
+class StageNode:
+    """
+    The LLM call shared by the nodes that run a stage of the interview: the assessments and the plans.
+
+    A stage with pre_assess is first decided from the user's own words when the rules allow it. In batched
+    interview mode the stage then sends its whole questionnaire and makes one consolidation call; in incremental
+    mode it calls the LLM with its prompt and drops the questions the user has already answered. Each LLM call is
+    recorded in the stage's usage for its budget.
+
+    llm_chain is the incremental call, which the speculator may start before the node runs.
+    """
+
+    def __init__(self, section: str, node: str, output_type: type, parser: RepairingOutputParser, prompt,
+                 consolidation_prompt, questionnaire: dict[str, list[str]], pending: BaseModel,
+                 llm, llm_cache=None, fallback_llm=None,
+                 pre_assess: Optional[Callable[[GraphState], Optional[BaseModel]]] = None):
+        self.section = section
+        self.node = node
+        self.questionnaire = questionnaire
+        self.pending = pending
+        self.pre_assess = pre_assess
+        self.llm = llm
+        self.llm_chain = cached_chain(structured_chain(prompt, llm, parser, fallback_llm),
+                                      llm_cache, llm, prompt, output_type)
+        self.prompt_tokens = count_tokens(static_prefix(prompt))
+        self.consolidation_chain = cached_chain(structured_chain(consolidation_prompt, llm, parser, fallback_llm),
+                                                llm_cache, llm, consolidation_prompt, output_type)
+        self.consolidation_prompt_tokens = count_tokens(static_prefix(consolidation_prompt))
+
+    def decided_without_llm(self, state: GraphState) -> bool:
+        # Lets the speculator leave out a call the node will not make
+        return self.pre_assess is not None and self.pre_assess(state) is not None
+
+    def output(self, parsed_response: BaseModel) -> dict:
+        """
+        Returns the state update recording the stage's output.
+        """
+        return {self.section: parsed_response}
+
+    async def run(self, state: GraphState) -> dict:
+        if self.pre_assess is not None:
+            # Clear-cut cases are decided from the user's own words without calling the LLM
+            pre_assessment = self.pre_assess(state)
+            if pre_assessment is not None:
+                record_pre_assessment(self.node, True, state.session_id)
+                return {self.section: pre_assessment}
+
+        # In batched interview mode the stage first sends its whole questionnaire, then makes one LLM call
+        if questionnaire := ask_questionnaire(state, self.section, self.questionnaire, self.pending):
+            return questionnaire
+
+        if self.pre_assess is not None:
+            record_pre_assessment(self.node, False, state.session_id)
+        if state.interview_mode == "batched":
+            full_context = consolidation_context(build_context(state), self.questionnaire, state.answers)
+            parsed_response = consolidated(await self.consolidation_chain.ainvoke({"full_context": full_context}))
+            prompt_tokens = self.consolidation_prompt_tokens
+        else:
+            full_context = build_context(state)
+            parsed_response = await self.llm_chain.ainvoke({"full_context": full_context})
+            parsed_response = drop_answered_questions(parsed_response, state.answers, self.node, state.session_id)
+            prompt_tokens = self.prompt_tokens
+
+        return {
+            **self.output(parsed_response),
+            **stage_usage(self.section, prompt_tokens + count_tokens(full_context), parsed_response),
+        }
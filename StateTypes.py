@@ -1,9 +1,10 @@
 from typing import Annotated
 from langgraph.graph.message import add_messages
 from pydantic import BaseModel, Field
+from pydantic.json_schema import SkipJsonSchema
 from typing import Literal, Optional, List
+from answers import AnswerStore, merge_answers
 import json
-import operator
 
 RiskLevel = Literal['high', 'low', 'unclear']
 
@@ -11,14 +12,15 @@ DefenceCapabilityLevel = Literal['high', 'low', 'unclear']
 
 class Questions(BaseModel):
     questions: list[str] = Field(description="A list of questions to be asked", default_factory=list)
-    answers: dict[str, str] = Field(description="A list of questions and their answers", default_factory=dict)
+    # The output field each questionnaire question is recorded in, left out of the schema the LLM is given
+    fields: SkipJsonSchema[dict[str, str]] = Field(description="The field of each question.", default_factory=dict)
 
     def __repr__(self):
         return json.dumps(self.model_dump(), indent=4)
 
 class Choice(BaseModel):
     choice_prompt: str = Field(description="The prompt to ask the user to make a choice", default="")
-    choices_made: Annotated[dict[str, str], operator.add] = Field(description="A list of choices and their selection - only include choices that have been made, do not include null or empty values", default_factory=dict)
+    choices_made: dict[str, str] = Field(description="A list of choices and their selection - only include choices that have been made, do not include null or empty values", default_factory=dict)
     last_choice: Optional[str] = Field(description="The last choice made by the user.", default=None)
     def __repr__(self):
         return json.dumps(self.model_dump(), indent=4)
@@ -67,6 +69,18 @@ class StayPlan(BaseModel):
     def __repr__(self):
         return json.dumps(self.model_dump(), indent=4)
 
+class StageUsage(BaseModel):
+    iterations: int = Field(description="The number of LLM calls made by the stage.", default=0)
+    tokens: int = Field(description="The estimated prompt and completion tokens used by the stage.", default=0)
+
+def add_stage_usage(current: Optional[dict], update: Optional[dict]) -> dict:
+    # Graph state reducer, the usage returned by a node is added to its stage's running total
+    merged = dict(current or {})
+    for stage, usage in (update or {}).items():
+        previous = merged.get(stage) or StageUsage()
+        merged[stage] = StageUsage(iterations=previous.iterations + usage.iterations, tokens=previous.tokens + usage.tokens)
+    return merged
+
 class PlanOutput(BaseModel):
     content: List[str] = Field(description="The complete bushfire leave plan as a list of strings", default_factory=list)
 
@@ -75,6 +89,7 @@ class GraphState(BaseModel):
     next: Optional[str] = None
     user_motivation: Optional[str] = None
     session_id: Optional[str] = None
+    interview_mode: Literal['incremental', 'batched'] = 'incremental'
 
     # track messages generated by the LLM
     messages: Optional[Annotated[list, add_messages]] = Field(description="A list of messages generated by the LLM.", default_factory=list)
@@ -87,6 +102,12 @@ class GraphState(BaseModel):
     leave_plan: Optional[LeavePlan] = None
     stay_plan: Optional[StayPlan] = None
     final_plan: PlanOutput = Field(description="The final bushfire plan.", default_factory=PlanOutput)
+
+    # every question the user has answered, nodes return new answers and they are merged into the store
+    answers: Annotated[AnswerStore, merge_answers] = Field(description="The user's answers.", default_factory=AnswerStore)
+
+    # LLM calls and tokens used by each stage, checked against the stage's budget when routing
+    stage_usage: Annotated[dict[str, StageUsage], add_stage_usage] = Field(description="Usage by stage.", default_factory=dict)
     
     def __repr__(self):
         return json.dumps(self.model_dump(), indent=4)
\ No newline at end of file
@@ -0,0 +1,144 @@
+from typing import Iterable, Optional
+from pydantic import BaseModel, Field
+import logging
+import metrics
+import re
+import settings
+
+# Words that change how a question is phrased but not what it asks
+FILLER_WORDS = {"a", "an", "the", "please", "can", "could", "would", "you", "tell", "me", "let", "know", "kindly"}
+
+def normalise_question(question: str) -> str:
+    """
+    Returns the key a question is stored under, so "What is your postcode?" and "what is your postcode" match.
+    """
+    question = question.lower().replace("’", "'")
+    question = re.sub(r"\b(what|who|where|when|how|it|that|there)'s\b", r"\1 is", question)
+    question = question.replace("n't", " not").replace("'re", " are").replace("'", "")
+    question = re.sub(r"[^\w\s]+", " ", question)
+    return " ".join(word for word in question.split() if word not in FILLER_WORDS)
+
+# Words a reworded question adds or leaves out without asking about anything else
+REWORDING_WORDS = FILLER_WORDS | {"is", "are", "was", "were", "do", "does", "did", "have", "has", "any", "your", "our",
+                                  "of", "to", "for", "in", "at", "about", "currently", "now", "again", "also", "just",
+                                  "there", "this", "that", "what", "which", "confirm", "whether", "if"}
+
+def same_question(key: str, other: str) -> bool:
+    """
+    Whether two normalised questions ask the same thing, when every word in one but not the other is only
+    rewording. "Is the house connected to mains water?" and "...mains power?" differ in "water" and "power", so
+    they are different questions however alike they look.
+    """
+    if key == other:
+        return True
+    words, other_words = set(key.split()), set(other.split())
+    if not words & other_words - REWORDING_WORDS:
+        return False
+    return not (words ^ other_words) - REWORDING_WORDS
+
+class Answer(BaseModel):
+    section: str = Field(description="The section of the plan the question was asked for.")
+    question: str = Field(description="The question as it was asked.")
+    answer: str = Field(description="The user's answer.")
+    key: str = Field(description="The normalised question.")
+
+class AnswerStore(BaseModel):
+    """
+    The questions a session has asked the user and their answers, in the order they were first asked.
+
+    Answers are keyed on their normalised question and a later answer only replaces an earlier one with the same
+    key, any other answer is added. Questions from the LLM that only reword an answered question are found with
+    find() so they are not asked again. The store keeps at most ANSWER_STORE_MAX_ENTRIES answers, dropping the
+    oldest.
+
+    Instances are not changed in place, the graph merges the answers a node returns with merge_answers.
+    """
+
+    entries: list[Answer] = Field(default_factory=list)
+
+    @classmethod
+    def of(cls, section: str, answers: dict) -> "AnswerStore":
+        return cls(entries=[
+            Answer(section=section, question=question, answer=str(answer), key=normalise_question(question))
+            for question, answer in answers.items() if answer is not None and str(answer).strip()
+        ])
+
+    def get(self, question: str) -> Optional[Answer]:
+        key = normalise_question(question)
+        for entry in self.entries:
+            if entry.key == key:
+                return entry
+        return None
+
+    def find(self, question: str) -> Optional[Answer]:
+        """
+        Returns the answer to the question or to a question it only rewords.
+        """
+        key = normalise_question(question)
+        return self.get(question) or next((entry for entry in self.entries if same_question(key, entry.key)), None)
+
+    def merged(self, other: "AnswerStore") -> "AnswerStore":
+        entries = list(self.entries)
+        for entry in other.entries:
+            # Only the same question replaces an answer, a look-alike question could be asking about something else
+            existing = next((existing for existing in entries if existing.key == entry.key), None)
+            if existing is None:
+                entries.append(entry)
+            else:
+                entries[entries.index(existing)] = existing.model_copy(update={"answer": entry.answer})
+        if len(entries) > settings.ANSWER_STORE_MAX_ENTRIES:
+            logging.warning(f"Answer store holds {len(entries)} answers, dropping the oldest")
+            entries = entries[-settings.ANSWER_STORE_MAX_ENTRIES:]
+        return AnswerStore(entries=entries)
+
+    def unanswered(self, questions: Iterable[str]) -> list[str]:
+        """
+        Returns the questions that have not been answered, without questions repeated in the list itself.
+        """
+        kept = []
+        asked = AnswerStore()
+        for question in questions:
+            if self.find(question) is None and asked.find(question) is None:
+                kept.append(question)
+                asked.entries.append(Answer(section="", question=question, answer="", key=normalise_question(question)))
+        return kept
+
+    def render(self, exclude_sections: Iterable[str] = ()) -> str:
+        """
+        Renders the answers as one "- question answer" line each, grouped under their section.
+        """
+        exclude_sections = set(exclude_sections)
+        lines, section = [], None
+        for entry in self.entries:
+            if entry.section in exclude_sections:
+                continue
+            if entry.section != section:
+                section = entry.section
+                lines.append(f"[{section}]")
+            lines.append(f"- {entry.question} {entry.answer}")
+        return "\n".join(lines)
+
+def merge_answers(current: Optional[AnswerStore], update: Optional[AnswerStore]) -> AnswerStore:
+    # Graph state reducer, answers returned by a node are merged into the session's store
+    if current is None:
+        return update or AnswerStore()
+    if update is None:
+        return current
+    return current.merged(update)
+
+def drop_answered_questions(value, answers: AnswerStore, node: str, session_id: str = None):
+    """
+    Removes the questions the user has already answered, or that repeat each other, from a node's LLM output so
+    no question is asked twice whatever the LLM returns. A plan asking only for answers it already has is done.
+    """
+    questions = value.questions.questions
+    kept = answers.unanswered(questions)
+    if len(kept) == len(questions):
+        return value
+
+    metrics.questions_deduplicated.inc(len(questions) - len(kept), node=node)
+    logging.info(f"[{session_id}] Dropped {len(questions) - len(kept)} questions that were already answered")
+    update = {"questions": value.questions.model_copy(update={"questions": kept})}
+    if not kept and getattr(value, "plan_status", None) == "more":
+        update["plan_status"] = "done"
+    return value.model_copy(update=update)
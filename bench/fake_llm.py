@@ -0,0 +1,181 @@
+from typing import Any, List, Optional
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+import asyncio
+import hashlib
+import json
+import re
+import time
+import zlib
+
+# The field that identifies each output schema in a prompt's format instructions
+SCHEMA_FIELDS = {
+    "risk_level": "risk_assessment",
+    "capability_level": "defence_assessment",
+    "when_to_leave": "leave_plan",
+    "when_to_start": "stay_plan",
+}
+
+def bench_question(stage: str, round: int, index: int) -> str:
+    return f"Bench {stage} question {round}.{index}?"
+
+def bench_answer(question: str) -> str:
+    # The simulated clients answer each bench question with a matching answer the fake model can find
+    return question.replace("question", "answer").rstrip("?")
+
+class FakeChatModel(BaseChatModel):
+    """
+    A deterministic stand-in for the OpenAI chat model used to benchmark the service offline.
+
+    The output schema is recognised from the prompt's format instructions and a schema-valid JSON response is
+    returned. Each stage asks question_rounds rounds of questions_per_round questions before deciding, rounds
+    are complete once the context contains the bench answers to their questions. The final plan is returned as
+    plan_lines lines of HTML. Every call waits for latency seconds (plus latency_per_line per plan line).
+
+    With reask_rate, that fraction of the responses that would decide a stage ask again, reworded, a question the
+    context already answers, as a real model sometimes does.
+
+    Prompt tokens are counted as 4 characters each. Like OpenAI's automatic prompt caching, the part of a prompt of
+    1024 tokens or more that repeats the start of an earlier prompt, in 128 token blocks, is reported as cached.
+    """
+
+    model_name: str = "fake-chat-model"
+    latency: float = 0.5
+    latency_per_line: float = 0.0
+    question_rounds: int = 1
+    questions_per_round: int = 2
+    plan_lines: int = 40
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_prompt_tokens: int = 0
+    reask_rate: float = 0.0
+    reasks: int = 0
+    calls: int = 0
+    # Running hashes of every 128 token block of prefix seen so far
+    seen_prefixes: set = set()
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _schema(self, text: str) -> Optional[str]:
+        # The format instructions end with the JSON schema of the expected output in a code block
+        for block in reversed(re.findall(r"```\s*(\{.*?\})\s*```", text, re.DOTALL)):
+            try:
+                properties = json.loads(block).get("properties", {})
+            except ValueError:
+                continue
+            for field, stage in SCHEMA_FIELDS.items():
+                if field in properties:
+                    return stage
+        return None
+
+    def _pending_round(self, stage: str, text: str) -> Optional[int]:
+        for round in range(1, self.question_rounds + 1):
+            if bench_answer(bench_question(stage, round, 1)) not in text:
+                return round
+        return None
+
+    def _questions(self, stage: str, round: Optional[int]) -> dict:
+        # Answers from earlier rounds are carried forward, as the prompts ask the real model to do
+        answered = range(1, round if round else self.question_rounds + 1)
+        return {
+            "questions": [bench_question(stage, round, i) for i in range(1, self.questions_per_round + 1)] if round else [],
+            "answers": {
+                bench_question(stage, r, i): bench_answer(bench_question(stage, r, i))
+                for r in answered for i in range(1, self.questions_per_round + 1)
+            },
+        }
+
+    def _reask(self, stage: str, text: str) -> bool:
+        # Decided from the prompt so the same prompt always gets the same response
+        return bool(self.reask_rate) and zlib.crc32(text.encode()) % 1000 < self.reask_rate * 1000
+
+    def _reasked(self, stage: str) -> dict:
+        # The first question of the stage reworded, with the answers carried forward as usual
+        return {**self._questions(stage, None), "questions": [f"Could you tell me {bench_question(stage, 1, 1).lower()}"]}
+
+    def respond(self, text: str) -> str:
+        stage = self._schema(text)
+        if stage is None:
+            lines = ["<h1>Bushfire Survival Plan</h1>"]
+            lines += [f"<p>Bench plan line {i} with enough text to resemble a real plan paragraph.</p>" for i in range(1, self.plan_lines)]
+            return "\n".join(lines)
+
+        round = self._pending_round(stage, text)
+        reask = round is None and self._reask(stage, text)
+        if reask:
+            self.reasks += 1
+        if stage in ("risk_assessment", "defence_assessment"):
+            level = "risk_level" if stage == "risk_assessment" else "capability_level"
+            return json.dumps({
+                "message": f"Bench {stage} message",
+                "assessment": f"Bench {stage} assessment",
+                "questions": self._reasked(stage) if reask else self._questions(stage, round),
+                level: "unclear" if round or reask else "high",
+            })
+
+        fields = {
+            "leave_plan": ["when_to_leave", "where_to_go", "how_to_get_there", "what_to_take", "who_to_tell", "backup_plan"],
+            "stay_plan": ["when_to_start", "before_the_fire", "during_the_fire", "after_the_fire", "who_can_help", "peoples_roles", "backup_plan"],
+        }[stage]
+        return json.dumps({
+            "plan_status": "more" if round or reask else "done",
+            "questions": self._reasked(stage) if reask else self._questions(stage, round),
+            **{field: None if round else f"Bench {field}" for field in fields},
+        })
+
+    def _cached_tokens(self, text: str) -> int:
+        if len(text) // 4 < 1024:
+            return 0
+        block = 128 * 4
+        digest = hashlib.sha256()
+        cached = 0
+        for end in range(block, len(text) + 1, block):
+            digest.update(text[end - block:end].encode())
+            key = digest.hexdigest()
+            if key in self.seen_prefixes and cached == end - block:
+                cached = end
+            self.seen_prefixes.add(key)
+        return cached // 4 if cached // 4 >= 1024 else 0
+
+    def _result(self, messages: List[BaseMessage]) -> tuple[str, dict]:
+        text = "\n".join(str(message.content) for message in messages)
+        content = self.respond(text)
+        usage = {
+            "input_tokens": len(text) // 4,
+            "output_tokens": len(content) // 4,
+            "total_tokens": len(text) // 4 + len(content) // 4,
+            "input_token_details": {"cache_read": self._cached_tokens(text)},
+        }
+        self.calls += 1
+        self.prompt_tokens += usage["input_tokens"]
+        self.cached_prompt_tokens += usage["input_token_details"]["cache_read"]
+        self.completion_tokens += usage["output_tokens"]
+        return content, usage
+
+    def _delay(self, content: str) -> float:
+        return self.latency + self.latency_per_line * content.count("\n")
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        content, usage = self._result(messages)
+        time.sleep(self._delay(content))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content, usage_metadata=usage))])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        content, usage = self._result(messages)
+        await asyncio.sleep(self._delay(content))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content, usage_metadata=usage))])
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any):
+        content, usage = self._result(messages)
+        lines = content.split("\n")
+        await asyncio.sleep(self.latency)
+        for i, line in enumerate(lines):
+            await asyncio.sleep(self.latency_per_line)
+            text = line if i == len(lines) - 1 else line + "\n"
+            chunk = AIMessageChunk(content=text, usage_metadata=usage if i == len(lines) - 1 else None)
+            if run_manager:
+                await run_manager.on_llm_new_token(text, chunk=ChatGenerationChunk(message=chunk))
+            yield ChatGenerationChunk(message=chunk)
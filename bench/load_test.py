@@ -0,0 +1,378 @@
+"""
+Offline load test for the bushfire plan WebSocket API.
+
+Runs the real FastAPI app under uvicorn with the LLM replaced by a deterministic FakeChatModel, then drives the
+/ws endpoint with N simulated clients that start a session, answer every questions/choice message and wait for
+plan_complete. Reports sessions/sec, per-node latency percentiles and RSS growth.
+
+    python bench/load_test.py --clients 50 --latency 0.5
+
+With --redis the sessions and checkpoints are kept in Redis, a server at the given URL or an in-process fakeredis
+server with --redis fake, as they are when several replicas run.
+
+With --openai-stub the real OpenAI chat model is used against a local stand-in server (bench/openai_stub.py), so
+the LLM scheduler's rate limiting and backoff can be tested with --stub-requests-per-minute and --stub-error-rate.
+
+Exits with a non-zero status if any session fails or a --max-* threshold is exceeded, so it can run in CI.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_llm import FakeChatModel, bench_answer
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Motivations that make the risk and defence assessments clear-cut, so the pre-assessment rules decide them. The
+# rules only decide a high risk and a low capability.
+CLEAR_CUT_MOTIVATIONS = [
+    "Our house backs onto the national park on a steep ridge with a single access road. We have a baby and only a garden hose.",
+    "We live on a bush block in dense scrub at the top of a hill, down a long dirt track. We are elderly, with no pump "
+    "and only mains water.",
+]
+
+def motivation(index: int, clear_cut: bool) -> str:
+    if clear_cut:
+        return f"Bench session {index}. {CLEAR_CUT_MOTIVATIONS[index % len(CLEAR_CUT_MOTIVATIONS)]}"
+    return f"Bench session {index} on a bush block"
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+node_timings = defaultdict(list)
+
+def instrument_nodes():
+    """
+    Wraps every node added to the graph so its wall time is recorded in node_timings.
+    """
+    from langgraph.graph import StateGraph
+
+    add_node = StateGraph.add_node
+
+    def timed_add_node(self, node, action=None, **kwargs):
+        async def timed(state):
+            start = time.perf_counter()
+            try:
+                result = action(state)
+                if asyncio.iscoroutine(result):
+                    result = await result
+                return result
+            finally:
+                node_timings[node].append(time.perf_counter() - start)
+        return add_node(self, node, timed, **kwargs)
+
+    StateGraph.add_node = timed_add_node
+
+def use_fake_redis():
+    """
+    Points every Redis client the app creates at one in-process fakeredis server.
+    """
+    try:
+        import fakeredis
+    except ImportError as e:
+        raise SystemExit("--redis fake needs the fakeredis package (pip install fakeredis)") from e
+    import redis.asyncio
+
+    server = fakeredis.FakeServer()
+    redis.asyncio.from_url = lambda url, **kwargs: fakeredis.FakeAsyncRedis(server=server, **kwargs)
+
+def load_app(fake: FakeChatModel, workdir: str, cache: bool, requests_per_minute: int, tokens_per_minute: int,
+             openai_url: str = None, speculate: str = "off", redis_url: str = None, pre_assessment: bool = False):
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ["CHECKPOINT_DB_PATH"] = os.path.join(workdir, "checkpoints.sqlite")
+    os.environ["SESSION_STORE_DB_PATH"] = os.path.join(workdir, "sessions.sqlite")
+    os.environ["LLM_CACHE"] = "true" if cache else "false"
+    os.environ["LLM_REQUESTS_PER_MINUTE"] = str(requests_per_minute)
+    os.environ["LLM_TOKENS_PER_MINUTE"] = str(tokens_per_minute)
+    os.environ["SPECULATIVE_PREFETCH"] = speculate
+    os.environ["PRE_ASSESSMENT"] = "true" if pre_assessment else "false"
+
+    if redis_url:
+        # Sessions and checkpoints in Redis, as run by several replicas
+        os.environ["SESSION_STORE"] = "redis"
+        os.environ["CHECKPOINTER"] = "redis"
+        if redis_url == "fake":
+            use_fake_redis()
+        else:
+            os.environ["REDIS_URL"] = redis_url
+
+    if openai_url:
+        os.environ["OPENAI_BASE_URL"] = openai_url
+        os.environ["OPENAI_API_KEY"] = "bench"
+    else:
+        import langchain.chat_models
+        langchain.chat_models.init_chat_model = lambda *args, **kwargs: fake
+    instrument_nodes()
+
+    import logging
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    for name in ("langgraph", "langgraph.pregel", "__main__", "httpx"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    return main
+
+def start_server(app) -> tuple[int, object]:
+    import uvicorn
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", ws_max_size=16 * 1024 * 1024))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return port, server
+
+async def run_client(url: str, index: int, think_time: float, result: dict, reconnect: bool = False, interview: str = None,
+                     clear_cut: bool = False, compression: bool = True):
+    import websockets
+    import wire
+
+    def connect():
+        return websockets.connect(url, max_size=None, compression="deflate" if compression else None)
+
+    strategy = "leave" if index % 2 == 0 else "stay"
+    start = time.perf_counter()
+    session_id = None
+    prompt = {}
+
+    async def resume(ws):
+        await ws.close()
+        ws = await connect()
+        await ws.recv()
+        await ws.send(json.dumps({"type": "resume_session", "session_id": session_id}))
+        message = wire.decode(await ws.recv())
+        if message["type"] != "session_resumed":
+            raise RuntimeError(f"session not resumed: {message}")
+        result["reconnects"] += 1
+        return ws
+
+    ws = await connect()
+    try:
+        while True:
+            message = wire.decode(await ws.recv())
+            kind = message["type"]
+            result["messages"] += 1
+
+            if message.get("repeated") and {**message, "repeated": None} == {**prompt, "repeated": None}:
+                # Sent again on resume, this client already answered it
+                continue
+            if kind in ("questions", "choice"):
+                prompt = message
+
+            if kind in ("questions", "choice") and reconnect:
+                # Drop the connection before answering, so the session resumes waiting for the answer
+                ws = await resume(ws)
+
+            if kind == "session_started":
+                session_id = message["session_id"]
+                start_session = {"type": "start_session", "motivation": motivation(index, clear_cut)}
+                if interview:
+                    start_session["interview"] = interview
+                await ws.send(json.dumps(start_session))
+            elif kind == "questions":
+                await asyncio.sleep(think_time)
+                await ws.send(json.dumps({"type": "user_response", "answers": {q: bench_answer(q) for q in message["questions"]}}))
+            elif kind == "choice":
+                await asyncio.sleep(think_time)
+                answer = "yes" if "yes" in message["choices"] else strategy
+                await ws.send(json.dumps({"type": "user_response", "answers": answer}))
+
+            if kind in ("questions", "choice") and reconnect:
+                # And again straight after answering, so the next message is sent while disconnected and replayed
+                ws = await resume(ws)
+            elif kind == "plan_complete":
+                result["ok"] = bool(message["plan"])
+                break
+            elif kind == "error":
+                result["error"] = message.get("message")
+                break
+    finally:
+        await ws.close()
+    result["duration"] = time.perf_counter() - start
+
+async def run_load(port: int, clients: int, concurrency: int, think_time: float, timeout: float, reconnect: bool = False,
+                   interview: str = None, clear_cut_rate: float = 0.0, encoding: str = None, compression: bool = True) -> list:
+    url = f"ws://127.0.0.1:{port}/ws" + (f"?encoding={encoding}" if encoding else "")
+    limit = asyncio.Semaphore(concurrency)
+    results = [{"ok": False, "messages": 0, "reconnects": 0, "error": None, "duration": None} for _ in range(clients)]
+
+    async def one(index: int):
+        async with limit:
+            try:
+                await asyncio.wait_for(run_client(url, index, think_time, results[index], reconnect, interview,
+                                                  index < round(clients * clear_cut_rate), compression), timeout)
+            except Exception as e:
+                results[index]["error"] = f"{type(e).__name__}: {e}"
+
+    await asyncio.gather(*(one(i) for i in range(clients)))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=20, help="number of simulated planning sessions")
+    parser.add_argument("--concurrency", type=int, default=0, help="sessions running at once (default: all)")
+    parser.add_argument("--latency", type=float, default=0.5, help="fake LLM latency per call in seconds")
+    parser.add_argument("--latency-per-line", type=float, default=0.0, help="extra fake LLM latency per plan line")
+    parser.add_argument("--rounds", type=int, default=1, help="question rounds asked by each LLM stage")
+    parser.add_argument("--reask-rate", type=float, default=0.0, help="fraction of deciding LLM responses that ask an answered question again")
+    parser.add_argument("--think-time", type=float, default=0.0, help="seconds a client waits before answering")
+    parser.add_argument("--interview", choices=["incremental", "batched"], help="interview mode the clients choose (default: INTERVIEW_MODE)")
+    parser.add_argument("--clear-cut-rate", type=float, default=0.0, help="fraction of clients whose motivation makes both assessments clear-cut")
+    parser.add_argument("--encoding", choices=["json", "compact", "msgpack"], help="message encoding the clients ask for (default: WS_ENCODING)")
+    parser.add_argument("--timeout", type=float, default=300.0, help="seconds before a session is failed")
+    parser.add_argument("--cache", action="store_true", help="enable the LLM response cache")
+    parser.add_argument("--speculate", choices=["off", "likely", "all"], default="off", help="speculative prefetch mode (enables the cache)")
+    parser.add_argument("--reconnect", action="store_true", help="drop the connection before and after every answer and resume the session on a new one")
+    parser.add_argument("--redis", metavar="URL", help="keep sessions and checkpoints in Redis at URL, or 'fake' for an in-process fakeredis server")
+    parser.add_argument("--requests-per-minute", type=int, default=0, help="LLM scheduler requests per minute (0 for no limit)")
+    parser.add_argument("--tokens-per-minute", type=int, default=0, help="LLM scheduler tokens per minute (0 for no limit)")
+    parser.add_argument("--openai-stub", action="store_true", help="use the OpenAI chat model against a local stand-in server")
+    parser.add_argument("--stub-requests-per-minute", type=int, default=0, help="requests a minute the stand-in allows before returning 429")
+    parser.add_argument("--stub-error-rate", type=float, default=0.0, help="fraction of stand-in requests failed with a 500")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--min-sessions-per-sec", type=float, default=0.0, help="fail if throughput is lower")
+    parser.add_argument("--max-p95", type=float, default=0.0, help="fail if any node's p95 latency (s) is higher")
+    parser.add_argument("--max-rss-growth", type=float, default=0.0, help="fail if RSS grows by more MB than this")
+    args = parser.parse_args()
+
+    fake = FakeChatModel(latency=args.latency, latency_per_line=args.latency_per_line, question_rounds=args.rounds,
+                         reask_rate=args.reask_rate)
+
+    stub = None
+    if args.openai_stub:
+        from openai_stub import create_app
+        stub = create_app(fake, args.stub_requests_per_minute, args.stub_error_rate)
+        stub_port, stub_server = start_server(stub)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        openai_url = f"http://127.0.0.1:{stub_port}/v1" if stub else None
+        app_module = load_app(fake, workdir, args.cache or args.speculate != "off", args.requests_per_minute, args.tokens_per_minute,
+                              openai_url, args.speculate, args.redis, args.clear_cut_rate > 0)
+        port, server = start_server(app_module.app)
+
+        rss_before = rss_mb()
+        start = time.perf_counter()
+        results = asyncio.run(run_load(port, args.clients, args.concurrency or args.clients, args.think_time, args.timeout,
+                                       args.reconnect, args.interview, args.clear_cut_rate, args.encoding))
+        elapsed = time.perf_counter() - start
+        rss_after = rss_mb()
+
+        server.should_exit = True
+        if stub:
+            stub_server.should_exit = True
+
+    # The app ran in this process, so its metrics are this module's
+    import metrics
+
+    completed = [r for r in results if r["ok"]]
+    failures = [r["error"] or "no plan" for r in results if not r["ok"]]
+    durations = [r["duration"] for r in completed]
+
+    report = {
+        "clients": args.clients,
+        "completed": len(completed),
+        "failed": len(failures),
+        "elapsed_s": round(elapsed, 3),
+        "sessions_per_sec": round(len(completed) / elapsed, 3) if elapsed else 0.0,
+        "session_duration_s": {
+            "p50": round(percentile(durations, 50), 3),
+            "p95": round(percentile(durations, 95), 3),
+            "mean": round(statistics.mean(durations), 3) if durations else 0.0,
+        },
+        "reconnects": sum(r["reconnects"] for r in results),
+        "llm_calls": fake.calls,
+        "llm_calls_per_session": round(fake.calls / max(len(completed), 1), 2),
+        "llm_reasks": fake.reasks,
+        "pre_assessments": {
+            "decided": sum(v for labels, v in metrics.pre_assessments.values.items() if ("result", "decided") in labels),
+            "llm": sum(v for labels, v in metrics.pre_assessments.values.items() if ("result", "llm") in labels),
+            "skip_ratio": round(metrics.pre_assessment_skipped_ratio(), 3),
+        },
+        "llm_prompt_tokens": fake.prompt_tokens,
+        "llm_cached_prompt_tokens": fake.cached_prompt_tokens,
+        "llm_cached_prompt_ratio": round(fake.cached_prompt_tokens / fake.prompt_tokens, 3) if fake.prompt_tokens else 0.0,
+        "llm_completion_tokens": fake.completion_tokens,
+        "nodes": {
+            node: {
+                "calls": len(timings),
+                "p50_ms": round(percentile(timings, 50) * 1000, 2),
+                "p95_ms": round(percentile(timings, 95) * 1000, 2),
+                "p99_ms": round(percentile(timings, 99) * 1000, 2),
+            }
+            for node, timings in sorted(node_timings.items())
+        },
+        "openai_stub": stub.state.stats if stub else None,
+        "rss_mb": {"before": round(rss_before, 1), "after": round(rss_after, 1), "growth": round(rss_after - rss_before, 1)},
+        "errors": sorted(set(failures))[:10],
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"Sessions: {report['completed']}/{report['clients']} completed in {report['elapsed_s']}s "
+              f"({report['sessions_per_sec']} sessions/sec), {report['failed']} failed")
+        if args.reconnect:
+            print(f"Reconnects: {report['reconnects']}")
+        print(f"Session duration: p50 {report['session_duration_s']['p50']}s, p95 {report['session_duration_s']['p95']}s")
+        print(f"LLM calls: {report['llm_calls']} ({report['llm_calls_per_session']} per session), "
+              f"{report['llm_prompt_tokens']} prompt / {report['llm_completion_tokens']} completion tokens, "
+              f"{report['llm_cached_prompt_ratio']:.1%} of prompt tokens cached")
+        pre_assessments = report["pre_assessments"]
+        print(f"Assessments decided without the LLM: {pre_assessments['decided']:.0f} of "
+              f"{pre_assessments['decided'] + pre_assessments['llm']:.0f} ({pre_assessments['skip_ratio']:.1%})")
+        if args.reask_rate:
+            print(f"Answered questions asked again by the LLM: {report['llm_reasks']}")
+        if stub:
+            print(f"OpenAI stand-in: {stub.state.stats['requests']} requests, {stub.state.stats['rate_limited']} rate limited, "
+                  f"{stub.state.stats['errors']} errors")
+        print(f"RSS: {report['rss_mb']['before']}MB -> {report['rss_mb']['after']}MB (+{report['rss_mb']['growth']}MB)")
+        print(f"{'Node':<32}{'calls':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for node, stats in report["nodes"].items():
+            print(f"{node:<32}{stats['calls']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+        for error in report["errors"]:
+            print(f"Error: {error}")
+
+    failed = bool(failures)
+    if args.min_sessions_per_sec and report["sessions_per_sec"] < args.min_sessions_per_sec:
+        print(f"Throughput {report['sessions_per_sec']} is below {args.min_sessions_per_sec} sessions/sec")
+        failed = True
+    if args.max_p95:
+        for node, stats in report["nodes"].items():
+            if stats["p95_ms"] / 1000 > args.max_p95:
+                print(f"{node} p95 of {stats['p95_ms']}ms is above {args.max_p95}s")
+                failed = True
+    if args.max_rss_growth and report["rss_mb"]["growth"] > args.max_rss_growth:
+        print(f"RSS grew by {report['rss_mb']['growth']}MB, above {args.max_rss_growth}MB")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+A local stand-in for the OpenAI chat completions endpoint, used to test the LLM scheduler's rate limiting and
+backoff without calling OpenAI.
+
+Responses come from a FakeChatModel. The server enforces a requests per minute limit by returning 429 with a
+retry-after header, and can fail a fraction of requests with a 500.
+
+    python bench/openai_stub.py --port 8100 --requests-per-minute 120
+    OPENAI_BASE_URL=http://127.0.0.1:8100/v1 python main.py
+"""
+from types import SimpleNamespace
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from fake_llm import FakeChatModel
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+class RateLimit:
+    """
+    A token bucket refilled at requests_per_minute / 60 a second, holding up to one second's worth of requests.
+    """
+
+    def __init__(self, requests_per_minute: int):
+        self.rate = requests_per_minute / 60
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """
+        Takes a request from the bucket, or returns the seconds until one is available.
+        """
+        if not self.rate:
+            return 0.0
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+def create_app(fake: FakeChatModel, requests_per_minute: int = 0, error_rate: float = 0.0) -> FastAPI:
+    app = FastAPI(title="OpenAI stand-in")
+    app.state.stats = {"requests": 0, "rate_limited": 0, "errors": 0}
+    rate_limit = RateLimit(requests_per_minute)
+
+    def completion(body: dict, content: str, usage: dict) -> dict:
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", fake.model_name),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    def chunk(body: dict, id: str, delta: dict, finish_reason=None, usage=None) -> str:
+        data = {
+            "id": id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", fake.model_name),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if usage is None else [],
+        }
+        if usage is not None:
+            data["usage"] = usage
+        return f"data: {json.dumps(data)}\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stats = app.state.stats
+        stats["requests"] += 1
+
+        retry_after = rate_limit.take()
+        if retry_after:
+            stats["rate_limited"] += 1
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={"retry-after": f"{retry_after:.3f}"},
+            )
+        if random.random() < error_rate:
+            stats["errors"] += 1
+            return JSONResponse({"error": {"message": "The server had an error", "type": "server_error"}}, status_code=500)
+
+        messages = [SimpleNamespace(content=message.get("content") or "") for message in body.get("messages", [])]
+        content, usage = fake._result(messages)
+        usage = {"prompt_tokens": usage["input_tokens"], "completion_tokens": usage["output_tokens"], "total_tokens": usage["total_tokens"],
+                 "prompt_tokens_details": {"cached_tokens": usage["input_token_details"]["cache_read"]}}
+
+        if not body.get("stream"):
+            await asyncio.sleep(fake._delay(content))
+            return completion(body, content, usage)
+
+        async def events():
+            id = f"chatcmpl-{uuid.uuid4().hex}"
+            await asyncio.sleep(fake.latency)
+            yield chunk(body, id, {"role": "assistant", "content": ""})
+            lines = content.split("\n")
+            for i, line in enumerate(lines):
+                await asyncio.sleep(fake.latency_per_line)
+                yield chunk(body, id, {"content": line if i == len(lines) - 1 else line + "\n"})
+            yield chunk(body, id, {}, finish_reason="stop")
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield chunk(body, id, {}, usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds each completion takes")
+    parser.add_argument("--requests-per-minute", type=int, default=0, help="requests allowed a minute (0 for no limit)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failed with a 500")
+    args = parser.parse_args()
+
+    fake = FakeChatModel(latency=args.latency)
+    uvicorn.run(create_app(fake, args.requests_per_minute, args.error_rate), host="127.0.0.1", port=args.port)
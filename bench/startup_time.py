@@ -0,0 +1,128 @@
+"""
+Startup time benchmark for the bushfire plan API.
+
+Starts the app under uvicorn in a fresh process several times and measures how long each worker takes to start
+listening (GET /healthz answers) and to become ready to run sessions (GET /ready returns 200, once the graph is
+compiled). Nothing is sent to the LLM, so no API key or network access is needed.
+
+    python bench/startup_time.py --runs 5
+
+Exits with a non-zero status if a worker fails to start or a --max-* threshold is exceeded, so it can run in CI.
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def get_status(url: str) -> int:
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except OSError:
+        return 0
+
+def measure_startup(workdir: str, timeout: float) -> dict:
+    port = free_port()
+    env = dict(os.environ)
+    env.setdefault("OPENAI_API_KEY", "bench")
+    env["CHECKPOINT_DB_PATH"] = os.path.join(workdir, "checkpoints.sqlite")
+    env["SESSION_STORE_DB_PATH"] = os.path.join(workdir, "sessions.sqlite")
+
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", ROOT, "--host", "127.0.0.1", "--port", str(port),
+         "--log-level", "warning"],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    listening = ready = None
+    try:
+        while time.perf_counter() - start < timeout:
+            if server.poll() is not None:
+                raise RuntimeError(f"server exited with {server.returncode}: {server.stderr.read().decode()[-500:]}")
+            if listening is None and get_status(f"http://127.0.0.1:{port}/healthz") == 200:
+                listening = time.perf_counter() - start
+            if listening is not None and get_status(f"http://127.0.0.1:{port}/ready") == 200:
+                ready = time.perf_counter() - start
+                break
+            time.sleep(0.01)
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    if ready is None:
+        raise RuntimeError(f"server not ready after {timeout}s")
+    return {"listening_s": listening, "ready_s": ready}
+
+def summary(values: list) -> dict:
+    return {
+        "min": round(min(values), 3),
+        "median": round(statistics.median(values), 3),
+        "max": round(max(values), 3),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="number of times the server is started")
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds before a start is failed")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--max-listening", type=float, default=0.0, help="fail if the median time to listen (s) is higher")
+    parser.add_argument("--max-ready", type=float, default=0.0, help="fail if the median time to ready (s) is higher")
+    args = parser.parse_args()
+
+    runs, errors = [], []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as workdir:
+            try:
+                runs.append(measure_startup(workdir, args.timeout))
+            except RuntimeError as e:
+                errors.append(str(e))
+
+    report = {
+        "runs": args.runs,
+        "started": len(runs),
+        "listening_s": summary([run["listening_s"] for run in runs]) if runs else None,
+        "ready_s": summary([run["ready_s"] for run in runs]) if runs else None,
+        "errors": errors[:10],
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"Starts: {report['started']}/{report['runs']}")
+        for name in ("listening_s", "ready_s"):
+            if report[name]:
+                stats = report[name]
+                print(f"{name[:-2].capitalize():<10} min {stats['min']}s, median {stats['median']}s, max {stats['max']}s")
+        for error in report["errors"]:
+            print(f"Error: {error}")
+
+    failed = bool(errors)
+    if runs and args.max_listening and report["listening_s"]["median"] > args.max_listening:
+        print(f"Median time to listen {report['listening_s']['median']}s is above {args.max_listening}s")
+        failed = True
+    if runs and args.max_ready and report["ready_s"]["median"] > args.max_ready:
+        print(f"Median time to ready {report['ready_s']['median']}s is above {args.max_ready}s")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Bytes-on-wire benchmark for the WebSocket message encodings.
+
+Runs the app offline as bench/load_test.py does and drives complete planning sessions through a local TCP proxy
+that counts the bytes sent each way, for each message encoding (json, compact, msgpack) with and without
+permessage-deflate. Reports the bytes per session sent to the client, compared with uncompressed JSON.
+
+    python bench/wire_size.py --clients 10 --plan-lines 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load_test import load_app, run_load, start_server
+from fake_llm import FakeChatModel
+
+WORDS = ("bushfire", "leave", "early", "property", "road", "water", "tank", "pump", "embers", "smoke", "family",
+         "neighbours", "warning", "rating", "extreme", "catastrophic", "check", "before", "during", "after", "gutters",
+         "hoses", "clothing", "kit", "medications", "documents", "pets", "car", "fuel", "route", "town", "oval",
+         "radio", "phone", "contact", "shelter", "house", "doors", "windows", "sprinklers", "garden", "fence")
+
+class VariedPlanModel(FakeChatModel):
+    """
+    The fake model with a final plan of varied sentences. The load test's plan repeats one line, which would make
+    compression look far better than it is on a real plan.
+    """
+
+    def respond(self, text: str) -> str:
+        content = super().respond(text)
+        if not content.startswith("<h1>"):
+            return content
+        rng = random.Random(len(text))
+        lines = ["<h1>Bushfire Survival Plan</h1>"]
+        for i in range(1, self.plan_lines):
+            tag = "h2" if i % 10 == 1 else "li" if i % 3 else "p"
+            sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))).capitalize()
+            lines.append(f'<{tag} class="plan-{tag}">{sentence}.</{tag}>')
+        return "\n".join(lines)
+
+class CountingProxy:
+    """
+    Forwards TCP connections to the app and counts the bytes sent in each direction, WebSocket framing included.
+    """
+
+    def __init__(self, port: int):
+        self.port = port
+        self.sent = 0
+        self.received = 0
+
+    async def _pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, to_client: bool):
+        try:
+            while data := await reader.read(65536):
+                if to_client:
+                    self.sent += len(data)
+                else:
+                    self.received += len(data)
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        app_reader, app_writer = await asyncio.open_connection("127.0.0.1", self.port)
+        await asyncio.gather(self._pipe(client_reader, app_writer, False), self._pipe(app_reader, client_writer, True))
+
+    async def start(self) -> int:
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self.server.sockets[0].getsockname()[1]
+
+async def measure(port: int, clients: int, encoding: str, compression: bool) -> dict:
+    proxy = CountingProxy(port)
+    proxy_port = await proxy.start()
+    results = await run_load(proxy_port, clients, clients, 0.0, 60.0, encoding=encoding, compression=compression)
+    proxy.server.close()
+    completed = sum(1 for r in results if r["ok"])
+    return {
+        "encoding": encoding,
+        "deflate": compression,
+        "completed": completed,
+        "bytes_to_client_per_session": round(proxy.sent / max(completed, 1)),
+        "bytes_from_client_per_session": round(proxy.received / max(completed, 1)),
+        "errors": sorted({r["error"] for r in results if r["error"]})[:5],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=10, help="sessions run for each encoding")
+    parser.add_argument("--plan-lines", type=int, default=120, help="lines of HTML in the fake model's final plan")
+    parser.add_argument("--rounds", type=int, default=1, help="question rounds asked by each LLM stage")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    fake = VariedPlanModel(latency=0.01, question_rounds=args.rounds, plan_lines=args.plan_lines)
+    with tempfile.TemporaryDirectory() as workdir:
+        app_module = load_app(fake, workdir, False, 0, 0)
+        port, server = start_server(app_module.app)
+        runs = [asyncio.run(measure(port, args.clients, encoding, compression))
+                for encoding in ("json", "compact", "msgpack") for compression in (False, True)]
+        server.should_exit = True
+
+    baseline = runs[0]["bytes_to_client_per_session"]
+    for run in runs:
+        run["reduction"] = round(1 - run["bytes_to_client_per_session"] / baseline, 3) if baseline else 0.0
+
+    if args.json:
+        print(json.dumps(runs, indent=2))
+    else:
+        print(f"{'Encoding':<10}{'deflate':>8}{'to client/session':>20}{'from client/session':>22}{'reduction':>11}")
+        for run in runs:
+            print(f"{run['encoding']:<10}{'on' if run['deflate'] else 'off':>8}{run['bytes_to_client_per_session']:>20}"
+                  f"{run['bytes_from_client_per_session']:>22}{run['reduction']:>11.1%}")
+        for run in runs:
+            for error in run["errors"]:
+                print(f"Error ({run['encoding']}, deflate {'on' if run['deflate'] else 'off'}): {error}")
+
+    sys.exit(0 if all(run["completed"] == args.clients for run in runs) else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+from typing import Callable, Optional
+from pydantic import BaseModel
+from StateTypes import GraphState, StageUsage
+from context_utils import count_tokens
+import logging
+import metrics
+import settings
+
+def stage_budget(stage: str) -> tuple[int, int]:
+    """
+    Returns the maximum LLM calls and tokens of a stage, 0 for no limit.
+    """
+    if stage in settings.STAGE_BUDGETS:
+        iterations, tokens = settings.STAGE_BUDGETS[stage].split("/")
+        return int(iterations), int(tokens)
+    return settings.STAGE_MAX_ITERATIONS, settings.STAGE_TOKEN_BUDGET
+
+def stage_usage(stage: str, prompt_tokens: int, response: BaseModel) -> dict:
+    """
+    Returns the state update recording one LLM call of a stage, added to the stage's usage by the graph.
+    """
+    tokens = prompt_tokens + count_tokens(response.model_dump_json())
+    return {"stage_usage": {stage: StageUsage(iterations=1, tokens=tokens)}}
+
+def exhausted_limit(state: GraphState, stage: str) -> Optional[str]:
+    usage = state.stage_usage.get(stage)
+    if usage is None:
+        return None
+    max_iterations, max_tokens = stage_budget(stage)
+    if max_iterations and usage.iterations >= max_iterations:
+        return "iterations"
+    if max_tokens and usage.tokens >= max_tokens:
+        return "tokens"
+    return None
+
+def budgeted(stage: str, path: Callable[[GraphState], str], loops: set, exhausted: str) -> Callable[[GraphState], str]:
+    """
+    Wraps a conditional edge's path so a stage that has used up its budget takes the exhausted route rather than
+    one of the routes in loops that would call the LLM again.
+    """
+    def route(state: GraphState) -> str:
+        selection = path(state)
+        if selection not in loops:
+            return selection
+        limit = exhausted_limit(state, stage)
+        if limit is None:
+            return selection
+        logging.warning(f"[{state.session_id}] Stage {stage} used up its {limit} budget, continuing as {exhausted}")
+        metrics.stage_budget_exhausted.inc(stage=stage, limit=limit)
+        return exhausted
+    return route
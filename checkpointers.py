@@ -0,0 +1,511 @@
+import asyncio
+import base64
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator, Optional, Sequence
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
+from langgraph.checkpoint.memory import MemorySaver
+import settings
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    parent_checkpoint_id TEXT,
+    type TEXT,
+    checkpoint BLOB,
+    metadata_type TEXT,
+    metadata BLOB,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+);
+CREATE TABLE IF NOT EXISTS writes (
+    thread_id TEXT NOT NULL,
+    checkpoint_ns TEXT NOT NULL DEFAULT '',
+    checkpoint_id TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    channel TEXT NOT NULL,
+    type TEXT,
+    value BLOB,
+    task_path TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
+);
+CREATE INDEX IF NOT EXISTS checkpoints_updated_at ON checkpoints (updated_at);
+"""
+
+class SqliteSaver(BaseCheckpointSaver[str]):
+    """
+    A checkpoint saver that keeps checkpoints in a SQLite database rather than in process memory.
+
+    Writes are buffered and committed in batches. The buffer is flushed when it reaches batch_size,
+    when flush_interval seconds have passed since the last flush, or before any read, so reads
+    always see the latest state. Only the last keep_last checkpoints of each thread are kept and
+    threads not updated for retention_seconds are removed.
+
+    The buffer has its own lock, held only to add or take rows, so the async methods can buffer on the event
+    loop while a flush is writing to the database in a thread. Every flush from the async methods runs in a
+    thread.
+    """
+
+    def __init__(self, path: str, batch_size: int = 20, flush_interval: float = 1.0,
+                 keep_last: int = 3, retention_seconds: int = 86400, serde=None):
+        super().__init__(serde=serde)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.keep_last = keep_last
+        self.retention_seconds = retention_seconds
+
+        # lock guards the connection, buffer_lock the buffer. lock is always taken first when both are held.
+        self.lock = threading.RLock()
+        self.buffer_lock = threading.Lock()
+        self.flushing = False
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+        # Buffered rows waiting to be written, keyed on their primary keys
+        self.pending_checkpoints: dict[tuple, tuple] = {}
+        self.pending_writes: dict[tuple, tuple] = {}
+        self.last_flush = time.monotonic()
+        self.last_prune = 0.0
+
+    def _buffered(self) -> int:
+        return len(self.pending_checkpoints) + len(self.pending_writes)
+
+    def _flush_due(self) -> bool:
+        return (self._buffered() >= self.batch_size
+                or time.monotonic() - self.last_flush >= self.flush_interval)
+
+    def flush(self):
+        with self.lock:
+            with self.buffer_lock:
+                pending_checkpoints, self.pending_checkpoints = self.pending_checkpoints, {}
+                pending_writes, self.pending_writes = self.pending_writes, {}
+            if not pending_checkpoints and not pending_writes:
+                self.last_flush = time.monotonic()
+                return
+
+            threads = {key[:2] for key in pending_checkpoints}
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [key + row for key, row in pending_checkpoints.items()])
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [key + row for key, row in pending_writes.items()])
+                for thread_id, checkpoint_ns in threads:
+                    self._prune_thread(thread_id, checkpoint_ns)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                # The rows are kept for the next flush, behind any buffered since
+                with self.buffer_lock:
+                    self.pending_checkpoints = {**pending_checkpoints, **self.pending_checkpoints}
+                    self.pending_writes = {**pending_writes, **self.pending_writes}
+                raise
+
+            logging.debug(f"Flushed {len(pending_checkpoints)} checkpoints and {len(pending_writes)} writes")
+            self.last_flush = time.monotonic()
+
+            if time.monotonic() - self.last_prune >= 60:
+                self.prune_expired()
+
+    def _prune_thread(self, thread_id: str, checkpoint_ns: str):
+        # Remove all but the newest keep_last checkpoints (and their writes) of a thread
+        stale = self.conn.execute(
+            """SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?
+               ORDER BY checkpoint_id DESC LIMIT -1 OFFSET ?""",
+            (thread_id, checkpoint_ns, self.keep_last)).fetchall()
+        if not stale:
+            return
+        params = [(thread_id, checkpoint_ns, row[0]) for row in stale]
+        self.conn.executemany(
+            "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?", params)
+        self.conn.executemany(
+            "DELETE FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?", params)
+
+    def prune_expired(self):
+        with self.lock:
+            self.last_prune = time.monotonic()
+            cutoff = time.time() - self.retention_seconds
+            expired = [row[0] for row in self.conn.execute(
+                "SELECT thread_id FROM checkpoints GROUP BY thread_id HAVING MAX(updated_at) < ?", (cutoff,))]
+            for thread_id in expired:
+                self._delete_thread(thread_id)
+            if expired:
+                logging.info(f"Removed {len(expired)} expired checkpoint threads")
+
+    def _row_to_tuple(self, thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id,
+                      type_, checkpoint, metadata_type, metadata) -> CheckpointTuple:
+        writes = self.conn.execute(
+            """SELECT task_id, channel, type, value FROM writes
+               WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?
+               ORDER BY task_path, task_id, idx""",
+            (thread_id, checkpoint_ns, checkpoint_id)).fetchall()
+        return CheckpointTuple(
+            config={"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint_id,
+            }},
+            checkpoint=self.serde.loads_typed((type_, checkpoint)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config=({"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": parent_checkpoint_id,
+            }} if parent_checkpoint_id else None),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((t, v))) for task_id, channel, t, v in writes],
+        )
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        with self.lock:
+            self.flush()
+            if checkpoint_id := get_checkpoint_id(config):
+                row = self.conn.execute(
+                    """SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata
+                       FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?""",
+                    (thread_id, checkpoint_ns, checkpoint_id)).fetchone()
+            else:
+                row = self.conn.execute(
+                    """SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata
+                       FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ?
+                       ORDER BY checkpoint_id DESC LIMIT 1""",
+                    (thread_id, checkpoint_ns)).fetchone()
+            return self._row_to_tuple(*row) if row else None
+
+    def list(self, config: Optional[RunnableConfig], *, filter: Optional[dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        query = """SELECT thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata_type, metadata
+                   FROM checkpoints"""
+        conditions, params = [], []
+        if config:
+            conditions.append("thread_id = ?")
+            params.append(config["configurable"]["thread_id"])
+            if (checkpoint_ns := config["configurable"].get("checkpoint_ns")) is not None:
+                conditions.append("checkpoint_ns = ?")
+                params.append(checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                conditions.append("checkpoint_id = ?")
+                params.append(checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            conditions.append("checkpoint_id < ?")
+            params.append(before_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY checkpoint_id DESC"
+
+        with self.lock:
+            self.flush()
+            results = []
+            for row in self.conn.execute(query, params).fetchall():
+                item = self._row_to_tuple(*row)
+                if filter and not all(item.metadata.get(k) == v for k, v in filter.items()):
+                    continue
+                results.append(item)
+                if limit is not None and len(results) >= limit:
+                    break
+        yield from results
+
+    def _buffer_checkpoint(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
+        metadata_type, serialized_metadata = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        with self.buffer_lock:
+            self.pending_checkpoints[(thread_id, checkpoint_ns, checkpoint["id"])] = (
+                config["configurable"].get("checkpoint_id"),
+                type_, serialized_checkpoint,
+                metadata_type, serialized_metadata,
+                time.time(),
+            )
+        return {"configurable": {
+            "thread_id": thread_id,
+            "checkpoint_ns": checkpoint_ns,
+            "checkpoint_id": checkpoint["id"],
+        }}
+
+    def _buffer_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str, task_path: str):
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        checkpoint_id = config["configurable"]["checkpoint_id"]
+        rows = {(thread_id, checkpoint_ns, checkpoint_id, task_id, WRITES_IDX_MAP.get(channel, idx)):
+                (channel, *self.serde.dumps_typed(value), task_path) for idx, (channel, value) in enumerate(writes)}
+        with self.buffer_lock:
+            for key, row in rows.items():
+                # Regular writes are only recorded once, special channels always replace
+                if key[4] >= 0 and key in self.pending_writes:
+                    continue
+                self.pending_writes[key] = row
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        next_config = self._buffer_checkpoint(config, checkpoint, metadata)
+        if self._flush_due():
+            self.flush()
+        return next_config
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str,
+                   task_path: str = "") -> None:
+        self._buffer_writes(config, writes, task_id, task_path)
+        if self._flush_due():
+            self.flush()
+
+    def _delete_thread(self, thread_id: str):
+        self.conn.execute("DELETE FROM checkpoints WHERE thread_id = ?", (thread_id,))
+        self.conn.execute("DELETE FROM writes WHERE thread_id = ?", (thread_id,))
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self.lock:
+            with self.buffer_lock:
+                for pending in (self.pending_checkpoints, self.pending_writes):
+                    for key in [key for key in pending if key[0] == thread_id]:
+                        del pending[key]
+            self._delete_thread(thread_id)
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.conn.close()
+
+    # Async versions run the database work in a thread so the event loop is not blocked.
+    # Buffering only touches memory and is done on the event loop, any flush it makes due runs in a thread.
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config: Optional[RunnableConfig], *, filter: Optional[dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        items = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in items:
+            yield item
+
+    async def _aflush_if_due(self):
+        # One flush at a time, rows buffered meanwhile go in the next one
+        if self.flushing or not self._flush_due():
+            return
+        self.flushing = True
+        try:
+            await asyncio.to_thread(self.flush)
+        finally:
+            self.flushing = False
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        next_config = self._buffer_checkpoint(config, checkpoint, metadata)
+        await self._aflush_if_due()
+        return next_config
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str,
+                          task_path: str = "") -> None:
+        self._buffer_writes(config, writes, task_id, task_path)
+        await self._aflush_if_due()
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def get_next_version(self, current: Optional[str], channel: None) -> str:
+        if current is None:
+            current_v = 0
+        elif isinstance(current, int):
+            current_v = current
+        else:
+            current_v = int(current.split(".")[0])
+        return f"{current_v + 1:032}.{random.random():016}"
+
+def _pack(*values) -> str:
+    return json.dumps([base64.b64encode(value).decode() if isinstance(value, bytes) else value for value in values])
+
+def _unpack(packed: bytes, *binary: int) -> list:
+    values = json.loads(packed)
+    return [base64.b64decode(value) if i in binary and value is not None else value for i, value in enumerate(values)]
+
+class RedisSaver(BaseCheckpointSaver[str]):
+    """
+    A checkpoint saver that keeps checkpoints in Redis (or any Redis-compatible server), so every replica can
+    resume any session.
+
+    Each thread's checkpoints are a hash keyed on checkpoint id, and the writes of each checkpoint are a hash
+    keyed on task and index. Only the last keep_last checkpoints of each thread are kept and a thread's keys
+    expire after retention_seconds without an update. The graph is always run asynchronously, so only the
+    async methods are implemented.
+    """
+
+    def __init__(self, url: str, keep_last: int = 3, retention_seconds: int = 86400, prefix: str = "bushfire", serde=None):
+        super().__init__(serde=serde)
+        try:
+            import redis.asyncio
+        except ImportError as e:
+            raise RuntimeError("CHECKPOINTER=redis needs the redis package (pip install redis)") from e
+        self.redis = redis.asyncio.from_url(url)
+        self.keep_last = keep_last
+        self.retention_seconds = retention_seconds
+        self.prefix = prefix
+
+    def _checkpoints_key(self, thread_id: str, checkpoint_ns: str) -> str:
+        return f"{self.prefix}:checkpoint:{thread_id}:{checkpoint_ns}"
+
+    def _writes_key(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str) -> str:
+        return f"{self.prefix}:checkpoint:{thread_id}:{checkpoint_ns}:writes:{checkpoint_id}"
+
+    async def _to_tuple(self, thread_id: str, checkpoint_ns: str, checkpoint_id: str, packed: bytes) -> CheckpointTuple:
+        parent_checkpoint_id, type_, checkpoint, metadata_type, metadata = _unpack(packed, 2, 4)
+        writes = sorted(_unpack(packed_write, 4) for packed_write in
+                        (await self.redis.hgetall(self._writes_key(thread_id, checkpoint_ns, checkpoint_id))).values())
+        return CheckpointTuple(
+            config={"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint_id,
+            }},
+            checkpoint=self.serde.loads_typed((type_, checkpoint)),
+            metadata=self.serde.loads_typed((metadata_type, metadata)),
+            parent_config=({"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": parent_checkpoint_id,
+            }} if parent_checkpoint_id else None),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((t, v))) for _, task_id, _, channel, v, t in writes],
+        )
+
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        key = self._checkpoints_key(thread_id, checkpoint_ns)
+        checkpoint_id = get_checkpoint_id(config)
+        if not checkpoint_id:
+            checkpoint_ids = await self.redis.hkeys(key)
+            if not checkpoint_ids:
+                return None
+            checkpoint_id = max(checkpoint_ids).decode()
+        packed = await self.redis.hget(key, checkpoint_id)
+        return await self._to_tuple(thread_id, checkpoint_ns, checkpoint_id, packed) if packed else None
+
+    async def alist(self, config: Optional[RunnableConfig], *, filter: Optional[dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        if not config:
+            return
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns") or ""
+        checkpoints = await self.redis.hgetall(self._checkpoints_key(thread_id, checkpoint_ns))
+        before_id = get_checkpoint_id(before) if before else None
+        count = 0
+        for checkpoint_id, packed in sorted(checkpoints.items(), reverse=True):
+            checkpoint_id = checkpoint_id.decode()
+            if get_checkpoint_id(config) and checkpoint_id != get_checkpoint_id(config):
+                continue
+            if before_id and checkpoint_id >= before_id:
+                continue
+            item = await self._to_tuple(thread_id, checkpoint_ns, checkpoint_id, packed)
+            if filter and not all(item.metadata.get(k) == v for k, v in filter.items()):
+                continue
+            yield item
+            count += 1
+            if limit is not None and count >= limit:
+                return
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        key = self._checkpoints_key(thread_id, checkpoint_ns)
+        packed = _pack(
+            config["configurable"].get("checkpoint_id"),
+            *self.serde.dumps_typed(checkpoint),
+            *self.serde.dumps_typed(get_checkpoint_metadata(config, metadata)),
+        )
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, checkpoint["id"], packed)
+            pipe.expire(key, self.retention_seconds)
+            await pipe.execute()
+
+        # Remove all but the newest keep_last checkpoints (and their writes) of the thread
+        stale = sorted(await self.redis.hkeys(key), reverse=True)[self.keep_last:]
+        if stale:
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.hdel(key, *stale)
+                pipe.delete(*(self._writes_key(thread_id, checkpoint_ns, checkpoint_id.decode()) for checkpoint_id in stale))
+                await pipe.execute()
+
+        return {"configurable": {
+            "thread_id": thread_id,
+            "checkpoint_ns": checkpoint_ns,
+            "checkpoint_id": checkpoint["id"],
+        }}
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str,
+                          task_path: str = "") -> None:
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        key = self._writes_key(thread_id, checkpoint_ns, config["configurable"]["checkpoint_id"])
+        async with self.redis.pipeline(transaction=True) as pipe:
+            for idx, (channel, value) in enumerate(writes):
+                idx = WRITES_IDX_MAP.get(channel, idx)
+                # Packed so that sorting the writes orders them by task path, task and index
+                packed = _pack(task_path, task_id, idx, channel, *reversed(self.serde.dumps_typed(value)))
+                # Regular writes are only recorded once, special channels always replace
+                if idx >= 0:
+                    pipe.hsetnx(key, f"{task_id}:{idx}", packed)
+                else:
+                    pipe.hset(key, f"{task_id}:{idx}", packed)
+            pipe.expire(key, self.retention_seconds)
+            await pipe.execute()
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        keys = [key async for key in self.redis.scan_iter(match=f"{self.prefix}:checkpoint:{thread_id}:*")]
+        if keys:
+            await self.redis.delete(*keys)
+
+    get_next_version = SqliteSaver.get_next_version
+
+def create_checkpointer(kind: str = None):
+    """
+    Creates the checkpointer selected by the CHECKPOINTER setting ('sqlite', 'redis' or 'memory').
+    """
+    kind = (kind or settings.CHECKPOINTER).lower()
+
+    if kind == "memory":
+        logging.warning("Using in-memory checkpointer, sessions will be lost on restart")
+        return MemorySaver()
+
+    if kind == "sqlite":
+        logging.info(f"Using SQLite checkpointer at {settings.CHECKPOINT_DB_PATH}")
+        return SqliteSaver(
+            settings.CHECKPOINT_DB_PATH,
+            batch_size=settings.CHECKPOINT_BATCH_SIZE,
+            flush_interval=settings.CHECKPOINT_FLUSH_INTERVAL,
+            keep_last=settings.CHECKPOINT_KEEP_LAST,
+            retention_seconds=settings.CHECKPOINT_RETENTION_SECONDS,
+        )
+
+    if kind == "redis":
+        logging.info(f"Using Redis checkpointer at {settings.REDIS_URL}")
+        return RedisSaver(
+            settings.REDIS_URL,
+            keep_last=settings.CHECKPOINT_KEEP_LAST,
+            retention_seconds=settings.CHECKPOINT_RETENTION_SECONDS,
+        )
+
+    raise ValueError(f"Unknown checkpointer: {kind}")
@@ -1,40 +1,233 @@
-from openai import BaseModel
 from StateTypes import GraphState
+from answers import AnswerStore
+from collections import OrderedDict
 import json
 from pprint import pprint
 import logging
+import metrics
+import threading
+import settings
 
-def build_context(state: GraphState):
-    # Build context from all messages and answers
-    context_parts = []
-    
-    if state.user_motivation:
-        context_parts.append(f"User's reason for creating bushfire plan: {state.user_motivation}")
-    
-    for msg in state.messages:
-        context_parts.append(msg.content)
+# State sections included in the context, in order, with their labels
+CONTEXT_SECTIONS = [
+    ("risk_assessment", "Risk Assessment"),
+    ("continue_with_plan", "Continue with Plan"),
+    ("defence_assessment", "Defence Assessment"),
+    ("stay_or_leave_plan", "Stay or Leave Plan"),
+    ("leave_plan", "Leave Plan"),
+    ("stay_plan", "Stay Plan"),
+    ("answers", "Answers given so far"),
+]
 
-    if state.risk_assessment:
-        context_parts.append(f"Risk Assessment: {state.risk_assessment}")
-    
-    if state.continue_with_plan:
-        context_parts.append(f"Continue with Plan: {state.continue_with_plan}")
+# Sections whose questions and answers have been consumed once their level has been decided
+CONSUMED_WHEN_DECIDED = {
+    "risk_assessment": "risk_level",
+    "defence_assessment": "capability_level",
+}
 
-    if state.defence_assessment:
-        context_parts.append(f"Defence Assessment: {state.defence_assessment}")
-    
-    if state.stay_or_leave_plan:
-        context_parts.append(f"Stay or Leave Plan: {state.stay_or_leave_plan}")
+# Sections of earlier stages that can be cut down to these fields, or left out, to keep the context within its
+# budget. The current stage's plan is always kept in full.
+SECTION_SUMMARIES = {
+    "risk_assessment": {"risk_level", "message"},
+    "continue_with_plan": {"choices_made"},
+    "defence_assessment": {"capability_level", "message"},
+    "stay_or_leave_plan": {"choices_made"},
+}
 
-    if state.leave_plan:
-        context_parts.append(f"Leave Plan: {state.leave_plan}")
-    
-    if state.stay_plan:
-        context_parts.append(f"Stay Plan: {state.stay_plan}")
+encoding = None
+
+def count_tokens(text: str) -> int:
+    """
+    Counts tokens with the gpt-4o tokenizer when it is available, otherwise estimates 4 characters per token.
+    """
+    global encoding
+    if encoding is None:
+        try:
+            import tiktoken
+            encoding = tiktoken.encoding_for_model("gpt-4o")
+        except Exception as e:
+            logging.warning(f"Unable to load tokenizer, estimating token counts: {e}")
+            encoding = False
+    if encoding:
+        return len(encoding.encode(text))
+    return (len(text) + 3) // 4
+
+def consumed_sections(state: GraphState) -> list[str]:
+    return [attr for attr, level_attr in CONSUMED_WHEN_DECIDED.items()
+            if getattr(getattr(state, attr, None), level_attr, None) in ("low", "high")]
+
+def render_section(attr: str, value, compact: bool, consumed: list[str] = ()) -> str:
+    if attr == "answers":
+        # One line per answer rather than JSON, leaving out the answers of consumed sections
+        return "\n" + value.render(consumed if compact else ())
+    # Once a level has been decided the questions and answers that led to it are no longer needed
+    level_attr = CONSUMED_WHEN_DECIDED.get(attr)
+    if compact and level_attr and getattr(value, level_attr, None) in ("low", "high"):
+        return value.model_dump_json(exclude={"questions"})
+    return value.model_dump_json()
+
+class ContextBuilder:
+    """
+    Builds the prompt context for each session incrementally.
+
+    The rendered messages and sections of each session are cached. New messages are rendered and appended,
+    sections are compared against their compact JSON from the last call and the full context is only
+    re-assembled when something has changed.
+
+    When compaction is enabled, consumed questions and answers are left out. A context still over token_budget
+    then drops, until it fits, its oldest messages, the oldest answers to earlier stages, and the sections of
+    earlier stages, first cut down to their decision and then left out. The tokens saved are logged and counted
+    in bushfire_context_tokens_saved_total.
+    """
+
+    def __init__(self, max_sessions: int = 1000, token_budget: int = 0, compact: bool = True):
+        self.max_sessions = max_sessions
+        self.token_budget = token_budget
+        self.compact = compact
+        self.cache: OrderedDict[str, dict] = OrderedDict()
+        self.lock = threading.Lock()
+        self.tokens_saved_total = 0
+
+    def _entry(self, session_id: str) -> dict:
+        with self.lock:
+            entry = self.cache.get(session_id)
+            if entry is None:
+                entry = {"message_ids": [], "messages": [], "sections": {}, "context": None}
+                self.cache[session_id] = entry
+                if len(self.cache) > self.max_sessions:
+                    self.cache.popitem(last=False)
+            else:
+                self.cache.move_to_end(session_id)
+            return entry
 
-    full_context = "\n\n".join(context_parts)
+    def forget(self, session_id: str):
+        with self.lock:
+            self.cache.pop(session_id, None)
 
-    return full_context
+    def build(self, state: GraphState) -> str:
+        entry = self._entry(state.session_id)
+        changed = entry["context"] is None
+
+        if entry.get("motivation") != state.user_motivation:
+            entry["motivation"] = state.user_motivation
+            changed = True
+
+        # Only render messages added since the last call, each message is kept with its token count
+        message_ids = [msg.id for msg in state.messages]
+        cached_ids = entry["message_ids"]
+        if message_ids[:len(cached_ids)] != cached_ids or any(id is None for id in message_ids):
+            entry["messages"] = [(msg.content, count_tokens(msg.content)) for msg in state.messages]
+            changed = True
+        elif len(message_ids) > len(cached_ids):
+            entry["messages"].extend((msg.content, count_tokens(msg.content)) for msg in state.messages[len(cached_ids):])
+            changed = True
+        entry["message_ids"] = message_ids
+
+        # Each section is kept as (full JSON, full tokens, compacted text, compacted tokens)
+        consumed = consumed_sections(state)
+        for attr, label in CONTEXT_SECTIONS:
+            value = getattr(state, attr, None)
+            if attr == "answers":
+                full = f"{value.model_dump_json()} {consumed}" if value and value.entries else None
+            else:
+                full = value.model_dump_json() if value else None
+            cached = entry["sections"].get(attr)
+            if cached and cached[0] == full:
+                continue
+            changed = True
+            if full is None:
+                entry["sections"][attr] = None
+                continue
+            text = f"{label}: {render_section(attr, value, self.compact, consumed)}"
+            full_tokens = count_tokens(f"{label}: {render_section(attr, value, False) if attr == 'answers' else full}")
+            entry["sections"][attr] = (full, full_tokens, text, count_tokens(text) if self.compact else full_tokens)
+
+        if changed:
+            entry["context"], compacted, trimmed = self._assemble(state, entry)
+            entry["tokens_saved"] = compacted + trimmed
+            if entry["tokens_saved"] > 0:
+                self.tokens_saved_total += entry["tokens_saved"]
+                for reason, saved in (("compacted", compacted), ("budget", trimmed)):
+                    if saved:
+                        metrics.context_tokens_saved.inc(saved, reason=reason)
+                logging.info(f"[{state.session_id}] Context compacted, saved {entry['tokens_saved']} tokens "
+                             f"({trimmed} to fit the budget)")
+        else:
+            logging.debug(f"[{state.session_id}] Context unchanged, reusing cached context")
+
+        return entry["context"]
+
+    def _assemble(self, state: GraphState, entry: dict) -> tuple[str, int, int]:
+        """
+        Returns the context, the tokens compaction left out and the tokens left out to fit the budget.
+        """
+        header = []
+        if state.user_motivation:
+            text = f"User's reason for creating bushfire plan: {state.user_motivation}"
+            header.append((text, count_tokens(text)))
+        messages = list(entry["messages"])
+        sections = {attr: (section[2], section[3]) for attr, _ in CONTEXT_SECTIONS if (section := entry["sections"][attr])}
+
+        full_tokens = sum(t for _, t in header + messages) + sum(entry["sections"][attr][1] for attr in sections)
+        compacted_tokens = sum(t for _, t in header + messages) + sum(t for _, t in sections.values())
+        tokens = compacted_tokens
+
+        if self.compact and self.token_budget and tokens > self.token_budget:
+            # The oldest messages go first
+            while tokens > self.token_budget and messages:
+                tokens -= messages.pop(0)[1]
+            if tokens > self.token_budget and "answers" in sections:
+                tokens -= sections["answers"][1]
+                sections["answers"] = self._trim_answers(state, tokens)
+                tokens += sections["answers"][1]
+            # Then earlier stages, cut down to their decision and then left out, oldest first
+            for attr in [attr for attr in SECTION_SUMMARIES if attr in sections]:
+                if tokens <= self.token_budget:
+                    break
+                label = dict(CONTEXT_SECTIONS)[attr]
+                text = f"{label}: {getattr(state, attr).model_dump_json(include=SECTION_SUMMARIES[attr])}"
+                tokens += count_tokens(text) - sections[attr][1]
+                sections[attr] = (text, count_tokens(text))
+            for attr in [attr for attr in SECTION_SUMMARIES if attr in sections]:
+                if tokens <= self.token_budget:
+                    break
+                tokens -= sections.pop(attr)[1]
+            if tokens > self.token_budget:
+                logging.warning(f"[{state.session_id}] Context of {tokens} tokens exceeds budget of {self.token_budget}")
+
+        context_parts = [text for text, _ in header + messages] + [text for text, _ in sections.values()]
+        return "\n\n".join(context_parts), full_tokens - compacted_tokens, compacted_tokens - tokens
+
+    def _trim_answers(self, state: GraphState, other_tokens: int) -> tuple[str, int]:
+        # Leaves out the oldest answers, keeping those of the stage being asked about (the last answered)
+        # however many there are
+        consumed = consumed_sections(state) if self.compact else []
+        entries = [answer for answer in state.answers.entries if answer.section not in consumed]
+        if not entries:
+            return "", 0
+        current = entries[-1].section
+        budget = self.token_budget - other_tokens - count_tokens(f"{dict(CONTEXT_SECTIONS)['answers']}: \n")
+        tokens = sum(count_tokens(f"- {answer.question} {answer.answer}") + 1 for answer in entries)
+        kept = list(entries)
+        for answer in entries:
+            if tokens <= budget:
+                break
+            if answer.section != current:
+                kept.remove(answer)
+                tokens -= count_tokens(f"- {answer.question} {answer.answer}") + 1
+
+        text = f"{dict(CONTEXT_SECTIONS)['answers']}: \n{AnswerStore(entries=kept).render()}"
+        if len(kept) < len(entries):
+            text += f"\n({len(entries) - len(kept)} earlier answers left out)"
+        return text, count_tokens(text)
+
+context_builder = ContextBuilder(token_budget=settings.CONTEXT_TOKEN_BUDGET, compact=settings.CONTEXT_COMPACTION)
+
+def build_context(state: GraphState):
+    # Build context from all messages and answers, reusing what was rendered on earlier calls
+    if not state.session_id:
+        return ContextBuilder(token_budget=settings.CONTEXT_TOKEN_BUDGET, compact=settings.CONTEXT_COMPACTION).build(state)
+    return context_builder.build(state)
 
 def value_with_default(value, values, state):
    if value is None or not value.lower() in values:
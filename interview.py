@@ -0,0 +1,179 @@
+from typing import Optional
+from pydantic import BaseModel
+from langchain_core.prompts import ChatPromptTemplate
+from StateTypes import GraphState, Questions
+from answers import AnswerStore
+from prompts import node_prompt
+import logging
+import settings
+
+# incremental: each stage's LLM asks a few questions at a time until it has what it needs.
+# batched: each stage sends its whole questionnaire at once and one LLM call turns the answers into its output.
+INTERVIEW_MODES = ("incremental", "batched")
+
+# The questionnaire of each stage, questions grouped by the output field their answers are recorded in
+RISK_QUESTIONNAIRE = {
+    "location": [
+        "What is your property's postcode and nearest town?",
+    ],
+    "vegetation": [
+        "What vegetation is within 100 metres of your home: dense bush, grassland, scattered trees or cleared ground?",
+        "How far is the nearest bush or grassland from your home, in metres?",
+    ],
+    "topography": [
+        "Is your home on flat ground, on a slope (upslope or downslope of the bush), in a valley or on a ridge?",
+    ],
+    "access": [
+        "How many vehicle routes lead out of your area, and could any of them be blocked by fire or fallen trees?",
+    ],
+    "building": [
+        "What is your home built from, and does it have a Bushfire Attack Level (BAL) rating?",
+    ],
+    "history": [
+        "Have bushfires burnt in or near your area before, and when?",
+    ],
+}
+
+DEFENCE_QUESTIONNAIRE = {
+    "people": [
+        "Who lives in your household, including any children, elderly, disabled people or pets?",
+        "Are the adults who would stay physically fit and able to work hard for several hours in heat and smoke?",
+    ],
+    "equipment": [
+        "What firefighting equipment do you have: a petrol or diesel pump, hoses that reach all sides of the house, sprinklers, protective clothing?",
+    ],
+    "water_supply": [
+        "How much water is set aside for firefighting that does not rely on mains pressure or electricity, in litres?",
+    ],
+    "preparation": [
+        "How well prepared is the property: gutters cleared, grass kept short, fuel cleared from around the house?",
+    ],
+    "experience": [
+        "Has anyone in the household fought a fire or had bushfire training before?",
+    ],
+    "readiness": [
+        "How confident are you that you could stay calm and keep defending your home with fire all around it?",
+    ],
+}
+
+LEAVE_PLAN_QUESTIONNAIRE = {
+    "when_to_leave": [
+        "At what Fire Danger Rating or warning level will you leave (e.g. Extreme, Catastrophic, Watch and Act)?",
+        "What warning signs, such as smoke nearby or embers, will make you leave straight away?",
+    ],
+    "where_to_go": [
+        "Where will you go, with the address and phone number of the place, and is there a second option?",
+    ],
+    "how_to_get_there": [
+        "Which road will you take to get there, and what is your alternative route?",
+        "Which vehicles will you use, and does anyone need help to travel?",
+    ],
+    "what_to_take": [
+        "What will you take: documents, medications, valuables, pet supplies and an emergency kit?",
+    ],
+    "who_to_tell": [
+        "Who will you tell when you leave and when you arrive safely?",
+    ],
+    "backup_plan": [
+        "If you cannot leave in time, where will you shelter?",
+    ],
+}
+
+STAY_PLAN_QUESTIONNAIRE = {
+    "when_to_start": [
+        "At what Fire Danger Rating or warning level will you start defending your home?",
+        "What signs, such as smoke or embers, will tell you to start?",
+    ],
+    "before_the_fire": [
+        "What equipment do you have, and what do you still need to get?",
+        "What will you do to prepare the house and yard before the fire arrives?",
+    ],
+    "during_the_fire": [
+        "What will you do while the fire front passes, and where in the house will you shelter?",
+    ],
+    "after_the_fire": [
+        "What will you check and do once the fire front has passed?",
+    ],
+    "who_can_help": [
+        "Who will be there to help defend the home, and who needs to leave early instead?",
+    ],
+    "peoples_roles": [
+        "What will each person do while defending the home?",
+    ],
+    "backup_plan": [
+        "If the house can no longer be defended, where will you go or shelter?",
+    ],
+}
+
+CONSOLIDATION_INSTRUCTIONS = """
+The user has answered a questionnaire covering every area of this stage in one go, their answers are listed at
+the end of the context under each output field. This is the only call for this stage, so do not ask any further
+questions: leave questions empty. Where an answer is missing, "don't know" or "none", record what Australian
+bushfire guidance recommends for someone in their situation and say that it is a recommendation.
+
+{task}
+"""
+
+def interview_mode(value: Optional[str]) -> str:
+    # Falls back to INTERVIEW_MODE for a session that does not choose a mode or chooses an unknown one
+    if value in INTERVIEW_MODES:
+        return value
+    if value is not None:
+        logging.warning(f"Unknown interview mode {value!r}, using {settings.INTERVIEW_MODE}")
+    return settings.INTERVIEW_MODE
+
+def consolidation_prompt(task: str, parser) -> ChatPromptTemplate:
+    """
+    Builds the prompt of a stage's one LLM call in batched mode, task says which output fields to record.
+    """
+    return node_prompt(CONSOLIDATION_INSTRUCTIONS.format(task=task.strip()), parser)
+
+def questionnaire_questions(questionnaire: dict[str, list[str]], answers: AnswerStore) -> Questions:
+    """
+    Returns the questions of a questionnaire the user has not already answered, each mapped to its output field.
+    """
+    fields = {}
+    for field, questions in questionnaire.items():
+        for question in questions:
+            if answers.find(question) is None and question not in fields:
+                fields[question] = field
+    return Questions(questions=list(fields), fields=fields)
+
+def ask_questionnaire(state: GraphState, section: str, questionnaire: dict[str, list[str]], pending: BaseModel) -> Optional[dict]:
+    """
+    Returns the state update that asks the section's questionnaire, the first time a batched stage runs and while
+    it has unanswered questions. Returns None once it is time for the stage's one LLM call.
+
+    pending is the section's output before the LLM call, the questions are added to it.
+    """
+    if state.interview_mode != "batched" or getattr(state, section) is not None:
+        return None
+    questions = questionnaire_questions(questionnaire, state.answers)
+    if not questions.questions:
+        return None
+    logging.info(f"[{state.session_id}] Asking the {section} questionnaire, {len(questions.questions)} questions")
+    return {section: pending.model_copy(update={"questions": questions})}
+
+def answers_by_field(questionnaire: dict[str, list[str]], answers: AnswerStore) -> str:
+    """
+    Renders the answers to a questionnaire under the output field each one is recorded in, for the LLM call.
+    """
+    lines = []
+    for field, questions in questionnaire.items():
+        lines.append(f"{field}:")
+        for question in questions:
+            answer = answers.find(question)
+            lines.append(f"- {question} {answer.answer if answer else 'No answer'}")
+    return "\n".join(lines)
+
+def consolidation_context(full_context: str, questionnaire: dict[str, list[str]], answers: AnswerStore) -> str:
+    return f"{full_context}\n\nQuestionnaire answers by field:\n{answers_by_field(questionnaire, answers)}"
+
+def consolidated(value: BaseModel) -> BaseModel:
+    """
+    Makes the output of a stage's one LLM call final: no questions are left to ask and a plan is done.
+    """
+    update = {"questions": Questions()}
+    if hasattr(value, "plan_status"):
+        update["plan_status"] = "done"
+    return value.model_copy(update=update)
@@ -1,17 +1,31 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Dict, Any
+from fastapi.responses import JSONResponse, PlainTextResponse
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING
 import uuid
-import json
 import asyncio
-import threading
+import importlib
+import os
+import time
 from dotenv import load_dotenv
-from langchain.chat_models import init_chat_model
-from langchain_core.messages import HumanMessage
-from langgraph.types import Command
-from langgraph.graph import END
-from StateTypes import GraphState
-from workflow import create_graph
+from session_stores import create_session_store
+import metrics
+import settings
+import wire
+
+# langchain, langgraph and the nodes take seconds to import, so they are imported when the worker starts up
+# (see lifespan) after the server is already listening, rather than when this module is imported
+if TYPE_CHECKING:
+    from StateTypes import GraphState
+    from SessionManager import SessionManager
+    from LLMCache import LLMCache
+    from LLMScheduler import LLMScheduler
+    from Speculator import Speculator
+
+HEAVY_MODULES = ["langchain.chat_models", "langchain_openai", "langgraph.types", "langgraph.graph", "workflow",
+                 "checkpointers", "SessionManager", "context_utils", "LLMCache", "ModelRouter", "LLMScheduler",
+                 "Speculator"]
 
 load_dotenv()
 
@@ -25,7 +39,135 @@ logging.getLogger("langgraph").setLevel(logging.DEBUG)
 logging.getLogger("langgraph.pregel").setLevel(logging.DEBUG)
 logging.getLogger("__main__").setLevel(logging.DEBUG)
 
-app = FastAPI(title="Bushfire Plan WebSocket API")
+# The services below are created by each worker process when it starts (see lifespan) rather than on import.
+# Several uvicorn or gunicorn workers then each have their own LLM clients, connections and compiled graph, and
+# share sessions through the session store.
+llm_scheduler: "LLMScheduler" = None
+llm_cache: "LLMCache" = None
+session_manager: "SessionManager" = None
+speculator: "Speculator" = None
+graph = None
+graph_semaphore: asyncio.Semaphore = None
+
+# Set once the graph is compiled and the worker can run sessions, reported by /ready
+ready = asyncio.Event()
+startup: asyncio.Task = None
+
+def create_chat_model(name: str):
+    from langchain.chat_models import init_chat_model
+    from LLMScheduler import ScheduledChatModel
+    return ScheduledChatModel(model=init_chat_model(name, max_retries=0), scheduler=llm_scheduler)
+
+def import_heavy_modules():
+    for name in HEAVY_MODULES:
+        importlib.import_module(name)
+
+def start_worker():
+    global llm_scheduler, llm_cache, session_manager, speculator, graph, graph_semaphore
+    from workflow import create_graph
+    from checkpointers import create_checkpointer
+    from SessionManager import SessionManager
+    from context_utils import context_builder
+    from LLMCache import LLMCache
+    from ModelRouter import ModelRouter
+    from LLMScheduler import LLMScheduler, split_limit
+    from Speculator import Speculator
+
+    # All LLM calls share the provider's rate limits through one scheduler, which also does the retrying.
+    # The limits are split evenly between the workers of every replica.
+    llm_scheduler = LLMScheduler(
+        requests_per_minute=split_limit(settings.LLM_REQUESTS_PER_MINUTE, settings.WORKERS * settings.REPLICAS),
+        tokens_per_minute=split_limit(settings.LLM_TOKENS_PER_MINUTE, settings.WORKERS * settings.REPLICAS),
+        max_in_flight=settings.LLM_MAX_IN_FLIGHT,
+        max_retries=settings.LLM_MAX_RETRIES,
+        backoff_base=settings.LLM_BACKOFF_BASE,
+        backoff_max=settings.LLM_BACKOFF_MAX,
+    )
+
+    # Initialize the chat models, checkpointer and graph
+    # Each node's model is chosen by the router, smaller models for the nodes that gather information
+    model_router = ModelRouter(create_chat_model, settings.LLM_MODEL, settings.LLM_NODE_MODELS, fallback=settings.LLM_FALLBACK)
+    checkpointer = create_checkpointer()
+
+    # Responses are shared across sessions, so near-identical prompts only call the LLM once
+    llm_cache = LLMCache(
+        ttl_seconds=settings.LLM_CACHE_TTL,
+        max_entries=settings.LLM_CACHE_MAX_ENTRIES,
+        db_path=settings.LLM_CACHE_DB_PATH or None,
+        db_max_entries=settings.LLM_CACHE_DB_MAX_ENTRIES,
+    ) if settings.LLM_CACHE else None
+
+    # All per-session state is owned by the session manager so it can be evicted together.
+    # Sessions survive a disconnect, with a session store shared by every worker and replica they can resume
+    # on any of them. Each worker process is a separate owner of sessions.
+    session_manager = SessionManager(
+        checkpointer,
+        ttl_seconds=settings.SESSION_IDLE_TTL,
+        max_sessions=settings.MAX_SESSIONS,
+        sweep_interval=settings.SESSION_SWEEP_INTERVAL,
+        store=create_session_store(),
+        owner=f"{settings.POD_NAME}:{os.getpid()}",
+        resume_timeout=settings.SESSION_RESUME_TIMEOUT,
+    )
+    session_manager.on_evict.append(context_builder.forget)
+
+    metrics.active_sessions.set_function(lambda: len(session_manager.sessions))
+    metrics.outbox_depth.set_function(lambda: sum(outbox.qsize() for outbox in session_manager.outboxes.values()))
+    metrics.inbox_depth.set_function(lambda: sum(inbox.qsize() for inbox in session_manager.inboxes.values()))
+    metrics.llm_queue_depth.set_function(llm_scheduler.waiting)
+    metrics.llm_in_flight.set_function(lambda: llm_scheduler.in_flight)
+
+    # Speculation hands its results to the real node through the LLM cache, so it needs the cache
+    speculator = Speculator(settings.SPECULATIVE_PREFETCH, callbacks=[metrics.metrics_callback]) \
+        if llm_cache and settings.SPECULATIVE_PREFETCH in ("likely", "all") else None
+    if speculator:
+        session_manager.on_evict.append(speculator.cancel)
+
+    graph = create_graph(
+        model_router,
+        session_manager.send,
+        session_manager.user_responses,
+        checkpointer,
+        llm_cache,
+        speculator,
+    )
+
+    # Caps how many sessions can be running graph steps at once in this worker.
+    # The graph runs asynchronously so waiting sessions never block the event loop.
+    graph_semaphore = asyncio.Semaphore(settings.GRAPH_CONCURRENCY)
+
+async def start_up():
+    started = time.perf_counter()
+    try:
+        # Imported in a thread so the event loop keeps answering the health and readiness probes meanwhile
+        await asyncio.to_thread(import_heavy_modules)
+        start_worker()
+        session_manager.start()
+    except Exception:
+        logging.exception("Worker failed to start")
+        raise
+    # With several workers each one publishes its metrics for whichever worker serves /metrics
+    if settings.METRICS_DIR:
+        metrics.registry.share(settings.METRICS_DIR, f"{settings.POD_NAME}:{os.getpid()}")
+
+    startup_seconds = time.perf_counter() - started
+    metrics.startup_seconds.set_function(lambda: startup_seconds)
+    logging.info(f"Worker ready in {startup_seconds:.2f}s")
+    ready.set()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global startup
+    # The server starts listening straight away and the graph is built in the background
+    startup = asyncio.create_task(start_up())
+    yield
+    if not startup.done():
+        startup.cancel()
+    elif startup.exception() is None:
+        await session_manager.stop(settings.SHUTDOWN_GRACE_SECONDS)
+    metrics.registry.unshare()
+
+app = FastAPI(title="Bushfire Plan WebSocket API", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -35,145 +177,278 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global storage for sessions and websockets
-sessions: Dict[str, Dict[str, Any]] = {}
-websockets: Dict[str, WebSocket] = {}
-pending_messages: Dict[str, list] = {}
-user_responses: Dict[str, Dict[str, str]] = {}
-
-# Thread locks for global dictionaries
-sessions_lock = threading.Lock()
-websockets_lock = threading.Lock()
-pending_messages_lock = threading.Lock()
-user_responses_lock = threading.Lock()
+@app.get("/healthz")
+async def health():
+    # A worker that failed to start is reported unhealthy so it gets restarted
+    if startup is not None and startup.done() and not startup.cancelled() and startup.exception():
+        return JSONResponse({"status": "failed", "error": str(startup.exception())}, status_code=500)
+    return {"status": "ok"}
 
-sessions_lock = threading.Lock()
-websockets_lock = threading.Lock()
-pending_messages_lock = threading.Lock()
-user_responses_lock = threading.Lock()
+@app.get("/ready")
+async def readiness():
+    if not ready.is_set():
+        return JSONResponse({"status": "starting"}, status_code=503)
+    return {"status": "ready"}
 
-# Initialize LLM and graph
-llm = init_chat_model("gpt-4o")
+@app.get("/llm-cache/stats")
+async def llm_cache_stats():
+    return llm_cache.stats() if llm_cache else {}
 
-graph = create_graph(llm, pending_messages, user_responses, pending_messages_lock)
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
+    # Connections arriving before the worker is ready wait for it rather than being refused
+    await ready.wait()
     await websocket.accept()
-    session_id = str(uuid.uuid4())
-    websockets[session_id] = websocket
+
+    # The client picks the encoding of the connection's messages with ?encoding=, session_started says which is used
+    encoding = wire.negotiate(websocket.query_params.get("encoding"))
+
+    # A reconnecting client passes the session_id it was given to resume that session
+    session_id = websocket.query_params.get("session_id")
+    values = await session_manager.resume(session_id, websocket, encoding) if session_id else None
+    if values is None:
+        session_id = str(uuid.uuid4())
+        await session_manager.open(session_id, websocket, encoding)
     
     try:
-        await websocket.send_text(json.dumps({
+        session_manager.send(session_id, {
             "type": "session_started",
-            "session_id": session_id
-        }))
+            "session_id": session_id,
+            "resumed": values is not None,
+            "encoding": encoding
+        })
+        if values is not None:
+            await resume_planning_session(session_id, values)
         
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            data = await websocket.receive()
+            if data["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(data.get("code", 1000))
+            # Clients using msgpack may send binary frames
+            message = wire.decode(data["bytes"] if data.get("bytes") is not None else data["text"])
+            session_manager.touch(session_id)
             logging.info(f"[] Received ws message: {message} Type: {message['type']}")
             
             if message["type"] == "start_session":
-                await start_planning_session(session_id, message["motivation"])
+                await start_planning_session(session_id, message["motivation"], message.get("stream_plan", False),
+                                             message.get("interview"))
             elif message["type"] == "user_response":
                 await handle_user_response(session_id, message)
+            elif message["type"] == "resume_session":
+                session_id = await handle_resume_session(session_id, websocket, message, encoding)
                 
     except WebSocketDisconnect:
-        if session_id in websockets:
-            del websockets[session_id]
-        if session_id in sessions:
-            del sessions[session_id]
+        await session_manager.disconnect(session_id, websocket, "websocket disconnected")
 
-async def start_planning_session(session_id: str, motivation: str):
-    logging.info(f"[{session_id}] Starting Planning Session")
-    config = {"configurable": {"thread_id": session_id}}
-    
-    prompt = """You are an expert emergency management consultant specializing in Australian bushfire preparedness. 
-Introduce yourself and explain the bushfire planning process. You will collect essential information about 
-their property, location, household composition, and any specific concerns as the process unfolds.
+async def handle_resume_session(session_id: str, websocket: WebSocket, message: dict, encoding: str = "json") -> str:
+    """
+    Moves the WebSocket from the session it was given to the earlier session it names, returns the session_id
+    the WebSocket now belongs to.
+    """
+    resume_id = message.get("session_id")
+    values = await session_manager.resume(resume_id, websocket, encoding) if resume_id and resume_id != session_id else None
+    if values is None:
+        logging.warning(f"[{session_id}] Unable to resume session {resume_id}")
+        session_manager.send(session_id, {
+            "type": "error",
+            "message": f"Unable to resume session {resume_id}"
+        })
+        return session_id
 
-Do not ask a question more than once.
+    # The session given to the WebSocket when it connected is no longer needed
+    await session_manager.evict(session_id, f"replaced by resumed session {resume_id}", drain=True)
+    session_manager.send(resume_id, {
+        "type": "session_resumed",
+        "session_id": resume_id
+    })
+    await resume_planning_session(resume_id, values)
+    return resume_id
 
-"""
+def session_config(session_id: str) -> dict:
+    # The metrics callback attributes LLM time and tokens to the node that made each call
+    return {"configurable": {"thread_id": session_id}, "callbacks": [metrics.metrics_callback]}
 
-    # Add session_id to state for WebSocket nodes to use
-    initial_state: GraphState = {
-        "messages": [HumanMessage(content=prompt)],
+def initial_graph_state(session_id: str, motivation: str, interview_mode: str) -> "GraphState":
+    # The introduction that used to open the session's messages is now the start of every prompt's static prefix,
+    # see prompts.node_prompt
+    return {
         "user_motivation": motivation,
-        "session_id": session_id
+        "session_id": session_id,
+        "interview_mode": interview_mode
     }
+
+async def start_planning_session(session_id: str, motivation: str, stream_plan: bool = False, interview: str = None):
+    from interview import interview_mode
+
+    logging.info(f"[{session_id}] Starting Planning Session")
+    config = session_config(session_id)
+    # Clients choose between a few questions at a time and whole questionnaires, see interview.py
+    interview = interview_mode(interview)
+    initial_state = initial_graph_state(session_id, motivation, interview)
     
-    sessions[session_id] = {"config": config}
+    # Clients opt in to receiving plan_chunk messages ahead of plan_complete
+    session_manager.update(session_id, config=config, stream_plan=stream_plan)
+    # Whichever replica resumes the session needs these to carry on
+    await session_manager.share(session_id, motivation=motivation, stream_plan=stream_plan, interview=interview)
     
-    # Start the graph execution in background
-    asyncio.create_task(run_graph(session_id, initial_state, config))
+    # Start the session's driver task, it runs the graph until the plan is complete
+    session_manager.start_driver(session_id, drive_session(session_id, initial_state, config))
 
-async def run_graph(session_id: str, initial_state: dict, config: dict):
-    try:
-        if initial_state:
-            logging.info(f"[{session_id}] Initial call to graph")
-            graph.invoke(initial_state, config)
+async def resume_planning_session(session_id: str, values: dict):
+    """
+    Carries on a session resumed by a reconnecting client, possibly one started on another replica.
+    """
+    replayed = await session_manager.replay(session_id)
+    logging.info(f"[{session_id}] Resuming planning session, {replayed} undelivered messages replayed")
+    metrics.sessions_resumed.inc(replica="same" if values["owner"] == session_manager.owner else "other")
+
+    if "motivation" not in values:
+        # The client had not started planning yet
+        return
+
+    config = session_config(session_id)
+    session_manager.update(session_id, config=config, stream_plan=values.get("stream_plan", False))
+    session_manager.start_driver(session_id, drive_session(session_id, None, config, values["motivation"],
+                                                           values.get("interview", settings.INTERVIEW_MODE)))
+
+async def drive_session(session_id: str, initial_state: dict, config: dict, motivation: str = None,
+                        interview_mode: str = None):
+    """
+    Runs the session's graph from one interrupt to the next until the plan is complete.
+
+    After each step the driver waits for the user's response if a message was sent to them, otherwise it resumes
+    straight away. After an error it waits for the next response and then retries from the last checkpoint.
+
+    Without an initial state the driver carries on from the session's last checkpoint, first waiting for the
+    user's response, sending its question again, if the graph had stopped to ask for one.
+    """
+    from langgraph.types import Command
+    from langgraph.graph import END
+    from StateTypes import GraphState
+
+    graph_input = initial_state
+    auto_resumes = 0
+
+    if initial_state is None:
+        current_state = await graph.aget_state(config)
+        if not current_state.values:
+            # No step was checkpointed before the session was detached, so start again
+            graph_input = initial_graph_state(session_id, motivation, interview_mode)
+        elif not current_state.next:
+            return
         else:
-            logging.info(f"[{session_id}] Resuming graph")
-            graph.invoke(Command(resume={}), config)
-        
-        current_state = graph.get_state(config)
-        logging.info(f"[{session_id}] Graph execution complete. Next node: {current_state.next}")
-        logging.debug(f"[{session_id}] Current values keys: {list(current_state.values.keys()) if current_state.values else 'None'}")
-        
-        if not session_id in websockets:
-            logging.warning(f"[{session_id}] No websocket found, ending graph.")
+            graph_input = Command(resume={})
+            if set(current_state.next) & set(graph.interrupt_before_nodes):
+                session_manager.resend_prompt(session_id)
+                await wait_for_user_response(session_id)
+
+    while True:
+        # Stop if the session has been resumed by another replica since the last step
+        if not await session_manager.owns(session_id):
+            session_manager.update(session_id, busy=False)
+            await session_manager.detach(session_id, "resumed by another replica")
             return
 
-        if not current_state.next or current_state.next == END:
-            plan = current_state.values.get('final_plan')
-            if session_id in websockets:
-                if not plan or not plan.get('content') or len(plan.get('content', [])) == 0:
-                    logging.warning(f"[{session_id}] No plan generated.")
-                    await websockets[session_id].send_text(json.dumps({
-                        "type": "plan_complete",
-                        "plan": []
-                    }))
+        messages_sent = session_manager.messages_sent(session_id)
+        try:
+            async with graph_semaphore:
+                session_manager.update(session_id, busy=True)
+                if isinstance(graph_input, Command):
+                    logging.info(f"[{session_id}] Resuming graph")
                 else:
-                    await websockets[session_id].send_text(json.dumps({
-                        "type": "plan_complete",
-                        "plan": plan.get('content', []) if plan else []
-                    }))
-
-        # Send any pending WebSocket messages
-        elif session_id in pending_messages:
-            logging.info(f"[{session_id}] Pending message being sent:")
-            logging.info(f"[{session_id}] {pending_messages[session_id]}")
-            with pending_messages_lock:
-                for message in pending_messages[session_id]:
-                    await websockets[session_id].send_text(json.dumps(message))
-                pending_messages[session_id] = []
-        else:
-            # nothing to do, so continue with workflow
-            asyncio.create_task(run_graph(session_id, None, config))
-        
-    except Exception as e:
-        logging.error(f"[{session_id}] Error in run_graph: {e}")
-        if session_id in websockets:
-            await websockets[session_id].send_text(json.dumps({
+                    logging.info(f"[{session_id}] Initial call to graph")
+
+                # Custom stream events carry the plan chunks written by ShowPlan
+                async for event in graph.astream(graph_input, config, stream_mode="custom"):
+                    send_plan_chunk(session_id, event)
+
+            current_state = await graph.aget_state(config)
+        except Exception as e:
+            logging.error(f"[{session_id}] Error in drive_session: {e}")
+            session_manager.send(session_id, {
                 "type": "error",
                 "message": str(e)
-            }))
+            })
+            current_state = None
+        finally:
+            session_manager.update(session_id, busy=False)
 
-async def handle_user_response(session_id: str, message: dict):
-    logging.debug(f"[{session_id}] handle_user_response: {message}")
+        # The WebSocket closed during the step, which is now checkpointed so the session can resume.
+        # A completed plan is still sent first, so it is recorded for the client to receive when it resumes.
+        finished = current_state is not None and (not current_state.next or current_state.next == END)
+        if (reason := session_manager.detaching(session_id)) and not finished:
+            await session_manager.detach(session_id, reason)
+            return
+
+        session_manager.touch(session_id)
+        graph_input = Command(resume={})
+
+        if current_state is None:
+            await wait_for_user_response(session_id)
+            continue
 
-    if session_id not in sessions:
+        logging.info(f"[{session_id}] Graph execution complete. Next node: {current_state.next}")
+        logging.debug(f"[{session_id}] Current values keys: {list(current_state.values.keys()) if current_state.values else 'None'}")
+
+        if finished:
+            plan = current_state.values.get('final_plan')
+            if not plan or not plan.get('content') or len(plan.get('content', [])) == 0:
+                logging.warning(f"[{session_id}] No plan generated.")
+                session_manager.send(session_id, {
+                    "type": "plan_complete",
+                    "plan": []
+                })
+            else:
+                session_manager.send(session_id, {
+                    "type": "plan_complete",
+                    "plan": plan.get('content', []) if plan else []
+                })
+            if reason := session_manager.detaching(session_id):
+                await session_manager.detach(session_id, reason)
+            return
+
+        if session_manager.messages_sent(session_id) > messages_sent:
+            auto_resumes = 0
+            if speculator:
+                speculator.start(session_id, current_state.next[0], GraphState(**current_state.values))
+            await wait_for_user_response(session_id)
+        else:
+            # nothing was sent to the user to respond to, so continue with workflow
+            auto_resumes += 1
+            if auto_resumes > settings.MAX_AUTO_RESUMES:
+                logging.error(f"[{session_id}] Graph resumed {auto_resumes} times without asking the user anything, stopping")
+                session_manager.send(session_id, {
+                    "type": "error",
+                    "message": "Unable to continue planning session"
+                })
+                return
+
+async def wait_for_user_response(session_id: str):
+    response = await session_manager.wait_for_response(session_id)
+    session_manager.user_responses[session_id] = response
+    if speculator:
+        speculator.resolve(session_id, response)
+
+def send_plan_chunk(session_id: str, event: dict):
+    session = session_manager.get(session_id)
+    if not session or not session.get("stream_plan"):
         return
+    if event.get("content"):
+        session_manager.send(session_id, event)
 
-    with user_responses_lock:
-        user_responses[session_id] = message["answers"]
+async def handle_user_response(session_id: str, message: dict):
+    logging.debug(f"[{session_id}] handle_user_response: {message}")
 
-    # Resume workflow with user_response passed to the next node
-    config = sessions[session_id]["config"]
-    asyncio.create_task(run_graph(session_id, None, config))
+    # The session's driver resumes the workflow once it receives the response
+    if not session_manager.respond(session_id, message["answers"]):
+        logging.warning(f"[{session_id}] No session for user response")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Workers are separate processes that each import the app and start their own services
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=settings.WORKERS,
+                ws_per_message_deflate=settings.WS_PER_MESSAGE_DEFLATE)
@@ -0,0 +1,343 @@
+from collections import defaultdict
+from typing import Any, Callable, Dict, Optional
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+import asyncio
+import json
+import logging
+import os
+import re
+import settings
+import threading
+import time
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Metric:
+    def __init__(self, registry: "MetricsRegistry", name: str, help: str, kind: str):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.kind = kind
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    def __init__(self, registry, name, help):
+        super().__init__(registry, name, help, "counter")
+        self.values: Dict[tuple, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        with self.registry.lock:
+            self.values[tuple(sorted(labels.items()))] += amount
+
+    def value(self, **labels) -> float:
+        return self.values.get(tuple(sorted(labels.items())), 0.0)
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{format_labels(self.registry.constant_labels + labels)} {format_value(value)}"
+                for labels, value in sorted(self.values.items())]
+
+class Gauge(Metric):
+    """
+    A gauge whose value is read from a function each time the metrics are rendered.
+    """
+
+    def __init__(self, registry, name, help):
+        super().__init__(registry, name, help, "gauge")
+        self.function: Optional[Callable[[], float]] = None
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    def render(self) -> list[str]:
+        if self.function is None:
+            return []
+        return [f"{self.name}{format_labels(self.registry.constant_labels)} {format_value(self.function())}"]
+
+class Histogram(Metric):
+    def __init__(self, registry, name, help, buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(registry, name, help, "histogram")
+        self.buckets = buckets + (float("inf"),)
+        # Bucket counts, sum and count for each label set
+        self.values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.registry.lock:
+            entry = self.values.setdefault(key, [[0] * len(self.buckets), 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+
+    def render(self) -> list[str]:
+        lines = []
+        for labels, (counts, total) in sorted(self.values.items()):
+            labels = self.registry.constant_labels + labels
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', format_value(bound)),))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {counts[-1]}")
+        return lines
+
+class MetricsRegistry:
+    """
+    A minimal Prometheus metrics registry, rendered in the text exposition format for the /metrics route.
+
+    When the app runs in several worker processes, /metrics is served by whichever worker takes the request.
+    Each worker then shares its samples, labelled with its name, in a directory the workers have in common, and
+    every worker renders the samples of all of them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics: list[Metric] = []
+        # Labels added to every sample, the worker's name when samples are shared
+        self.constant_labels: tuple = ()
+        self.shared_path: Optional[str] = None
+        self.publisher: Optional[asyncio.Task] = None
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter(self, name, help))
+
+    def gauge(self, name: str, help: str) -> Gauge:
+        return self._register(Gauge(self, name, help))
+
+    def histogram(self, name: str, help: str, buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(self, name, help, buckets))
+
+    def _register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def samples(self) -> Dict[str, list[str]]:
+        with self.lock:
+            return {metric.name: metric.render() for metric in self.metrics}
+
+    def render(self) -> str:
+        samples = self.samples()
+        if self.shared_path:
+            self._publish(samples)
+            for name, lines in self._shared_samples():
+                samples.setdefault(name, []).extend(lines)
+
+        lines = []
+        for metric in self.metrics:
+            lines += metric.header() + samples[metric.name]
+        return "\n".join(lines) + "\n"
+
+    def share(self, directory: str, worker: str, interval: float = 5.0):
+        """
+        Labels this worker's samples with its name and publishes them to directory every interval seconds.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.constant_labels = (("worker", worker),)
+        self.shared_path = os.path.join(directory, re.sub(r"[^A-Za-z0-9_.-]", "_", worker) + ".json")
+        self.stale_seconds = max(60.0, interval * 3)
+        self.publisher = asyncio.create_task(self._publish_loop(interval))
+
+    def unshare(self):
+        if self.publisher:
+            self.publisher.cancel()
+            self.publisher = None
+        if self.shared_path:
+            try:
+                os.remove(self.shared_path)
+            except OSError:
+                pass
+            self.shared_path = None
+
+    async def _publish_loop(self, interval: float):
+        while True:
+            try:
+                self._publish(self.samples())
+            except Exception as e:
+                logging.warning(f"Unable to publish metrics: {e}")
+            await asyncio.sleep(interval)
+
+    def _publish(self, samples: Dict[str, list[str]]):
+        temp_path = f"{self.shared_path}.tmp"
+        with open(temp_path, "w") as file:
+            json.dump(samples, file)
+        os.replace(temp_path, self.shared_path)
+
+    def _shared_samples(self):
+        # Samples published by the other workers, leaving out workers that have stopped publishing
+        directory = os.path.dirname(self.shared_path)
+        cutoff = time.time() - self.stale_seconds
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if not name.endswith(".json") or path == self.shared_path:
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    continue
+                with open(path) as file:
+                    yield from json.load(file).items()
+            except (OSError, ValueError):
+                continue
+
+registry = MetricsRegistry()
+
+node_seconds = registry.histogram("bushfire_node_seconds", "Wall time of each graph node run")
+node_errors = registry.counter("bushfire_node_errors_total", "Graph node runs that raised an exception")
+node_retries = registry.counter("bushfire_node_retries_total", "Graph node runs retried after an error")
+llm_seconds = registry.histogram("bushfire_llm_seconds", "Time spent waiting on the LLM by each graph node")
+llm_calls = registry.counter("bushfire_llm_calls_total", "LLM calls made by each graph node")
+llm_prompt_tokens = registry.counter("bushfire_llm_prompt_tokens_total", "Prompt tokens sent to the LLM by each graph node")
+llm_cached_prompt_tokens = registry.counter("bushfire_llm_cached_prompt_tokens_total", "Prompt tokens the provider served from its prompt cache for each graph node")
+llm_completion_tokens = registry.counter("bushfire_llm_completion_tokens_total", "Completion tokens returned by the LLM to each graph node")
+llm_cost = registry.counter("bushfire_llm_cost_usd_total", "Estimated LLM spend in USD of each graph node")
+parser_seconds = registry.histogram("bushfire_parser_seconds", "Time spent parsing LLM output by each graph node")
+llm_queue_seconds = registry.histogram("bushfire_llm_queue_seconds", "Time LLM calls waited in the scheduler's queue")
+llm_backoffs = registry.counter("bushfire_llm_backoffs_total", "LLM calls retried after backing off, by HTTP status")
+llm_fallbacks = registry.counter("bushfire_llm_fallbacks_total", "Node outputs retried with the default model after the node's own model failed validation")
+speculative_prefetches = registry.counter("bushfire_speculative_prefetch_total", "Speculative LLM calls started during a choice, by whether the user's answer used them")
+sessions_resumed = registry.counter("bushfire_sessions_resumed_total", "Sessions resumed by a reconnecting client, by whether this or another replica ran them last")
+questions_deduplicated = registry.counter("bushfire_questions_deduplicated_total", "Questions from the LLM dropped by each graph node because the user had already answered them")
+stage_budget_exhausted = registry.counter("bushfire_stage_budget_exhausted_total", "Stages forced to a decision because they used up their iteration or token budget, by stage and limit")
+pre_assessments = registry.counter("bushfire_pre_assessments_total", "Risk and defence assessments by whether the local rules decided them or the LLM was called")
+websocket_bytes_sent = registry.counter("bushfire_websocket_bytes_sent_total", "Bytes of WebSocket messages sent before compression, by message encoding")
+context_tokens_saved = registry.counter("bushfire_context_tokens_saved_total", "Prompt context tokens left out, by whether compaction or the token budget left them out")
+structured_output_paths = registry.counter("bushfire_structured_output_total", "Structured LLM outputs by parse path: direct, local_repair, reprompt or failed")
+
+active_sessions = registry.gauge("bushfire_active_sessions", "Sessions held by this worker")
+outbox_depth = registry.gauge("bushfire_websocket_outbox_depth", "Messages waiting in WebSocket outboxes")
+inbox_depth = registry.gauge("bushfire_websocket_inbox_depth", "User responses waiting for their session's graph")
+llm_queue_depth = registry.gauge("bushfire_llm_queue_depth", "LLM calls waiting in the scheduler's queue")
+llm_in_flight = registry.gauge("bushfire_llm_in_flight", "LLM calls running")
+llm_cached_prompt_ratio = registry.gauge("bushfire_llm_cached_prompt_ratio", "Fraction of prompt tokens served from the provider's prompt cache")
+pre_assessment_skip_ratio = registry.gauge("bushfire_pre_assessment_skip_ratio", "Fraction of risk and defence assessments decided by the local rules without an LLM call")
+startup_seconds = registry.gauge("bushfire_startup_seconds", "Seconds the worker took from starting to listen to being ready to run sessions")
+
+def cached_prompt_ratio() -> float:
+    prompt_tokens = sum(llm_prompt_tokens.values.values())
+    return sum(llm_cached_prompt_tokens.values.values()) / prompt_tokens if prompt_tokens else 0.0
+
+llm_cached_prompt_ratio.set_function(cached_prompt_ratio)
+
+def pre_assessment_skipped_ratio() -> float:
+    assessments = sum(pre_assessments.values.values())
+    decided = sum(value for labels, value in pre_assessments.values.items() if ("result", "decided") in labels)
+    return decided / assessments if assessments else 0.0
+
+pre_assessment_skip_ratio.set_function(pre_assessment_skipped_ratio)
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Records LLM time, token usage, parser time and retries against the graph node that made the call.
+
+    LangGraph adds the node name to the metadata of every run inside a node, so passing this handler in the
+    graph's config is enough to attribute each LLM call and parse to its node.
+    """
+
+    # Record inline on the event loop rather than in an executor thread
+    run_inline = True
+
+    def __init__(self):
+        self.runs: Dict[UUID, tuple] = {}
+
+    def _start(self, run_id: UUID, metadata: Optional[dict]):
+        metadata = metadata or {}
+        self.runs[run_id] = (metadata.get("langgraph_node", "unknown"), time.perf_counter(), metadata.get("ls_model_name", "unknown"))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs: Any):
+        self._start(run_id, metadata)
+
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs: Any):
+        self._start(run_id, metadata)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        run = self.runs.pop(run_id, None)
+        if run is None:
+            return
+        node, start, model = run
+        llm_seconds.observe(time.perf_counter() - start, node=node)
+        llm_calls.inc(node=node, model=model)
+
+        usage = None
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or usage
+        if usage:
+            input_cost, output_cost = settings.model_price(model)
+            llm_prompt_tokens.inc(usage.get("input_tokens", 0), node=node, model=model)
+            llm_cached_prompt_tokens.inc((usage.get("input_token_details") or {}).get("cache_read", 0), node=node, model=model)
+            llm_completion_tokens.inc(usage.get("output_tokens", 0), node=node, model=model)
+            llm_cost.inc(
+                usage.get("input_tokens", 0) * input_cost / 1_000_000
+                + usage.get("output_tokens", 0) * output_cost / 1_000_000, node=node, model=model)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        run = self.runs.pop(run_id, None)
+        if run:
+            llm_seconds.observe(time.perf_counter() - run[1], node=run[0])
+
+    def on_chain_start(self, serialized, inputs, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs: Any):
+        if kwargs.get("run_type") == "parser":
+            self.runs[run_id] = ((metadata or {}).get("langgraph_node", "unknown"), time.perf_counter())
+
+    def on_chain_end(self, outputs, *, run_id: UUID, **kwargs: Any):
+        run = self.runs.pop(run_id, None)
+        if run:
+            parser_seconds.observe(time.perf_counter() - run[1], node=run[0])
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self.on_chain_end(None, run_id=run_id)
+
+    def on_retry(self, retry_state, *, run_id: UUID, metadata: Optional[dict] = None, **kwargs: Any):
+        node = self.runs.get(run_id, ((metadata or {}).get("langgraph_node", "unknown"),))[0]
+        node_retries.inc(node=node)
+
+metrics_callback = MetricsCallbackHandler()
+
+class InstrumentedNode:
+    """
+    Wraps a graph node to record its wall time and errors. A node run again for a session after it raised is
+    counted as a retry.
+    """
+
+    def __init__(self, name: str, node):
+        self.name = name
+        self.node = node
+        self.failed_sessions: set[str] = set()
+
+    async def __call__(self, state):
+        # langgraph is imported by the time the graph runs, leaving it out of this module's imports keeps /metrics
+        # available while the worker is starting
+        from langgraph.errors import GraphBubbleUp
+
+        session_id = getattr(state, "session_id", None)
+        if session_id in self.failed_sessions:
+            self.failed_sessions.discard(session_id)
+            node_retries.inc(node=self.name)
+
+        start = time.perf_counter()
+        try:
+            result = self.node(state)
+            if hasattr(result, "__await__"):
+                result = await result
+            return result
+        except GraphBubbleUp:
+            # Interrupts are control flow rather than failures
+            raise
+        except Exception:
+            node_errors.inc(node=self.name)
+            if session_id:
+                self.failed_sessions.add(session_id)
+            raise
+        finally:
+            node_seconds.observe(time.perf_counter() - start, node=self.name)
@@ -0,0 +1,197 @@
+from functools import lru_cache
+from typing import Any, List, Optional, Union
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration, Generation
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from metrics import llm_fallbacks, structured_output_paths
+import json
+import logging
+import re
+import settings
+
+REPAIR_PROMPT = """Your previous response could not be used because it did not match the required format.
+
+Error: {error}
+
+Previous response:
+{output}
+
+{format_instructions}
+
+Respond with the corrected JSON object only."""
+
+def _strip_trailing_comma(out: list):
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ",":
+        out.pop()
+
+def repair_json(text: str) -> str:
+    """
+    Makes a cheap, local attempt at turning malformed LLM output into a JSON object.
+
+    Code fences and text around the object are dropped, trailing commas are removed and a string, object or list
+    left open by a truncated response is closed.
+    """
+    fenced = re.search(r"```(?:json)?\s*(.*?)```", text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1)
+    start = text.find("{")
+    if start == -1:
+        return text
+
+    out, closers = [], []
+    in_string = escaped = False
+    for ch in text[start:]:
+        if in_string:
+            out.append(ch)
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+
+        if ch in "}]":
+            if not closers or ch != closers[-1]:
+                continue
+            _strip_trailing_comma(out)
+            out.append(closers.pop())
+            if not closers:
+                break
+            continue
+
+        if ch == '"':
+            in_string = True
+        elif ch == "{":
+            closers.append("}")
+        elif ch == "[":
+            closers.append("]")
+        out.append(ch)
+
+    if in_string:
+        out.append('"')
+    while closers:
+        _strip_trailing_comma(out)
+        out.append(closers.pop())
+    return "".join(out)
+
+@lru_cache(maxsize=None)
+def format_instructions(pydantic_object: type) -> str:
+    """
+    Returns the format instructions for a pydantic model, built from its JSON schema once per process.
+    """
+    return PydanticOutputParser(pydantic_object=pydantic_object).get_format_instructions()
+
+class RepairingOutputParser(PydanticOutputParser):
+    """
+    A PydanticOutputParser that repairs malformed output rather than failing the session's step.
+
+    Output is validated as is first, then after a local repair with repair_json, and finally by asking the LLM
+    to correct it up to max_repair_prompts times. The path taken is counted in the structured output metric.
+
+    Repair prompts are run with the parser's config, so they are queued under the session and counted against
+    the node like the call that produced the output.
+    """
+
+    llm: Any = None
+    max_repair_prompts: int = settings.OUTPUT_REPAIR_PROMPTS
+
+    def get_format_instructions(self) -> str:
+        # Used by the node prompts and again by every repair prompt
+        return format_instructions(self.pydantic_object)
+
+    def _parse_text(self, text: str) -> tuple[Any, str]:
+        try:
+            return self.pydantic_object.model_validate_json(text), "direct"
+        except ValueError:
+            pass
+        # Raises a ValueError (a JSONDecodeError or ValidationError) when the repair was not enough
+        return self.pydantic_object.model_validate(json.loads(repair_json(text), strict=False)), "local_repair"
+
+    def _repair_prompt(self, text: str, error: Exception) -> str:
+        return REPAIR_PROMPT.format(error=error, output=text, format_instructions=self.get_format_instructions())
+
+    def _failed(self, text: str, error: Exception):
+        structured_output_paths.inc(path="failed")
+        return OutputParserException(
+            f"Unable to parse {self.pydantic_object.__name__} from LLM output: {error}", llm_output=text)
+
+    @staticmethod
+    def _generation(output: Union[str, BaseMessage]) -> Generation:
+        return ChatGeneration(message=output) if isinstance(output, BaseMessage) else Generation(text=output)
+
+    def invoke(self, input: Union[str, BaseMessage], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        return self._call_with_config(
+            lambda output, config: self.parse_result([self._generation(output)], config=config),
+            input, config, run_type="parser")
+
+    async def ainvoke(self, input: Union[str, BaseMessage], config: Optional[RunnableConfig] = None,
+                      **kwargs: Any) -> Any:
+        return await self._acall_with_config(
+            lambda output, config: self.aparse_result([self._generation(output)], config=config),
+            input, config, run_type="parser")
+
+    def parse_result(self, result: List[Generation], *, partial: bool = False,
+                     config: Optional[RunnableConfig] = None) -> Any:
+        text = result[0].text
+        prompts = self.max_repair_prompts if self.llm is not None else 0
+        for attempt in range(prompts + 1):
+            if attempt:
+                logging.info(f"Asking the LLM to repair its {self.pydantic_object.__name__} output: {error}")
+                text = self.llm.invoke(self._repair_prompt(text, error), config).content
+            try:
+                parsed, path = self._parse_text(text)
+            except ValueError as e:
+                error = e
+                continue
+            structured_output_paths.inc(path="reprompt" if attempt else path)
+            return parsed
+        raise self._failed(text, error)
+
+    async def aparse_result(self, result: List[Generation], *, partial: bool = False,
+                            config: Optional[RunnableConfig] = None) -> Any:
+        text = result[0].text
+        prompts = self.max_repair_prompts if self.llm is not None else 0
+        for attempt in range(prompts + 1):
+            if attempt:
+                logging.info(f"Asking the LLM to repair its {self.pydantic_object.__name__} output: {error}")
+                text = (await self.llm.ainvoke(self._repair_prompt(text, error), config)).content
+            try:
+                parsed, path = self._parse_text(text)
+            except ValueError as e:
+                error = e
+                continue
+            structured_output_paths.inc(path="reprompt" if attempt else path)
+            return parsed
+        raise self._failed(text, error)
+
+def json_mode(llm):
+    """
+    Binds the model to JSON mode so it only returns JSON objects, when LLM_JSON_MODE is enabled.
+    """
+    if not settings.LLM_JSON_MODE:
+        return llm
+    return llm.bind(response_format={"type": "json_object"})
+
+def _record_fallback(inputs: dict, config: RunnableConfig) -> dict:
+    llm_fallbacks.inc(node=config.get("metadata", {}).get("langgraph_node", "unknown"))
+    return inputs
+
+def structured_chain(prompt, llm, parser: RepairingOutputParser, fallback_llm=None):
+    """
+    Returns prompt | llm | parser with the model in JSON mode and the parser able to re-prompt it for repairs.
+
+    When fallback_llm is given, output that still fails to parse is generated again with fallback_llm.
+    """
+    llm = json_mode(llm)
+    chain = prompt | llm | parser.model_copy(update={"llm": llm})
+    if fallback_llm is None:
+        return chain
+
+    fallback_llm = json_mode(fallback_llm)
+    fallback = RunnableLambda(_record_fallback) | prompt | fallback_llm | parser.model_copy(update={"llm": fallback_llm})
+    return chain.with_fallbacks([fallback], exceptions_to_handle=(OutputParserException,))
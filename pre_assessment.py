@@ -0,0 +1,161 @@
+from dataclasses import dataclass
+from typing import Optional
+from StateTypes import GraphState, RiskAnalysis, DefenceAnalysis
+import logging
+import metrics
+import re
+import settings
+
+# Words in the few words before a phrase that reverse it, "no bush nearby" is not evidence of nearby bush
+NEGATION = re.compile(r"\b(no|not|without|never|far from|away from|isn't|aren't|don't|doesn't|nothing|used to|no longer)\b[\w\s,'-]{0,20}$")
+# Words later in the same clause that undo a phrase, "the fire pump is broken" is not evidence of a working pump
+QUALIFIER = re.compile(r"^[^.;!?\n]{0,60}?\b(empty|broken|not working|doesn't work|does not work|won't work|out of order|"
+                       r"faulty|needs? (fixing|repair|repairing|replacing)|not (full|connected|filled|reliable|ready|installed)|"
+                       r"unreliable|leak(s|ing|y)?|dry|dried up|low|half full|sold|gone|missing|lost|no longer|used to|"
+                       r"isn't|aren't|wasn't|weren't|don't|doesn't|never|not)\b")
+
+@dataclass
+class Factor:
+    """
+    A factor scored by a pre-assessment. Each pattern found in the user's text is evidence that the factor is at
+    its level, the factor is only scored when all of the evidence agrees.
+    """
+    name: str
+    label: str
+    patterns: list[tuple[str, str]]
+
+@dataclass
+class Rules:
+    """
+    The factors of an assessment and, for the level it is safe to decide without the LLM, how many factors must
+    agree on it (and none disagree). Any other level is always left to the LLM.
+    """
+    factors: list[Factor]
+    decide_at: dict[str, int]
+
+RISK_RULES = Rules(
+    factors=[
+        Factor("vegetation", "Vegetation proximity", [
+            (r"\b(backs? on ?to|adjoins?|adjacent to|next to|borders?|bordering|surrounded by|in the middle of|right on)\b[\w\s]{0,20}\b(national park|state forest|bush|bushland|forest|scrub|reserve|grassland|paddocks?)\b", "high"),
+            (r"\b(dense|thick|heavy|unmanaged) (bush|scrub|forest|vegetation|undergrowth)\b", "high"),
+            (r"\bbush(land)? (block|property|setting)\b", "high"),
+            (r"\b(suburban|urban|inner city|apartment|unit block|cbd|town centre|city centre)\b", "low"),
+            (r"\b(no|without) (bush|trees|scrub|vegetation|grassland) (nearby|near|around|close)\b", "low"),
+            (r"\b(cleared|irrigated|mown|maintained) (land|block|paddocks?|lawns?|gardens?)\b", "low"),
+        ]),
+        Factor("topography", "Topographical exposure", [
+            (r"\b(steep|upslope|ridge ?line|ridge|hill ?top|top of (a|the) hill|gully|gullies|escarpment|valley)\b", "high"),
+            (r"\b(flat|level) (ground|land|block|site|area|terrain)\b", "low"),
+        ]),
+        Factor("access", "Access limitations", [
+            (r"\b(single|one|only one|only) (access )?(road|route|way|track|exit)( in| out| in and out)?\b", "high"),
+            (r"\b(dead[ -]end|cul[ -]de[ -]sac|no through road|long (dirt )?(driveway|track)|dirt track|single[ -]lane)\b", "high"),
+            (r"\b(two|several|multiple|many|three) (access )?(roads|routes|ways|exits)\b", "low"),
+            (r"\b(on|off) (a|the) (main|major|sealed) (road|highway)\b", "low"),
+        ]),
+        Factor("bal", "Bushfire Attack Level", [
+            (r"\b(bal[ -]?(fz|40|29)|flame zone)\b", "high"),
+            (r"\bbal[ -]?(low|12\.5)\b", "low"),
+        ]),
+    ],
+    # Only a high risk is decided, wrongly reassuring someone is the costlier mistake
+    decide_at={"high": 2},
+)
+
+DEFENCE_RULES = Rules(
+    factors=[
+        Factor("water_supply", "Water supply", [
+            (r"\b(\d{2,3},?000|\d{2,3}k) ?(l|litres?|liters?)\b", "high"),
+            (r"\b(water tank|tanks?|dam|swimming pool|pool) (dedicated |set aside |reserved )?(for|to) (fire ?fighting|the fire|fires?)\b", "high"),
+            (r"\b(mains|town) water only\b|\bonly (mains|town) water\b|\bno (water|tank|dam)\b", "low"),
+        ]),
+        Factor("equipment", "Firefighting equipment", [
+            (r"\b(petrol|diesel|fire ?fighting|fire) (powered )?pumps?\b", "high"),
+            (r"\b(roof|gutter|ember) sprinklers?\b|\bprotective (clothing|gear)\b", "high"),
+            (r"\bonly (a )?garden hoses?\b|\bno (fire ?fighting )?(equipment|pump|hoses?|gear)\b|\bjust (a )?garden hoses?\b", "low"),
+        ]),
+        Factor("occupants", "Vulnerable occupants", [
+            (r"\b(bab(y|ies)|toddlers?|infants?|young (children|kids)|small (children|kids)|elderly|frail|disabilit(y|ies)|disabled|wheelchair|mobility (issues|problems|aid)|pregnant|asthma|heart condition|dementia)\b", "low"),
+            (r"\b(fit|able[ -]bodied|healthy) adults?\b|\bno (children|kids|vulnerable|elderly)\b", "high"),
+        ]),
+    ],
+    # Only a low capability is decided, leaving early is the safe outcome and staying to defend is left to the LLM
+    decide_at={"low": 2},
+)
+
+def user_text(state: GraphState) -> str:
+    """
+    The user's own words, their motivation and answers. The questions are left out as they mention the factors
+    whatever the answer.
+    """
+    parts = [state.user_motivation or ""] + [entry.answer for entry in state.answers.entries]
+    return "\n".join(parts).lower()
+
+def score_factor(factor: Factor, text: str) -> tuple[Optional[str], list[str]]:
+    """
+    Returns the factor's level and the phrases it was found from, no level if there is no evidence or it
+    disagrees. A phrase negated before it or qualified after it ("the tank is empty") is not evidence.
+    """
+    levels, evidence = set(), []
+    for pattern, level in factor.patterns:
+        for match in re.finditer(pattern, text):
+            if NEGATION.search(text[max(0, match.start() - 30):match.start()]) or QUALIFIER.search(text[match.end():]):
+                continue
+            levels.add(level)
+            evidence.append(match.group(0))
+    return (levels.pop() if len(levels) == 1 else None), evidence
+
+def pre_assess(rules: Rules, text: str) -> tuple[Optional[str], list[tuple[Factor, str, list[str]]]]:
+    """
+    Scores each factor of the rules from the text and returns the level decided, if any, with the scored factors.
+    """
+    scored = []
+    for factor in rules.factors:
+        level, evidence = score_factor(factor, text)
+        if level:
+            scored.append((factor, level, evidence))
+
+    levels = {level for _, level, _ in scored}
+    if len(levels) == 1:
+        level = levels.pop()
+        if level in rules.decide_at and len(scored) >= rules.decide_at[level]:
+            return level, scored
+    return None, scored
+
+def summary(scored: list[tuple[Factor, str, list[str]]]) -> str:
+    return "\n".join(f"- {factor.label}: {level} ({', '.join(dict.fromkeys(evidence))})" for factor, level, evidence in scored)
+
+def pre_assess_risk(state: GraphState) -> Optional[RiskAnalysis]:
+    """
+    Returns the risk assessment when the user's own words make it clear-cut, otherwise None and the LLM decides.
+    """
+    if not settings.PRE_ASSESSMENT:
+        return None
+    level, scored = pre_assess(RISK_RULES, user_text(state))
+    if level is None:
+        return None
+    return RiskAnalysis(
+        message=f"Your property has a {level} bushfire risk based on what you have told me.",
+        assessment=f"Risk factors assessed from your description:\n{summary(scored)}\nOverall risk rating: {level}",
+        risk_level=level,
+    )
+
+def pre_assess_defence(state: GraphState) -> Optional[DefenceAnalysis]:
+    """
+    Returns the defence assessment when the user's own words make it clear-cut, otherwise None and the LLM decides.
+    """
+    if not settings.PRE_ASSESSMENT:
+        return None
+    level, scored = pre_assess(DEFENCE_RULES, user_text(state))
+    if level is None:
+        return None
+    return DefenceAnalysis(
+        message=f"Your capability to defend your property is {level} based on what you have told me.",
+        assessment=f"Defence factors assessed from your description:\n{summary(scored)}\nOverall capability: {level}",
+        capability_level=level,
+    )
+
+def record_pre_assessment(node: str, decided: bool, session_id: str = None):
+    if decided:
+        logging.info(f"[{session_id}] {node} decided by the pre-assessment rules, LLM call skipped")
+    metrics.pre_assessments.inc(node=node, result="decided" if decided else "llm")
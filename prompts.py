@@ -0,0 +1,32 @@
+from langchain_core.messages import SystemMessage
+from langchain_core.prompts import ChatPromptTemplate
+
+# Opens every prompt. It is the same for every session, so it is part of the static prefix rather than the context.
+SESSION_PREAMBLE = """You are an expert emergency management consultant specializing in Australian bushfire preparedness.
+Introduce yourself and explain the bushfire planning process. You will collect essential information about
+their property, location, household composition, and any specific concerns as the process unfolds.
+
+Do not ask a question more than once."""
+
+def node_prompt(instructions: str, parser=None) -> ChatPromptTemplate:
+    """
+    Builds a node's prompt as a system message that never changes followed by a user message with the context.
+
+    The system message holds the preamble, the node's instructions and the parser's format instructions, so every
+    call made by the node starts with the same prefix and the provider can serve it from its prompt cache. Only
+    the user message differs from one session or step to the next.
+    """
+    parts = [SESSION_PREAMBLE, instructions.strip()]
+    if parser is not None:
+        parts.append(parser.get_format_instructions())
+
+    return ChatPromptTemplate.from_messages([
+        SystemMessage(content="\n\n".join(parts)),
+        ("human", "Context: {full_context}"),
+    ])
+
+def static_prefix(prompt: ChatPromptTemplate) -> str:
+    """
+    Returns the text of the prompt's fixed messages, which identifies the prompt when caching its responses.
+    """
+    return "\n\n".join(message.content for message in prompt.messages if isinstance(message, SystemMessage))
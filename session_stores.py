@@ -0,0 +1,326 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import settings
+
+class MemorySessionStore:
+    """
+    A session store kept in process memory, for a single replica.
+
+    Every store records, for each session, the pod that owns it, a few values needed to resume it and an outbox
+    of the messages sent to it. Messages are numbered in order and delivered in order, so the store only needs
+    to remember the last delivered number; messages after it are pending and replayed when the session resumes.
+    A message is removed from the outbox once it has been delivered.
+    """
+
+    def __init__(self):
+        self.sessions: Dict[str, dict] = {}
+
+    async def register(self, session_id: str, owner: str, **values):
+        self.sessions[session_id] = {"owner": owner, "values": values, "seq": 0, "delivered": 0, "outbox": {},
+                                     "updated_at": time.time()}
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        session = self.sessions.get(session_id)
+        return {"owner": session["owner"], **session["values"]} if session else None
+
+    async def update(self, session_id: str, **values):
+        if session_id in self.sessions:
+            self.sessions[session_id]["values"].update(values)
+            self.sessions[session_id]["updated_at"] = time.time()
+
+    async def claim(self, session_id: str, owner: str, expected: Optional[str] = None) -> bool:
+        """
+        Makes owner the owner of the session, if it exists and, when expected is given, is still owned by expected.
+        """
+        if session_id not in self.sessions or expected not in (None, self.sessions[session_id]["owner"]):
+            return False
+        self.sessions[session_id]["owner"] = owner
+        self.sessions[session_id]["updated_at"] = time.time()
+        return True
+
+    async def owner(self, session_id: str) -> Optional[str]:
+        session = self.sessions.get(session_id)
+        return session["owner"] if session else None
+
+    async def append(self, session_id: str, message: dict) -> int:
+        session = self.sessions.get(session_id)
+        if session is None:
+            return 0
+        session["seq"] += 1
+        session["outbox"][session["seq"]] = message
+        session["updated_at"] = time.time()
+        return session["seq"]
+
+    async def mark_delivered(self, session_id: str, seq: int):
+        session = self.sessions.get(session_id)
+        if session:
+            session["delivered"] = max(session["delivered"], seq)
+            session["outbox"].pop(seq, None)
+
+    async def pending(self, session_id: str) -> List[Tuple[int, dict]]:
+        session = self.sessions.get(session_id)
+        if session is None:
+            return []
+        return [(seq, message) for seq, message in sorted(session["outbox"].items()) if seq > session["delivered"]]
+
+    async def delete(self, session_id: str):
+        self.sessions.pop(session_id, None)
+
+    async def expire(self, max_age: float) -> List[str]:
+        cutoff = time.time() - max_age
+        expired = [session_id for session_id, session in self.sessions.items() if session["updated_at"] < cutoff]
+        for session_id in expired:
+            del self.sessions[session_id]
+        return expired
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    value_json TEXT NOT NULL,
+    seq INTEGER NOT NULL DEFAULT 0,
+    delivered INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbox (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+);
+CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);
+"""
+
+class SqliteSessionStore:
+    """
+    A session store in a SQLite database that every replica can open, such as one on a shared volume.
+    """
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+
+    def _run(self, function, *args):
+        with self.lock:
+            return function(*args)
+
+    async def _call(self, function, *args):
+        return await asyncio.to_thread(self._run, function, *args)
+
+    def _register(self, session_id: str, owner: str, values: dict):
+        self.conn.execute("DELETE FROM outbox WHERE session_id = ?", (session_id,))
+        self.conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, 0, 0, ?)",
+                          (session_id, owner, json.dumps(values), time.time()))
+
+    async def register(self, session_id: str, owner: str, **values):
+        await self._call(self._register, session_id, owner, values)
+
+    def _get(self, session_id: str) -> Optional[dict]:
+        row = self.conn.execute("SELECT owner, value_json FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return {"owner": row[0], **json.loads(row[1])} if row else None
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        return await self._call(self._get, session_id)
+
+    def _update(self, session_id: str, values: dict):
+        row = self.conn.execute("SELECT value_json FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row:
+            self.conn.execute("UPDATE sessions SET value_json = ?, updated_at = ? WHERE session_id = ?",
+                              (json.dumps({**json.loads(row[0]), **values}), time.time(), session_id))
+
+    async def update(self, session_id: str, **values):
+        await self._call(self._update, session_id, values)
+
+    def _claim(self, session_id: str, owner: str, expected: Optional[str]) -> bool:
+        cursor = self.conn.execute("""UPDATE sessions SET owner = ?, updated_at = ?
+            WHERE session_id = ? AND owner = COALESCE(?, owner)""", (owner, time.time(), session_id, expected))
+        return cursor.rowcount > 0
+
+    async def claim(self, session_id: str, owner: str, expected: Optional[str] = None) -> bool:
+        return await self._call(self._claim, session_id, owner, expected)
+
+    async def owner(self, session_id: str) -> Optional[str]:
+        session = await self.get(session_id)
+        return session["owner"] if session else None
+
+    def _append(self, session_id: str, message: dict) -> int:
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.conn.execute("UPDATE sessions SET seq = seq + 1, updated_at = ? WHERE session_id = ? RETURNING seq",
+                                    (time.time(), session_id)).fetchone()
+            if row:
+                self.conn.execute("INSERT INTO outbox VALUES (?, ?, ?)", (session_id, row[0], json.dumps(message)))
+            self.conn.execute("COMMIT")
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        return row[0] if row else 0
+
+    async def append(self, session_id: str, message: dict) -> int:
+        return await self._call(self._append, session_id, message)
+
+    def _mark_delivered(self, session_id: str, seq: int):
+        self.conn.execute("UPDATE sessions SET delivered = MAX(delivered, ?) WHERE session_id = ?", (seq, session_id))
+        self.conn.execute("DELETE FROM outbox WHERE session_id = ? AND seq = ?", (session_id, seq))
+
+    async def mark_delivered(self, session_id: str, seq: int):
+        await self._call(self._mark_delivered, session_id, seq)
+
+    def _pending(self, session_id: str) -> List[Tuple[int, dict]]:
+        rows = self.conn.execute("""SELECT outbox.seq, outbox.message FROM outbox JOIN sessions USING (session_id)
+            WHERE session_id = ? AND outbox.seq > sessions.delivered ORDER BY outbox.seq""", (session_id,)).fetchall()
+        return [(seq, json.loads(message)) for seq, message in rows]
+
+    async def pending(self, session_id: str) -> List[Tuple[int, dict]]:
+        return await self._call(self._pending, session_id)
+
+    def _delete(self, session_id: str):
+        self.conn.execute("DELETE FROM outbox WHERE session_id = ?", (session_id,))
+        self.conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    async def delete(self, session_id: str):
+        await self._call(self._delete, session_id)
+
+    def _expire(self, max_age: float) -> List[str]:
+        cutoff = time.time() - max_age
+        expired = [row[0] for row in self.conn.execute("SELECT session_id FROM sessions WHERE updated_at < ?", (cutoff,))]
+        for session_id in expired:
+            self._delete(session_id)
+        return expired
+
+    async def expire(self, max_age: float) -> List[str]:
+        return await self._call(self._expire, max_age)
+
+class RedisSessionStore:
+    """
+    A session store in Redis (or any Redis-compatible server) shared by every replica.
+
+    Each session is a hash holding its owner and one field per value, a counter for message numbers, a hash of pending
+    messages by number and the last delivered number. Keys expire after ttl_seconds without an update.
+    """
+
+    def __init__(self, url: str, ttl_seconds: int, prefix: str = "bushfire"):
+        try:
+            import redis.asyncio
+        except ImportError as e:
+            raise RuntimeError("SESSION_STORE=redis needs the redis package (pip install redis)") from e
+        self.redis = redis.asyncio.from_url(url, decode_responses=True)
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+
+    def _keys(self, session_id: str) -> Tuple[str, str, str]:
+        base = f"{self.prefix}:session:{session_id}"
+        return base, f"{base}:seq", f"{base}:outbox"
+
+    def _touch(self, pipe, session_id: str):
+        for key in self._keys(session_id):
+            pipe.expire(key, self.ttl_seconds)
+
+    async def register(self, session_id: str, owner: str, **values):
+        session_key, seq_key, outbox_key = self._keys(session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(session_key, seq_key, outbox_key)
+            pipe.hset(session_key, mapping={"owner": owner, "delivered": 0, **self._fields(values)})
+            self._touch(pipe, session_id)
+            await pipe.execute()
+
+    @staticmethod
+    def _fields(values: dict) -> Dict[str, str]:
+        # Each value is a field of its own, so updates to different values do not overwrite each other
+        return {f"value:{name}": json.dumps(value) for name, value in values.items()}
+
+    async def get(self, session_id: str) -> Optional[dict]:
+        session = await self.redis.hgetall(self._keys(session_id)[0])
+        if not session:
+            return None
+        values = {field[len("value:"):]: json.loads(value)
+                  for field, value in session.items() if field.startswith("value:")}
+        return {"owner": session["owner"], **values}
+
+    async def _if_exists(self, session_id: str, check, **fields) -> bool:
+        """
+        Sets fields of the session's hash if it exists and check(session) is true, in a transaction watching the
+        hash so that nothing changes between the check and the write.
+        """
+        session_key = self._keys(session_id)[0]
+
+        async def write(pipe) -> bool:
+            session = await pipe.hgetall(session_key)
+            pipe.multi()
+            if not session or not check(session):
+                return False
+            pipe.hset(session_key, mapping=fields)
+            return True
+
+        return await self.redis.transaction(write, session_key, value_from_callable=True)
+
+    async def update(self, session_id: str, **values):
+        if values:
+            await self._if_exists(session_id, lambda session: True, **self._fields(values))
+
+    async def claim(self, session_id: str, owner: str, expected: Optional[str] = None) -> bool:
+        return await self._if_exists(session_id, lambda session: expected is None or session["owner"] == expected,
+                                     owner=owner)
+
+    async def owner(self, session_id: str) -> Optional[str]:
+        return await self.redis.hget(self._keys(session_id)[0], "owner")
+
+    async def append(self, session_id: str, message: dict) -> int:
+        session_key, seq_key, outbox_key = self._keys(session_id)
+        if not await self.redis.exists(session_key):
+            return 0
+        seq = await self.redis.incr(seq_key)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(outbox_key, seq, json.dumps(message))
+            self._touch(pipe, session_id)
+            await pipe.execute()
+        return seq
+
+    async def mark_delivered(self, session_id: str, seq: int):
+        session_key, _, outbox_key = self._keys(session_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(session_key, "delivered", seq)
+            pipe.hdel(outbox_key, seq)
+            await pipe.execute()
+
+    async def pending(self, session_id: str) -> List[Tuple[int, dict]]:
+        session_key, _, outbox_key = self._keys(session_id)
+        delivered = int(await self.redis.hget(session_key, "delivered") or 0)
+        messages = await self.redis.hgetall(outbox_key)
+        return sorted((int(seq), json.loads(message)) for seq, message in messages.items() if int(seq) > delivered)
+
+    async def delete(self, session_id: str):
+        await self.redis.delete(*self._keys(session_id))
+
+    async def expire(self, max_age: float) -> List[str]:
+        # Keys expire on their own in Redis
+        return []
+
+def create_session_store(kind: str = None):
+    """
+    Creates the session store selected by the SESSION_STORE setting ('memory', 'sqlite' or 'redis').
+    """
+    kind = (kind or settings.SESSION_STORE).lower()
+
+    if kind == "memory":
+        if settings.WORKERS > 1:
+            logging.warning("Using in-memory session store with several workers, sessions only resume on the worker that ran them")
+        return MemorySessionStore()
+
+    if kind == "sqlite":
+        logging.info(f"Using SQLite session store at {settings.SESSION_STORE_DB_PATH}")
+        return SqliteSessionStore(settings.SESSION_STORE_DB_PATH)
+
+    if kind == "redis":
+        logging.info(f"Using Redis session store at {settings.REDIS_URL}")
+        return RedisSessionStore(settings.REDIS_URL, ttl_seconds=settings.SESSION_IDLE_TTL * 2)
+
+    raise ValueError(f"Unknown session store: {kind}")
@@ -0,0 +1,142 @@
+import os
+import socket
+import tempfile
+from dotenv import load_dotenv
+import nodes
+
+load_dotenv()
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+def env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value not in (None, "") else default
+
+def env_mapping(name: str, default: str = "") -> dict[str, str]:
+    # Parses comma separated key=value pairs
+    value = os.getenv(name) or default
+    return dict(pair.split("=", 1) for pair in value.replace(" ", "").split(",") if pair)
+
+# Number of worker processes serving the app (python main.py). Each worker runs its own graph and LLM clients,
+# so sessions are shared through the session store and the LLM rate limits are split between the workers.
+WORKERS = env_int("WORKERS", 1)
+# Number of replicas (pods) of the app sharing the provider's LLM rate limits, which are split between all of
+# their workers. Keep it equal to the deployment's replica count.
+REPLICAS = env_int("REPLICAS", 1)
+# Directory the workers share their metrics through, so /metrics on any worker reports all of them
+METRICS_DIR = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "bushfire-metrics") if WORKERS > 1 else "")
+
+# Maximum number of graph steps (LLM calls) a single worker runs at the same time.
+# Sessions beyond this wait their turn without blocking the WebSocket event loop.
+GRAPH_CONCURRENCY = env_int("GRAPH_CONCURRENCY", 16)
+
+# Checkpointer used to persist graph state between steps: 'sqlite', 'redis' (at REDIS_URL) or 'memory'
+CHECKPOINTER = os.getenv("CHECKPOINTER", "sqlite")
+CHECKPOINT_DB_PATH = os.getenv("CHECKPOINT_DB_PATH", "checkpoints.sqlite")
+# Checkpoint writes are buffered and committed in batches of this size (or after the flush interval)
+CHECKPOINT_BATCH_SIZE = env_int("CHECKPOINT_BATCH_SIZE", 20)
+CHECKPOINT_FLUSH_INTERVAL = env_float("CHECKPOINT_FLUSH_INTERVAL", 1.0)
+# Number of checkpoints kept per session and how long an idle session's checkpoints are kept
+CHECKPOINT_KEEP_LAST = env_int("CHECKPOINT_KEEP_LAST", 3)
+CHECKPOINT_RETENTION_SECONDS = env_int("CHECKPOINT_RETENTION_SECONDS", 86400)
+
+# Sessions idle for longer than this are evicted along with their checkpoints
+SESSION_IDLE_TTL = env_int("SESSION_IDLE_TTL", 1800)
+# Maximum number of sessions kept in one worker, the least recently used is evicted beyond this
+MAX_SESSIONS = env_int("MAX_SESSIONS", 1000)
+SESSION_SWEEP_INTERVAL = env_int("SESSION_SWEEP_INTERVAL", 60)
+
+# Registry and outbox of sessions shared by every replica: 'memory' (one worker only), 'sqlite' or 'redis'.
+# With a shared store a client reconnecting to any replica resumes its session, which also needs a checkpointer
+# every replica can read, such as a CHECKPOINT_DB_PATH on a shared volume.
+SESSION_STORE = os.getenv("SESSION_STORE", "memory" if WORKERS == 1 else "sqlite")
+SESSION_STORE_DB_PATH = os.getenv("SESSION_STORE_DB_PATH", "sessions.sqlite")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Seconds a replica resuming a session waits for the replica running it to finish its step and let it go
+SESSION_RESUME_TIMEOUT = env_float("SESSION_RESUME_TIMEOUT", 30.0)
+# Name recorded as the owner of the sessions this replica is running
+POD_NAME = os.getenv("POD_NAME") or socket.gethostname()
+
+# Leave consumed questions and answers out of the prompt context and keep it within a token budget (0 for no budget)
+CONTEXT_COMPACTION = os.getenv("CONTEXT_COMPACTION", "true").lower() == "true"
+CONTEXT_TOKEN_BUDGET = env_int("CONTEXT_TOKEN_BUDGET", 6000)
+
+# Each session keeps the answers it was given in one store, at most this many
+ANSWER_STORE_MAX_ENTRIES = env_int("ANSWER_STORE_MAX_ENTRIES", 200)
+
+# Cache of LLM responses keyed on model, prompt template and normalised context
+LLM_CACHE = os.getenv("LLM_CACHE", "true").lower() == "true"
+LLM_CACHE_TTL = env_int("LLM_CACHE_TTL", 86400)
+LLM_CACHE_MAX_ENTRIES = env_int("LLM_CACHE_MAX_ENTRIES", 1000)
+# Optional SQLite tier for the cache, disabled when no path is given
+LLM_CACHE_DB_PATH = os.getenv("LLM_CACHE_DB_PATH", "")
+LLM_CACHE_DB_MAX_ENTRIES = env_int("LLM_CACHE_DB_MAX_ENTRIES", 10000)
+# Price of the LLM in USD per million tokens, used to estimate the savings made by the cache
+LLM_INPUT_COST_PER_MTOK = env_float("LLM_INPUT_COST_PER_MTOK", 2.50)
+LLM_OUTPUT_COST_PER_MTOK = env_float("LLM_OUTPUT_COST_PER_MTOK", 10.00)
+
+# Chat models: the final plan uses LLM_MODEL, the nodes that gather information run many times per session and use
+# LLM_SMALL_MODEL. LLM_NODE_MODELS overrides the model of any node as NODE=model pairs, e.g. "ASSESS_RISK_NODE=gpt-4o"
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o")
+LLM_SMALL_MODEL = os.getenv("LLM_SMALL_MODEL", "gpt-4o-mini")
+LLM_NODE_MODELS = {
+    **{node: LLM_SMALL_MODEL for node in (
+        nodes.ASSESS_RISK_NODE, nodes.ASSESS_DEFENCE_NODE, nodes.CREATE_LEAVE_PLAN_NODE, nodes.CREATE_STAY_PLAN_NODE)},
+    **env_mapping("LLM_NODE_MODELS"),
+}
+# Retry a node with LLM_MODEL when the output of its smaller model fails validation
+LLM_FALLBACK = os.getenv("LLM_FALLBACK", "true").lower() == "true"
+# Price of each model in USD per million prompt/completion tokens, other models use the LLM_*_COST_PER_MTOK prices
+LLM_MODEL_PRICES = env_mapping("LLM_MODEL_PRICES", "gpt-4o=2.50/10.00,gpt-4o-mini=0.15/0.60")
+
+def model_price(model: str) -> tuple[float, float]:
+    if model in LLM_MODEL_PRICES:
+        input_cost, output_cost = LLM_MODEL_PRICES[model].split("/")
+        return float(input_cost), float(output_cost)
+    return LLM_INPUT_COST_PER_MTOK, LLM_OUTPUT_COST_PER_MTOK
+
+# Limits of the provider's account (0 for no limit), each worker of each replica gets an even share. Calls wait in a
+# queue that is fair across sessions.
+# Calls failing with a rate limit or server error are retried up to LLM_MAX_RETRIES times with jittered backoff.
+LLM_REQUESTS_PER_MINUTE = env_int("LLM_REQUESTS_PER_MINUTE", 500)
+LLM_TOKENS_PER_MINUTE = env_int("LLM_TOKENS_PER_MINUTE", 200000)
+LLM_MAX_IN_FLIGHT = env_int("LLM_MAX_IN_FLIGHT", 32)
+LLM_MAX_RETRIES = env_int("LLM_MAX_RETRIES", 5)
+LLM_BACKOFF_BASE = env_float("LLM_BACKOFF_BASE", 0.5)
+LLM_BACKOFF_MAX = env_float("LLM_BACKOFF_MAX", 30.0)
+
+# Ask the LLM for JSON objects only (OpenAI-compatible response_format) and how many times it may be asked to
+# repair output that still fails to parse
+LLM_JSON_MODE = os.getenv("LLM_JSON_MODE", "true").lower() == "true"
+OUTPUT_REPAIR_PROMPTS = env_int("OUTPUT_REPAIR_PROMPTS", 1)
+
+# Start the LLM call that follows a choice while the user is making it: 'off', 'likely' (the predicted answer only)
+# or 'all' (every answer). Needs LLM_CACHE, which is how the real call picks up the speculative one.
+SPECULATIVE_PREFETCH = os.getenv("SPECULATIVE_PREFETCH", "off").lower()
+
+# Decide clear-cut high risks and low defence capabilities from the user's own words with local rules, skipping the
+# LLM call. Off until the rules have been checked against more real answers.
+PRE_ASSESSMENT = os.getenv("PRE_ASSESSMENT", "false").lower() == "true"
+
+# How sessions that do not choose an interview mode are interviewed: "incremental" (a few questions per LLM call)
+# or "batched" (each stage's whole questionnaire at once, then one LLM call)
+INTERVIEW_MODE = os.getenv("INTERVIEW_MODE", "incremental").lower()
+
+# Budget of each assessment and plan stage (0 for no limit). Once a stage has made STAGE_MAX_ITERATIONS LLM calls or
+# used STAGE_TOKEN_BUDGET tokens it stops asking questions and moves on as undetermined or done. STAGE_BUDGETS
+# overrides the budget of any stage as stage=iterations/tokens pairs, e.g. "risk_assessment=4/40000"
+STAGE_MAX_ITERATIONS = env_int("STAGE_MAX_ITERATIONS", 6)
+STAGE_TOKEN_BUDGET = env_int("STAGE_TOKEN_BUDGET", 60000)
+STAGE_BUDGETS = env_mapping("STAGE_BUDGETS")
+
+# Maximum number of times in a row a session's graph is resumed without asking the user anything
+MAX_AUTO_RESUMES = env_int("MAX_AUTO_RESUMES", 25)
+# Encoding of WebSocket messages for clients that do not ask for one: json, compact or msgpack (see wire.py)
+WS_ENCODING = os.getenv("WS_ENCODING", "json").lower()
+# Compress WebSocket messages with permessage-deflate when the client offers it
+WS_PER_MESSAGE_DEFLATE = os.getenv("WS_PER_MESSAGE_DEFLATE", "true").lower() == "true"
+
+# Seconds sessions are given to finish the graph step they are running when the server shuts down
+SHUTDOWN_GRACE_SECONDS = env_float("SHUTDOWN_GRACE_SECONDS", 10.0)
@@ -0,0 +1,18 @@
+from LLMScheduler import LLMScheduler, TokenBucket, split_limit
+
+def test_a_limit_smaller_than_the_number_of_workers_still_limits_each_worker():
+    # 20 requests a minute shared by 8 workers in each of 3 replicas
+    requests_per_minute = split_limit(20, 8 * 3)
+    assert requests_per_minute > 0
+    assert abs(requests_per_minute * 8 * 3 - 20) < 1e-9
+
+    scheduler = LLMScheduler(requests_per_minute=requests_per_minute, tokens_per_minute=split_limit(1000, 8 * 3),
+                             max_in_flight=4)
+    scheduler.requests.consume(1)
+    assert scheduler.requests.wait_time(1) > 60
+
+def test_no_limit_stays_unlimited():
+    assert split_limit(0, 8 * 3) == 0
+    bucket = TokenBucket(split_limit(0, 8 * 3))
+    bucket.consume(1000)
+    assert bucket.wait_time(1000) == 0.0
@@ -0,0 +1,66 @@
+import asyncio
+from typing import List
+
+import pytest
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.prompts import PromptTemplate
+from pydantic import BaseModel
+
+from output_parsing import RepairingOutputParser, structured_chain
+
+class Answer(BaseModel):
+    level: str
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Returns the scripted responses in turn and records the metadata of the run making each call.
+    """
+
+    responses: List[str]
+    calls: List[dict] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def _respond(self, run_manager) -> ChatResult:
+        self.calls.append(dict(run_manager.metadata))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.responses[len(self.calls) - 1]))])
+
+    def _generate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return self._respond(run_manager)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        return self._respond(run_manager)
+
+CONFIG = {"configurable": {"thread_id": "session-1"},
+          "metadata": {"thread_id": "session-1", "langgraph_node": "assess_risk"}}
+
+@pytest.mark.parametrize("run_async", [False, True])
+def test_repair_prompt_is_attributed_to_the_session_and_node(run_async):
+    llm = ScriptedChatModel(responses=["the risk is high", '{"level": "high"}'])
+    chain = structured_chain(PromptTemplate.from_template("{question}"), llm,
+                             RepairingOutputParser(pydantic_object=Answer, max_repair_prompts=1))
+
+    if run_async:
+        answer = asyncio.run(chain.ainvoke({"question": "risk?"}, CONFIG))
+    else:
+        answer = chain.invoke({"question": "risk?"}, CONFIG)
+
+    assert answer == Answer(level="high")
+    assert len(llm.calls) == 2
+    for metadata in llm.calls:
+        assert metadata["thread_id"] == "session-1"
+        assert metadata["langgraph_node"] == "assess_risk"
+
+def test_repair_prompt_is_run_with_the_given_config():
+    llm = ScriptedChatModel(responses=['{"level": "low"}'])
+    parser = RepairingOutputParser(pydantic_object=Answer, llm=llm, max_repair_prompts=1)
+
+    answer = asyncio.run(parser.aparse_result([ChatGeneration(message=AIMessage(content="low"))], config=CONFIG))
+
+    assert answer == Answer(level="low")
+    assert llm.calls[0]["thread_id"] == "session-1"
+    assert llm.calls[0]["langgraph_node"] == "assess_risk"
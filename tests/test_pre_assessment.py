@@ -0,0 +1,54 @@
+import pytest
+from StateTypes import GraphState
+from answers import AnswerStore
+from pre_assessment import DEFENCE_RULES, RISK_RULES, pre_assess, pre_assess_defence, pre_assess_risk
+import settings
+
+@pytest.fixture(autouse=True)
+def pre_assessment_on(monkeypatch):
+    monkeypatch.setattr(settings, "PRE_ASSESSMENT", True)
+
+def state(motivation: str, **answers) -> GraphState:
+    return GraphState(session_id="test", user_motivation=motivation, answers=AnswerStore.of("defence_assessment", answers))
+
+@pytest.mark.parametrize("text", [
+    "we are two fit adults. our 20,000 litre tank is empty this summer and the fire pump is broken.",
+    "we have a petrol pump but it is not working, and roof sprinklers that need fixing. we are able-bodied adults.",
+    "there is a 10,000 litre tank for firefighting, it has been dry since march. the fire pump was sold. two healthy adults.",
+    "we used to have a diesel pump. we no longer have roof sprinklers. fit adults, no kids.",
+])
+def test_equipment_that_does_not_work_is_not_evidence_for_staying(text):
+    level, scored = pre_assess(DEFENCE_RULES, text)
+    assert level is None
+    assert all(factor.name not in ("water_supply", "equipment") for factor, _, _ in scored)
+
+def test_high_defence_capability_is_left_to_the_llm():
+    text = ("we have a 22,000 litre tank for firefighting, a petrol pump, roof sprinklers, protective clothing "
+            "and two fit adults.")
+    level, scored = pre_assess(DEFENCE_RULES, text)
+    assert level is None
+    assert {level for _, level, _ in scored} == {"high"}
+    assert pre_assess_defence(state(text)) is None
+
+def test_low_risk_is_left_to_the_llm():
+    text = "we live in a suburban house on flat ground with several routes out, bal-low."
+    assert pre_assess(RISK_RULES, text)[0] is None
+    assert pre_assess_risk(state(text)) is None
+
+def test_low_defence_capability_is_decided():
+    decided = pre_assess_defence(state("We have a baby and only a garden hose.", water="Only mains water."))
+    assert decided is not None and decided.capability_level == "low"
+
+def test_high_risk_is_decided():
+    decided = pre_assess_risk(state("Our house backs onto the national park on a steep ridge with a single access road."))
+    assert decided is not None and decided.risk_level == "high"
+
+def test_answer_qualifying_the_motivation_stops_a_decision():
+    # The motivation alone would be a clear-cut low capability, the answers contradict it
+    decided = pre_assess_defence(state("We have a baby and only a garden hose.",
+                                       equipment="We also have a diesel pump and roof sprinklers."))
+    assert decided is None
+
+def test_pre_assessment_off_by_default_setting(monkeypatch):
+    monkeypatch.setattr(settings, "PRE_ASSESSMENT", False)
+    assert pre_assess_risk(state("Our house backs onto the national park on a steep ridge with a single access road.")) is None
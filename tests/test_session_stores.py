@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+from session_stores import MemorySessionStore, RedisSessionStore, SqliteSessionStore
+
+def redis_store() -> RedisSessionStore:
+    fakeredis = pytest.importorskip("fakeredis")
+    store = RedisSessionStore("redis://localhost", ttl_seconds=60)
+    store.redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+    return store
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemorySessionStore()
+    if request.param == "sqlite":
+        return SqliteSessionStore(str(tmp_path / "sessions.sqlite"))
+    return redis_store()
+
+def test_values_round_trip(store):
+    async def run():
+        await store.register("s1", "pod-a", attached=True, last_prompt={"seq": 3, "message": {"type": "question"}})
+        await store.update("s1", attached=False)
+        assert await store.get("s1") == {"owner": "pod-a", "attached": False,
+                                         "last_prompt": {"seq": 3, "message": {"type": "question"}}}
+        assert await store.get("missing") is None
+
+    asyncio.run(run())
+
+def test_update_does_not_create_a_session(store):
+    async def run():
+        await store.update("missing", attached=True)
+        assert await store.get("missing") is None
+
+    asyncio.run(run())
+
+def test_concurrent_updates_are_all_kept(store):
+    async def run():
+        await store.register("s1", "pod-a")
+        await asyncio.gather(*(store.update("s1", **{f"value{i}": i}) for i in range(20)))
+        values = await store.get("s1")
+        assert all(values[f"value{i}"] == i for i in range(20))
+
+    asyncio.run(run())
+
+def test_claim_checks_the_expected_owner(store):
+    async def run():
+        assert not await store.claim("missing", "pod-b")
+        await store.register("s1", "pod-a")
+        assert not await store.claim("s1", "pod-b", expected="pod-c")
+        assert await store.owner("s1") == "pod-a"
+        assert await store.claim("s1", "pod-b", expected="pod-a")
+        assert await store.owner("s1") == "pod-b"
+
+    asyncio.run(run())
+
+def test_only_one_concurrent_claim_wins(store):
+    async def run():
+        await store.register("s1", "pod-a")
+        claimed = await asyncio.gather(*(store.claim("s1", f"pod-{i}", expected="pod-a") for i in range(10)))
+        assert claimed.count(True) == 1
+        assert await store.owner("s1") == f"pod-{claimed.index(True)}"
+
+    asyncio.run(run())
@@ -0,0 +1,43 @@
+import asyncio
+import json
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+
+from AssessDefence import AssessDefence
+from CreateLeavePlan import CreateLeavePlan
+from StateTypes import GraphState
+from interview import LEAVE_PLAN_QUESTIONNAIRE
+import settings
+
+LEAVE_PLAN = {"plan_status": "more", "questions": {"questions": ["Where will you go?"]}, "when_to_leave": "Extreme",
+              "where_to_go": None, "how_to_get_there": None, "what_to_take": None, "who_to_tell": None,
+              "backup_plan": None}
+
+def test_incremental_call_records_the_output_and_the_stage_usage():
+    node = CreateLeavePlan(FakeListChatModel(responses=[json.dumps(LEAVE_PLAN)]))
+
+    update = asyncio.run(node(GraphState(session_id="test", user_motivation="we plan to leave")))
+
+    assert update["leave_plan"].when_to_leave == "Extreme"
+    assert update["questions"].questions == ["Where will you go?"]
+    assert update["stage_usage"]["leave_plan"].iterations == 1
+
+def test_batched_stage_sends_its_questionnaire_before_calling_the_llm():
+    node = CreateLeavePlan(FakeListChatModel(responses=[]))
+
+    update = asyncio.run(node(GraphState(session_id="test", user_motivation="we plan to leave", interview_mode="batched")))
+
+    questions = update["leave_plan"].questions.questions
+    assert questions == [question for field in LEAVE_PLAN_QUESTIONNAIRE.values() for question in field]
+    assert "stage_usage" not in update
+
+def test_pre_assessed_stage_does_not_call_the_llm(monkeypatch):
+    monkeypatch.setattr(settings, "PRE_ASSESSMENT", True)
+    node = AssessDefence(FakeListChatModel(responses=[]))
+    state = GraphState(session_id="test", user_motivation="We have a baby and only a garden hose.")
+
+    assert node.decided_without_llm(state)
+    update = asyncio.run(node(state))
+
+    assert update["defence_assessment"].capability_level == "low"
+    assert "stage_usage" not in update
@@ -0,0 +1,37 @@
+import pytest
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langgraph.checkpoint.memory import MemorySaver
+from langgraph.graph import StateGraph
+
+from LLMCache import CachedChain, LLMCache
+import nodes
+from workflow import create_graph
+
+def build_graph(llm_cache=None):
+    return create_graph(FakeListChatModel(responses=["{}"]), send_message=None, user_responses={},
+                        checkpointer=MemorySaver(), llm_cache=llm_cache)
+
+def test_defence_answers_go_back_to_the_defence_assessment():
+    # Without this edge the run ended after the defence answers and the session never got a plan
+    edges = build_graph().builder.edges
+    assert (nodes.GET_DEFENCE_ANSWERS_NODE, nodes.ASSESS_DEFENCE_NODE) in edges
+    assert (nodes.GET_RISK_ANSWERS_NODE, nodes.ASSESS_RISK_NODE) in edges
+
+def test_a_node_without_an_outgoing_edge_is_rejected(monkeypatch):
+    add_edge = StateGraph.add_edge
+
+    def without_defence_answers_edge(self, start, end):
+        if start != nodes.GET_DEFENCE_ANSWERS_NODE:
+            return add_edge(self, start, end)
+        return self
+
+    monkeypatch.setattr(StateGraph, "add_edge", without_defence_answers_edge)
+    with pytest.raises(ValueError, match=nodes.GET_DEFENCE_ANSWERS_NODE):
+        build_graph()
+
+def test_the_dated_final_plan_is_not_cached():
+    graph = build_graph(LLMCache(ttl_seconds=60, max_entries=10))
+    node = lambda name: graph.builder.nodes[name].runnable.afunc.node
+
+    assert isinstance(node(nodes.ASSESS_RISK_NODE).llm_chain, CachedChain)
+    assert not isinstance(node(nodes.SHOW_PLAN_NODE).llm_chain, CachedChain)
@@ -0,0 +1,61 @@
+from typing import Optional, Union
+import json
+import logging
+import settings
+
+# json: the original messages as JSON text frames.
+# compact: orjson text frames without null fields and with the plan as one string rather than a list of lines.
+# msgpack: the compact messages as MessagePack binary frames.
+ENCODINGS = ("json", "compact", "msgpack")
+
+def supported(encoding: str) -> bool:
+    try:
+        if encoding == "compact":
+            import orjson
+        elif encoding == "msgpack":
+            import ormsgpack
+    except ImportError:
+        return False
+    return encoding in ENCODINGS
+
+def negotiate(requested: Optional[str]) -> str:
+    """
+    Returns the encoding of a new connection, the one the client asked for if this worker supports it, otherwise
+    WS_ENCODING or json.
+    """
+    for encoding in (requested, settings.WS_ENCODING):
+        if encoding and supported(encoding.lower()):
+            return encoding.lower()
+        if encoding:
+            logging.warning(f"Unsupported message encoding {encoding!r}")
+    return "json"
+
+def compact(message: dict) -> dict:
+    message = {key: value for key, value in message.items() if value is not None}
+    # The plan is one HTML document, a single string is smaller than a list of its lines in either encoding
+    if message.get("type") == "plan_complete" and isinstance(message.get("plan"), list):
+        message["plan"] = "\n".join(message["plan"])
+    return message
+
+def encode(message: dict, encoding: str) -> Union[str, bytes]:
+    """
+    Encodes a message for the WebSocket, bytes are sent as a binary frame and str as a text frame.
+
+    session_started is always JSON text, it tells the client which encoding the rest of the messages use.
+    """
+    if encoding == "json" or message.get("type") == "session_started":
+        return json.dumps(message)
+    if encoding == "compact":
+        import orjson
+        return orjson.dumps(compact(message)).decode()
+    import ormsgpack
+    return ormsgpack.packb(compact(message))
+
+def decode(data: Union[str, bytes]) -> dict:
+    """
+    Decodes a message from the client, JSON from a text frame or MessagePack from a binary frame.
+    """
+    if isinstance(data, bytes):
+        import ormsgpack
+        return ormsgpack.unpackb(data)
+    return json.loads(data)
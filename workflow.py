@@ -1,7 +1,7 @@
 from langgraph.graph import StateGraph, START, END
-from langgraph.checkpoint.memory import MemorySaver
 from StateTypes import GraphState
 import nodes
+from checkpointers import create_checkpointer
 from context_utils import value_with_default, value_with_default_and_questions
 from AssessRisk import AssessRisk
 from AssessDefence import AssessDefence
@@ -10,32 +10,58 @@ from CreateStayPlan import CreateStayPlan
 from ShowPlan import ShowPlan
 from Questions import WebSocketQuestions, WebSocketAnswers
 from Choice import WebSocketChoice, WebSocketSelection
+from metrics import InstrumentedNode
+from ModelRouter import ModelRouter
+from budgets import budgeted
+
+def add_node(graph_builder: StateGraph, name: str, node):
+    # Every node is timed and its errors counted for the /metrics route
+    graph_builder.add_node(name, InstrumentedNode(name, node))
+    return node
+
+def create_graph(llm, send_message, user_responses, checkpointer=None, llm_cache=None, speculator=None):
+    # llm is either a ModelRouter choosing each node's model or a single chat model used by every node
+    router = llm if isinstance(llm, ModelRouter) else ModelRouter.single(llm)
 
-def create_graph(llm, pending_messages, user_responses, pending_messages_lock):
     graph_builder = StateGraph(GraphState)
-    graph_builder.add_node(nodes.ASSESS_RISK_NODE, AssessRisk(llm))
-    graph_builder.add_node(nodes.ASK_RISK_QUESTIONS_NODE, WebSocketQuestions("risk_assessment", pending_messages, pending_messages_lock))
-    graph_builder.add_node(nodes.GET_RISK_ANSWERS_NODE, WebSocketAnswers("risk_assessment", user_responses))
+    add_node(graph_builder, nodes.ASSESS_RISK_NODE, AssessRisk(router.model(nodes.ASSESS_RISK_NODE), llm_cache, router.fallback(nodes.ASSESS_RISK_NODE)))
+    add_node(graph_builder, nodes.ASK_RISK_QUESTIONS_NODE, WebSocketQuestions("risk_assessment", send_message))
+    add_node(graph_builder, nodes.GET_RISK_ANSWERS_NODE, WebSocketAnswers("risk_assessment", user_responses))
 
-    graph_builder.add_node(nodes.ASK_CONTINUE_WITH_PLAN_NODE, WebSocketChoice("continue_with_plan", "risk_assessment", "Continue with plan?", ["yes","no"], pending_messages, pending_messages_lock))
-    graph_builder.add_node(nodes.GET_CONTINUE_WITH_PLAN_NODE, WebSocketSelection("continue_with_plan", user_responses))
+    add_node(graph_builder, nodes.ASK_CONTINUE_WITH_PLAN_NODE, WebSocketChoice("continue_with_plan", "risk_assessment", "Continue with plan?", ["yes","no"], send_message))
+    continue_selection = add_node(graph_builder, nodes.GET_CONTINUE_WITH_PLAN_NODE, WebSocketSelection("continue_with_plan", user_responses))
     
-    graph_builder.add_node(nodes.ASSESS_DEFENCE_NODE, AssessDefence(llm))
-    graph_builder.add_node(nodes.ASK_DEFENCE_QUESTIONS_NODE, WebSocketQuestions("defence_assessment", pending_messages, pending_messages_lock))
-    graph_builder.add_node(nodes.GET_DEFENCE_ANSWERS_NODE, WebSocketAnswers("defence_assessment", user_responses))
+    assess_defence = add_node(graph_builder, nodes.ASSESS_DEFENCE_NODE, AssessDefence(router.model(nodes.ASSESS_DEFENCE_NODE), llm_cache, router.fallback(nodes.ASSESS_DEFENCE_NODE)))
+    add_node(graph_builder, nodes.ASK_DEFENCE_QUESTIONS_NODE, WebSocketQuestions("defence_assessment", send_message))
+    add_node(graph_builder, nodes.GET_DEFENCE_ANSWERS_NODE, WebSocketAnswers("defence_assessment", user_responses))
 
-    graph_builder.add_node(nodes.ASK_STRATEGY_NODE, WebSocketChoice("stay_or_leave_plan", "defence_assessment", "Do you want to create a leave early or stay and defend plan?", ["leave", "stay"], pending_messages, pending_messages_lock))
-    graph_builder.add_node(nodes.GET_STRATEGY_NODE, WebSocketSelection("stay_or_leave_plan", user_responses))
+    add_node(graph_builder, nodes.ASK_STRATEGY_NODE, WebSocketChoice("stay_or_leave_plan", "defence_assessment", "Do you want to create a leave early or stay and defend plan?", ["leave", "stay"], send_message))
+    strategy_selection = add_node(graph_builder, nodes.GET_STRATEGY_NODE, WebSocketSelection("stay_or_leave_plan", user_responses))
     
-    graph_builder.add_node(nodes.CREATE_LEAVE_PLAN_NODE, CreateLeavePlan(llm))
-    graph_builder.add_node(nodes.ASK_LEAVE_PLAN_QUESTIONS_NODE, WebSocketQuestions("leave_plan", pending_messages, pending_messages_lock))
-    graph_builder.add_node(nodes.GET_LEAVE_PLAN_ANSWERS_NODE, WebSocketAnswers("leave_plan", user_responses))
+    create_leave_plan = add_node(graph_builder, nodes.CREATE_LEAVE_PLAN_NODE, CreateLeavePlan(router.model(nodes.CREATE_LEAVE_PLAN_NODE), llm_cache, router.fallback(nodes.CREATE_LEAVE_PLAN_NODE)))
+    add_node(graph_builder, nodes.ASK_LEAVE_PLAN_QUESTIONS_NODE, WebSocketQuestions("leave_plan", send_message))
+    add_node(graph_builder, nodes.GET_LEAVE_PLAN_ANSWERS_NODE, WebSocketAnswers("leave_plan", user_responses))
     
-    graph_builder.add_node(nodes.CREATE_STAY_PLAN_NODE, CreateStayPlan(llm))
-    graph_builder.add_node(nodes.ASK_STAY_PLAN_QUESTIONS_NODE, WebSocketQuestions("stay_plan", pending_messages, pending_messages_lock))
-    graph_builder.add_node(nodes.GET_STAY_PLAN_ANSWERS_NODE, WebSocketAnswers("stay_plan", user_responses))
+    create_stay_plan = add_node(graph_builder, nodes.CREATE_STAY_PLAN_NODE, CreateStayPlan(router.model(nodes.CREATE_STAY_PLAN_NODE), llm_cache, router.fallback(nodes.CREATE_STAY_PLAN_NODE)))
+    add_node(graph_builder, nodes.ASK_STAY_PLAN_QUESTIONS_NODE, WebSocketQuestions("stay_plan", send_message))
+    add_node(graph_builder, nodes.GET_STAY_PLAN_ANSWERS_NODE, WebSocketAnswers("stay_plan", user_responses))
     
-    graph_builder.add_node(nodes.SHOW_PLAN_NODE, ShowPlan(llm))
+    add_node(graph_builder, nodes.SHOW_PLAN_NODE, ShowPlan(router.model(nodes.SHOW_PLAN_NODE)))
+
+    # The LLM call after each choice can be started while the user is still choosing
+    if speculator:
+        speculator.add_choice(
+            nodes.GET_CONTINUE_WITH_PLAN_NODE,
+            continue_selection,
+            {"yes": (nodes.ASSESS_DEFENCE_NODE, assess_defence)},
+            likely=lambda state: "yes",
+        )
+        speculator.add_choice(
+            nodes.GET_STRATEGY_NODE,
+            strategy_selection,
+            {"leave": (nodes.CREATE_LEAVE_PLAN_NODE, create_leave_plan), "stay": (nodes.CREATE_STAY_PLAN_NODE, create_stay_plan)},
+            likely=lambda state: "stay" if state.defence_assessment and state.defence_assessment.capability_level == "high" else "leave",
+        )
 
     # Add edges
     graph_builder.add_edge(START, nodes.ASSESS_RISK_NODE)
@@ -44,6 +70,8 @@ def create_graph(llm, pending_messages, user_responses, pending_messages_lock):
     graph_builder.add_edge(nodes.ASK_CONTINUE_WITH_PLAN_NODE, nodes.GET_CONTINUE_WITH_PLAN_NODE)
 
     graph_builder.add_edge(nodes.ASK_DEFENCE_QUESTIONS_NODE, nodes.GET_DEFENCE_ANSWERS_NODE)
+    # The defence answers go back to the assessment, as the risk answers do
+    graph_builder.add_edge(nodes.GET_DEFENCE_ANSWERS_NODE, nodes.ASSESS_DEFENCE_NODE)
     graph_builder.add_edge(nodes.ASK_STRATEGY_NODE, nodes.GET_STRATEGY_NODE)
 
     graph_builder.add_edge(nodes.ASK_STAY_PLAN_QUESTIONS_NODE, nodes.GET_STAY_PLAN_ANSWERS_NODE)
@@ -55,14 +83,15 @@ def create_graph(llm, pending_messages, user_responses, pending_messages_lock):
     graph_builder.add_edge(nodes.SHOW_PLAN_NODE, END)
 
     # Add conditional edges
+    # Routes that would call a stage's LLM again are only taken while the stage is within its budget
     graph_builder.add_conditional_edges(
         source=nodes.ASSESS_RISK_NODE,
-        path=lambda state: value_with_default_and_questions(
+        path=budgeted("risk_assessment", lambda state: value_with_default_and_questions(
             state.risk_assessment.risk_level, 
             ['low', 'high', 'unclear'], 
             state.risk_assessment.questions,
             state
-            ),
+            ), loops={"unclear", "default"}, exhausted="undetermined"),
         path_map={
             "unclear": nodes.ASK_RISK_QUESTIONS_NODE,
             "low": nodes.ASK_CONTINUE_WITH_PLAN_NODE,
@@ -84,12 +113,12 @@ def create_graph(llm, pending_messages, user_responses, pending_messages_lock):
 
     graph_builder.add_conditional_edges(
         source=nodes.ASSESS_DEFENCE_NODE,
-        path=lambda state: value_with_default_and_questions(
+        path=budgeted("defence_assessment", lambda state: value_with_default_and_questions(
             state.defence_assessment.capability_level, 
             ['low', 'high', 'unclear'], 
             state.defence_assessment.questions,
             state
-            ),
+            ), loops={"unclear"}, exhausted="undetermined"),
         path_map={
             "unclear": nodes.ASK_DEFENCE_QUESTIONS_NODE,
             "low": nodes.ASK_STRATEGY_NODE,
@@ -111,9 +140,9 @@ def create_graph(llm, pending_messages, user_responses, pending_messages_lock):
 
     graph_builder.add_conditional_edges(
         source=nodes.CREATE_LEAVE_PLAN_NODE,
-        path=lambda state: (
+        path=budgeted("leave_plan", lambda state: (
             value_with_default(state.leave_plan.plan_status, ['more', 'done'], state)
-        ),
+        ), loops={"more"}, exhausted="done"),
         path_map={
             "more": nodes.ASK_LEAVE_PLAN_QUESTIONS_NODE,
             "done": nodes.SHOW_PLAN_NODE,
@@ -123,7 +152,8 @@ def create_graph(llm, pending_messages, user_responses, pending_messages_lock):
 
     graph_builder.add_conditional_edges(
         source=nodes.CREATE_STAY_PLAN_NODE,
-        path=lambda state: value_with_default(state.stay_plan.plan_status, ['more', 'done'], state),
+        path=budgeted("stay_plan", lambda state: value_with_default(state.stay_plan.plan_status, ['more', 'done'], state),
+                      loops={"more"}, exhausted="done"),
         path_map={
             "more": nodes.ASK_STAY_PLAN_QUESTIONS_NODE,
             "done": nodes.SHOW_PLAN_NODE,
@@ -131,8 +161,13 @@ def create_graph(llm, pending_messages, user_responses, pending_messages_lock):
         }
     )
 
+    # LangGraph ends the run at a node without an outgoing edge, which would end the session without a plan
+    dead_ends = set(graph_builder.nodes) - {source for source, _ in graph_builder.edges} - set(graph_builder.branches)
+    if dead_ends:
+        raise ValueError(f"Graph nodes without an outgoing edge: {', '.join(sorted(dead_ends))}")
+
     return graph_builder.compile(
-        checkpointer=MemorySaver(),
+        checkpointer=checkpointer or create_checkpointer(),
         interrupt_before=[
             nodes.GET_RISK_ANSWERS_NODE,
             nodes.GET_CONTINUE_WITH_PLAN_NODE,